@@ -0,0 +1,962 @@
+###################
+# Benchmarks for kvsservice.py that run a cluster of nodes as local processes on loopback ports,
+# so they need neither docker nor the asg4net subnet.
+# Run with: python benchmark.py {clock-size,write-modes,shard-scaling,storage,join,anti-entropy,forwarding,client,reshard,concurrency,read-scaling,replication,compression,memory,remote-cache,stats} [--nodes 6] [--shards 2] [--clients 8] [--requests 2000]
+# Mixed load and membership changes: python benchmark.py {load,scenarios} [--mix put=50,get=45,delete=5] [--distribution uniform|zipf|sequential]
+#   [--keys 1000] [--no-chain] [--json results.json], then python benchmark.py compare old.json new.json
+###################
+
+import argparse
+import bisect
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import random
+
+import requests
+
+SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kvsservice.py')
+
+
+class LocalCluster:
+    '''Starts `nodes` kvsservice processes on 127.0.0.1, all in each other's view, split into `shards` shards.
+    `env` is added to every node's environment. With `data_dir` every node keeps its DATA_DIR in its own
+    subdirectory of it.'''
+
+    def __init__(self, nodes, shards, base_port=9200, env=None, data_dir=None):
+        self.base_port = base_port
+        self.addresses = ['127.0.0.1:{}'.format(base_port + n) for n in range(nodes)]
+        self.shards = shards
+        self.env = env or {}
+        self.data_dir = data_dir
+        self.processes = {}
+
+    def start_node(self, address, view, shard_count=None):
+        env = dict(os.environ, SOCKET_ADDRESS=address, VIEW=','.join(view), **self.env)
+        if self.data_dir:
+            env['DATA_DIR'] = os.path.join(self.data_dir, address.replace(':', '-'))
+        env.pop('SHARD_COUNT', None)
+        if shard_count is not None:
+            env['SHARD_COUNT'] = str(shard_count)
+        self.processes[address] = subprocess.Popen([sys.executable, SERVICE], env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.wait_until_up(address)
+
+    def wait_until_up(self, address, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                requests.get('http://{}/view'.format(address), timeout=1)
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+        raise RuntimeError('{} did not come up'.format(address))
+
+    def kill_node(self, address):
+        self.processes[address].kill()
+        self.processes[address].wait()
+
+    def add_node(self):
+        '''Starts one more node, in the view of the others but in no shard yet. Returns its address.'''
+        address = '127.0.0.1:{}'.format(self.base_port + len(self.processes))
+        self.start_node(address, self.addresses + [address])
+        self.addresses.append(address)
+        return address
+
+    def peer_requests(self):
+        '''Calls the nodes made to each other so far, summed over the cluster.'''
+        return sum(requests.get('http://{}/connections'.format(address)).json()['requests'] for address in self.addresses)
+
+    def peer_traffic(self):
+        '''(calls, body bytes sent) the nodes still up made to each other so far, summed over the cluster.'''
+        calls = sent = 0
+        for address in self.addresses:
+            try:
+                stats = requests.get('http://{}/connections'.format(address), timeout=2).json()
+            except requests.exceptions.RequestException:
+                continue
+            calls += stats['requests']
+            sent += stats['bytes-sent']
+        return calls, sent
+
+    def __enter__(self):
+        for address in self.addresses:
+            self.processes[address] = None
+        for address in self.addresses:
+            self.start_node(address, self.addresses, self.shards)
+        # every node broadcast its view at startup, wait for the last broadcasts to settle
+        time.sleep(1)
+        return self
+
+    def __exit__(self, *exc):
+        for process in self.processes.values():
+            if process is not None:
+                process.kill()
+                process.wait()
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def write_load(cluster, clients, request_count, value_size=32, causal=True):
+    '''`clients` threads PUT `request_count` keys in total, each thread talking to its own node. With `causal`
+    every thread passes on the causal-metadata of its last response, otherwise every PUT is independent.
+    Returns (seconds, latencies, retries).'''
+    latencies = []
+    retries = [0]
+    lock = threading.Lock()
+
+    def client(n):
+        session = requests.Session()
+        address = cluster.addresses[n % len(cluster.addresses)]
+        metadata = None
+        mine = []
+        for i in range(n, request_count, clients):
+            start = time.perf_counter()
+            for attempt in range(10):
+                response = session.put('http://{}/kvs/bench{}'.format(address, i),
+                        json={'value': 'v' * value_size, 'causal-metadata': metadata})
+                if response.status_code != 503:
+                    break
+                with lock:
+                    retries[0] += 1
+                time.sleep(0.01 * 2 ** attempt)
+            mine.append(time.perf_counter() - start)
+            if causal:
+                metadata = response.json().get('causal-metadata', metadata)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, retries[0]
+
+
+def report(name, seconds, latencies, retries):
+    print('{:<12} {:>10.1f} req/s   p50 {:>7.1f} ms   p99 {:>7.1f} ms   503 retries {}'.format(
+        name, len(latencies) / seconds, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, retries))
+
+
+def key_picker(distribution, key_count, rng):
+    '''Returns a function giving the index of the next key: 'uniform' over all keys, 'zipf' with key n picked
+    in proportion to 1 / (n + 1) (a few hot keys, a long tail) or 'sequential' walking the keys in order.'''
+    if distribution == 'zipf':
+        cumulative = list(itertools.accumulate(1 / (n + 1) for n in range(key_count)))
+        return lambda: bisect.bisect_left(cumulative, rng.random() * cumulative[-1])
+    if distribution == 'sequential':
+        counter = itertools.count()
+        return lambda: next(counter) % key_count
+    return lambda: rng.randrange(key_count)
+
+
+class LoadGenerator:
+    '''`clients` threads sending a mix of PUT, GET and DELETE (`mix` {'put': weight, 'get': ..., 'delete': ...})
+    over `key_count` keys picked by key_picker(`distribution`). Each thread is one client of its own node and
+    moves on to the next node when its node cannot be reached. With `chain` every thread is one causal session
+    that passes on the causal-metadata of its last response, otherwise every request is independent. Run it
+    for a number of requests with run(), or in the background with start() and stop().'''
+
+    def __init__(self, cluster, clients, mix, key_count=1000, distribution='uniform', chain=True, value_size=32, seed=1):
+        self.cluster = cluster
+        self.clients = clients
+        self.methods = [method.upper() for method in mix]
+        self.weights = list(itertools.accumulate(mix.values()))
+        self.key_count = key_count
+        self.distribution = distribution
+        self.chain = chain
+        self.value = 'v' * value_size
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def reset(self):
+        self.latencies = {method: [] for method in self.methods}
+        self.errors = 0
+        self.retries = 0
+        self.client_bytes = 0
+        self.sent = 0
+        self.start_time = time.perf_counter()
+
+    def client(self, n, request_count):
+        rng = random.Random(self.seed * 1000 + n)
+        pick_key = key_picker(self.distribution, self.key_count, rng)
+        session = requests.Session()
+        node = n
+        metadata = None
+        for i in itertools.count():
+            if self.stopped.is_set() or (request_count is not None and i * self.clients + n >= request_count):
+                return
+            method = self.methods[bisect.bisect_left(self.weights, rng.random() * self.weights[-1])]
+            body = {'causal-metadata': metadata if self.chain else None}
+            if method == 'PUT':
+                body['value'] = self.value
+            url_key = 'key{}'.format(pick_key())
+            start = time.perf_counter()
+            response = None
+            for attempt in range(10):
+                address = self.cluster.addresses[node % len(self.cluster.addresses)]
+                try:
+                    response = session.request(method, 'http://{}/kvs/{}'.format(address, url_key), json=body, timeout=30)
+                except requests.exceptions.RequestException:
+                    node += 1 # this node is gone, go on with the next one
+                    continue
+                if response.status_code != 503:
+                    break
+                with self.lock:
+                    self.retries += 1
+                time.sleep(0.01 * 2 ** attempt)
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.sent += 1
+                if response is None or response.status_code >= 500:
+                    self.errors += 1
+                    continue
+                self.latencies[method].append(seconds)
+                self.client_bytes += len(response.request.body or b'') + len(response.content)
+            if response.status_code < 300:
+                metadata = response.json().get('causal-metadata', metadata)
+
+    def run(self, request_count):
+        '''Sends request_count requests and returns result().'''
+        self.start(request_count)
+        for thread in self.threads:
+            thread.join()
+        return self.result()
+
+    def start(self, request_count=None):
+        self.reset()
+        self.stopped.clear()
+        self.peer_before = self.cluster.peer_traffic()
+        self.threads = [threading.Thread(target=self.client, args=(n, request_count)) for n in range(self.clients)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        '''Stops the clients and returns result().'''
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join()
+        return self.result()
+
+    def result(self):
+        '''Throughput, p50/p99 latency per method, errors and body bytes of clients and between the nodes, as a dict.'''
+        seconds = time.perf_counter() - self.start_time
+        peer_calls, peer_bytes = (after - before for after, before in zip(self.cluster.peer_traffic(), self.peer_before))
+        answered = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'seconds': round(seconds, 3),
+            'requests': self.sent,
+            'throughput': round(answered / seconds, 1),
+            'latency-ms': {method: {'p50': round(percentile(latencies, 0.5) * 1000, 2), 'p99': round(percentile(latencies, 0.99) * 1000, 2)}
+                    for method, latencies in self.latencies.items() if latencies},
+            'errors': self.errors,
+            'retries': self.retries,
+            'client-bytes': self.client_bytes,
+            'peer-calls': peer_calls,
+            'peer-bytes': peer_bytes,
+        }
+
+
+def print_result(name, result, args):
+    '''Prints a LoadGenerator result and appends it, with the commit and the arguments, to --json if given.'''
+    latency = '   '.join('{} p50 {:.1f} p99 {:.1f} ms'.format(method, values['p50'], values['p99']) for method, values in result['latency-ms'].items())
+    print('{:<24} {:>8.1f} req/s   {}   errors {}   client {:.0f} B/req   peer {:.0f} B/req ({:.1f} calls)'.format(
+            name, result['throughput'], latency, result['errors'], result['client-bytes'] / max(result['requests'], 1),
+            result['peer-bytes'] / max(result['requests'], 1), result['peer-calls'] / max(result['requests'], 1)))
+    if args.json:
+        try:
+            commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                    cwd=os.path.dirname(SERVICE)).stdout.strip()
+        except OSError:
+            commit = None
+        config = {key: value for key, value in vars(args).items() if key not in ('json', 'files')}
+        with open(args.json, 'a') as out:
+            out.write(json.dumps({'name': name, 'commit': commit, 'config': config, **result}) + '\n')
+
+
+def parse_mix(text):
+    '''"put=50,get=45,delete=5" -> {'put': 50.0, 'get': 45.0, 'delete': 5.0}'''
+    mix = {}
+    for part in text.split(','):
+        method, weight = part.split('=')
+        mix[method.strip().lower()] = float(weight)
+    return mix
+
+
+def bench_write_modes(args):
+    '''Client write throughput and latency for every WRITE_MODE; 'all' is the wait-for-every-peer behavior.'''
+    for causal in (False, True):
+        print('--- {} writes'.format('causally chained' if causal else 'independent'))
+        for mode in ('all', 'quorum', 'local'):
+            with LocalCluster(args.nodes, args.shards, env={'WRITE_MODE': mode}) as cluster:
+                report(mode, *write_load(cluster, args.clients, args.requests, causal=causal))
+
+
+def bench_shard_scaling(args):
+    '''Write throughput as shards are added (two nodes each), with one /update_metadata per write to every
+    other-shard node (METADATA_INTERVAL=0) and with merged clocks sent every 50ms and every 500ms.'''
+    for interval in ('0', '0.05', '0.5'):
+        print('--- METADATA_INTERVAL={}'.format(interval))
+        for shard_count in range(1, args.shards + 1):
+            with LocalCluster(2 * shard_count, shard_count, env={'METADATA_INTERVAL': interval}) as cluster:
+                before = cluster.peer_requests()
+                report('{} shards'.format(shard_count), *write_load(cluster, args.clients, args.requests, causal=False))
+                print('{:<12} {:>10.1f} peer calls per write'.format('', (cluster.peer_requests() - before) / args.requests))
+
+
+def dict_is_causal(local_clock, message_clock, sender_address):
+    '''is_causal() as it was when clocks were {address: count} dicts, the baseline for bench_clock_size.'''
+    if message_clock[sender_address] != local_clock[sender_address] + 1:
+        return False
+    for replica_address in local_clock:
+        if replica_address != sender_address and replica_address in message_clock:
+            if message_clock[replica_address] > local_clock[replica_address]:
+                return False
+    return True
+
+
+def bench_clock_size(args):
+    '''Causal-metadata bytes and replica message comparison time as the view grows, {address: count} dicts
+    against packed client clocks and delta replica clocks. Runs in process, no cluster needed.'''
+    import kvsservice
+    print('{:>8} {:>12} {:>12} {:>12} {:>14} {:>14}'.format('replicas', 'dict bytes', 'packed bytes', 'delta bytes', 'dict compare', 'list compare'))
+    for size in (4, 16, 64, 256):
+        members = ['10.10.{}.{}:8090'.format(n // 250, n % 250 + 2) for n in range(size)]
+        vc = kvsservice.VectorClock(members)
+        vc.clock = {member: 1000 + n for n, member in enumerate(members)}
+        sender = members[-1]
+        local_dict = vc.clock
+        message_dict = dict(local_dict, **{sender: local_dict[sender] + 1})
+        message_counts = vc.counts_of(message_dict)
+        delta = {'digest': vc.digest, 'base': sum(vc.counts), 'delta': [vc.index[sender], message_dict[sender]]}
+        rounds = 20000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            dict_is_causal(local_dict, message_dict, sender)
+        dict_time = (time.perf_counter() - start) / rounds
+        start = time.perf_counter()
+        for _ in range(rounds):
+            vc.is_causal(message_counts, sender)
+        list_time = (time.perf_counter() - start) / rounds
+        print('{:>8} {:>12} {:>12} {:>12} {:>11.2f} us {:>11.2f} us'.format(size, len(json.dumps(message_dict)), len(json.dumps(vc.encode())),
+                len(json.dumps(delta)), dict_time * 1e6, list_time * 1e6))
+
+
+def load_keys(cluster, key_count, value_size=32, batch=500):
+    '''PUTs key_count keys through /kvs/batch. Returns the causal-metadata of the last batch.'''
+    metadata = None
+    for first in range(0, key_count, batch):
+        operations = [{'op': 'put', 'key': 'key{}'.format(n), 'value': 'v' * value_size} for n in range(first, min(first + batch, key_count))]
+        response = requests.post('http://{}/kvs/batch'.format(cluster.addresses[0]), json={'operations': operations, 'causal-metadata': metadata})
+        metadata = response.json()['causal-metadata']
+    return metadata
+
+
+def shard_key_count(address):
+    shard_id = requests.get('http://{}/shard/node-shard-id'.format(address)).json()['node-shard-id']
+    return requests.get('http://{}/shard/key-count/{}'.format(address, shard_id)).json()['shard-key-count']
+
+
+def bench_storage(args):
+    '''Write throughput with STORAGE_ENGINE memory and log, then the time a killed node takes to serve its
+    shard again as the store grows: the log engine restarts on its own files, the memory engine comes back
+    empty and is added to its shard again, which streams the shard from all its members through
+    /storage/export.'''
+    print('--- write throughput')
+    for engine in ('memory', 'log'):
+        data_dir = tempfile.mkdtemp(prefix='kvs-bench-')
+        try:
+            with LocalCluster(args.nodes, args.shards, env={'STORAGE_ENGINE': engine}, data_dir=data_dir) as cluster:
+                report(engine, *write_load(cluster, args.clients, args.requests, causal=False))
+        finally:
+            shutil.rmtree(data_dir)
+    print('--- restart time')
+    for key_count in (1000, 10000, 50000):
+        for engine in ('memory', 'log'):
+            data_dir = tempfile.mkdtemp(prefix='kvs-bench-')
+            try:
+                with LocalCluster(args.nodes, args.shards, env={'STORAGE_ENGINE': engine}, data_dir=data_dir) as cluster:
+                    load_keys(cluster, key_count)
+                    address = cluster.addresses[-1]
+                    shard_id = requests.get('http://{}/shard/node-shard-id'.format(address)).json()['node-shard-id']
+                    expected = shard_key_count(address)
+                    time.sleep(0.5) # let the last group fsync land
+                    cluster.kill_node(address)
+                    start = time.perf_counter()
+                    if engine == 'log':
+                        cluster.start_node(address, cluster.addresses, cluster.shards)
+                    else:
+                        cluster.start_node(address, cluster.addresses)
+                        requests.put('http://{}/shard/add-member/{}'.format(cluster.addresses[0], shard_id), json={'socket-address': address})
+                    seconds = time.perf_counter() - start
+                    recovered = shard_key_count(address)
+                print('{:<8} {:>7} keys   restart {:>7.2f} s   {} of {} shard keys back'.format(engine, key_count, seconds, recovered, expected))
+            finally:
+                shutil.rmtree(data_dir)
+
+
+def bench_join(args):
+    '''Time for /shard/add-member to bring a new node into shard 0 as the shard grows, while clients keep
+    writing, and whether the new node then holds exactly what the other members of the shard hold.'''
+    for key_count in (1000, 10000, 50000):
+        with LocalCluster(args.nodes, args.shards) as cluster:
+            load_keys(cluster, key_count)
+            address = '127.0.0.1:{}'.format(9200 + args.nodes)
+            cluster.start_node(address, cluster.addresses + [address])
+            writes = threading.Thread(target=write_load, args=(cluster, args.clients, args.requests), kwargs={'causal': False})
+            writes.start()
+            start = time.perf_counter()
+            requests.put('http://{}/shard/add-member/0'.format(cluster.addresses[0]), json={'socket-address': address})
+            seconds = time.perf_counter() - start
+            writes.join()
+            time.sleep(1) # let the last replica messages land
+            member = requests.get('http://{}/shard/members/0'.format(address)).json()['shard-members'][0]
+            print('{:>7} keys   join {:>6.2f} s   shard keys: new node {}, {} {}'.format(key_count, seconds,
+                    shard_key_count(address), member, shard_key_count(member)))
+
+
+def bench_anti_entropy(args):
+    '''Bytes and time one /antientropy/sync round takes to repair `divergent` keys a shard member has wrong,
+    against the bytes of copying the whole shard, as the store grows. The wrong keys are planted with newer
+    versions through PUT /antientropy/items on the other member, which the round must then copy back.'''
+    print('{:>7} {:>10} {:>14} {:>8} {:>10} {:>10} {:>14}'.format('keys', 'divergent', 'repair bytes', 'calls', 'repaired', 'seconds', 'full copy bytes'))
+    for key_count in (10000, 50000):
+        for divergent in (0, 1, 10, 100, 1000):
+            with LocalCluster(2, 1, env={'ANTI_ENTROPY_INTERVAL': '0'}) as cluster:
+                load_keys(cluster, key_count)
+                time.sleep(0.5) # let replication land
+                first, second = cluster.addresses
+                full = len(requests.get('http://{}/storage/export'.format(first), params={'limit': key_count}).content)
+                items = {'key{}'.format(n): {'value': 'diverged', 'version': [10 ** 9, 'bench']} for n in range(0, key_count, key_count // max(divergent, 1))}
+                requests.put('http://{}/antientropy/items'.format(second), json={'items': dict(list(items.items())[:divergent])})
+                start = time.perf_counter()
+                stats = requests.put('http://{}/antientropy/sync'.format(first), json={'socket-address': second}).json()
+                seconds = time.perf_counter() - start
+            print('{:>7} {:>10} {:>14} {:>8} {:>10} {:>10.3f} {:>14}'.format(key_count, divergent, stats['bytes'], stats['calls'],
+                    stats['pulled'] + stats['pushed'], seconds, full))
+
+
+def forwarded_to(cluster):
+    '''{member: requests the other nodes forwarded to it} from every node's /connections.'''
+    counts = {}
+    for address in cluster.addresses:
+        try:
+            stats = requests.get('http://{}/connections'.format(address), timeout=2).json()['forwarding']
+        except requests.exceptions.RequestException:
+            continue
+        for peer, health in stats.items():
+            counts[peer] = counts.get(peer, 0) + health['forwarded']
+    return counts
+
+
+def bench_forwarding(args):
+    '''Write throughput for every FORWARD_POLICY, how the forwarded writes spread over the members of each
+    shard, and the same again with one member of shard 0 killed, counting the writes that failed.'''
+    for policy in ('least-outstanding', 'round-robin'):
+        for killed in (False, True):
+            with LocalCluster(args.nodes, args.shards, env={'FORWARD_POLICY': policy}) as cluster:
+                if killed:
+                    cluster.kill_node(cluster.addresses[0])
+                    cluster.addresses = cluster.addresses[1:]
+                seconds, latencies, retries = write_load(cluster, args.clients, args.requests, causal=False)
+                report('{}{}'.format(policy, ' (1 down)' if killed else ''), seconds, latencies, retries)
+                counts = forwarded_to(cluster)
+                print('{:<12} forwarded to: {}'.format('', ', '.join('{} {}'.format(peer, counts[peer]) for peer in sorted(counts))))
+
+
+def bench_client(args):
+    '''Latency of PUTs then GETs of the same keys sent to any node (which forwards the ones of other shards)
+    against kvsclient.KVSClient sending each straight to a member of the key's shard. Every thread is one
+    causal session.'''
+    import kvsclient
+    with LocalCluster(args.nodes, args.shards) as cluster:
+        shard_map = kvsclient.ShardMap(cluster.addresses)
+        for mode in ('proxied', 'direct'):
+            for method in ('PUT', 'GET'):
+                latencies = []
+                lock = threading.Lock()
+
+                def client(n):
+                    mine = []
+                    session = requests.Session()
+                    direct = kvsclient.KVSClient(shard_map)
+                    metadata = None
+                    for i in range(n, args.requests, args.clients):
+                        key = 'client{}'.format(i)
+                        start = time.perf_counter()
+                        if mode == 'direct':
+                            direct.put(key, 'v' * 32) if method == 'PUT' else direct.get(key)
+                        else:
+                            url = 'http://{}/kvs/{}'.format(random.choice(cluster.addresses), key)
+                            response = session.request(method, url, json={'value': 'v' * 32, 'causal-metadata': metadata})
+                            metadata = response.json()['causal-metadata']
+                        mine.append(time.perf_counter() - start)
+                    with lock:
+                        latencies.extend(mine)
+
+                threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                report('{} {}'.format(mode, method), time.perf_counter() - start, latencies, 0)
+
+
+def bench_reshard(args):
+    '''Cost of finding keys' shards in process: md5 ring lookups per key against crc32 buckets and counting a
+    shard's keys from its bucket counts. Then /shard/reshard from `shards` to `shards` + 1 shards as the store
+    grows, and whether the shards' key counts still add up.'''
+    import hashlib
+    import kvsring
+    import kvsstorage
+    keys = ['key{}'.format(n) for n in range(50000)]
+    ring = kvsring.HashRing(range(3))
+    start = time.perf_counter()
+    for key in keys:
+        ring.owners[bisect.bisect_left(ring.positions, int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)) % len(ring.positions)]
+    md5_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for key in keys:
+        ring.shard_for(key)
+    bucket_time = time.perf_counter() - start
+    storage = kvsstorage.MemoryStorage({key: 'v' for key in keys}, bucket_of=ring.bucket_of)
+    start = time.perf_counter()
+    scanned = sum(1 for key in storage if ring.shard_for(key) == 0)
+    scan_time = time.perf_counter() - start
+    start = time.perf_counter()
+    counted = storage.bucket_totals(ring.buckets_of(0))[0]
+    count_time = time.perf_counter() - start
+    print('key to shard: md5 ring {:.2f} us, crc32 bucket {:.2f} us'.format(md5_time / len(keys) * 1e6, bucket_time / len(keys) * 1e6))
+    print('shard key count of 50000 keys: scan {:.2f} ms ({}), buckets {:.3f} ms ({})'.format(scan_time * 1000, scanned, count_time * 1000, counted))
+    for key_count in (10000, 50000):
+        with LocalCluster(args.nodes, args.shards) as cluster:
+            load_keys(cluster, key_count)
+            start = time.perf_counter()
+            response = requests.put('http://{}/shard/reshard'.format(cluster.addresses[0]), json={'shard-count': args.shards + 1})
+            seconds = time.perf_counter() - start
+            counts = {}
+            for address in cluster.addresses:
+                shard_id = requests.get('http://{}/shard/node-shard-id'.format(address)).json()['node-shard-id']
+                counts.setdefault(shard_id, shard_key_count(address))
+            print('{:>7} keys   reshard {} -> {} {:>6.2f} s ({})   keys per shard {} = {}'.format(key_count, args.shards, args.shards + 1,
+                    seconds, response.status_code, counts, sum(counts.values())))
+
+
+def get_load(address, concurrency, request_count, key_count):
+    '''GETs of key0..key<key_count> from `concurrency` connections all open at once to address, each sending its
+    share of request_count one after the other. Returns (seconds, latencies, failed requests).'''
+    import asyncio
+    import aiohttp
+
+    async def load():
+        latencies = []
+        errors = [0]
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60)) as session:
+            async def connection(n):
+                for i in range(n, n + max(1, request_count // concurrency)):
+                    start = time.perf_counter()
+                    try:
+                        async with session.get('http://{}/kvs/key{}'.format(address, i % key_count), json={'causal-metadata': None}) as response:
+                            await response.read()
+                            if response.status != 200:
+                                errors[0] += 1
+                                continue
+                    except (aiohttp.ClientError, asyncio.TimeoutError):
+                        errors[0] += 1
+                        continue
+                    latencies.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            await asyncio.gather(*(connection(n) for n in range(concurrency)))
+            return time.perf_counter() - start, latencies, errors[0]
+
+    return asyncio.run(load())
+
+
+def bench_concurrency(args):
+    '''GETs from `concurrency` connections all open at once to one node, for SERVER_MODE threaded and async.
+    Every connection sends its GETs one after the other over keys of every shard, so most are forwarded. Counts
+    the requests that failed (refused connections, resets, timeouts) next to the latency of the ones answered.'''
+    key_count = 1000
+    for mode in ('threaded', 'async'):
+        with LocalCluster(args.nodes, args.shards, env={'SERVER_MODE': mode}) as cluster:
+            load_keys(cluster, key_count)
+            for concurrency in (100, 500, 2000):
+                seconds, latencies, errors = get_load(cluster.addresses[0], concurrency, args.requests, key_count)
+                if latencies:
+                    report('{} {}'.format(mode, concurrency), seconds, latencies, 0)
+                print('{:<12} {} of {} failed'.format('', errors, errors + len(latencies)))
+
+
+def bench_read_scaling(args):
+    '''GET throughput from a growing number of client threads, all reading keys of the first node's shard from
+    it with causal-metadata, alone and while `clients` threads write to the same node.'''
+    import kvsclient
+    key_count = 1000
+    with LocalCluster(args.nodes, args.shards) as cluster:
+        address = cluster.addresses[0]
+        metadata = load_keys(cluster, key_count)
+        shard_map = kvsclient.ShardMap(cluster.addresses)
+        shard_id = requests.get('http://{}/shard/node-shard-id'.format(address)).json()['node-shard-id']
+        ring_keys = [key for key in ('key{}'.format(n) for n in range(key_count)) if shard_map.shard_for(key) == shard_id]
+        for writing in (False, True):
+            for threads in (1, 4, 16, 64):
+                latencies = []
+                lock = threading.Lock()
+                stop = threading.Event()
+
+                def reader(n):
+                    session = requests.Session()
+                    mine = []
+                    for i in range(n, args.requests, threads):
+                        start = time.perf_counter()
+                        session.get('http://{}/kvs/{}'.format(address, ring_keys[i % len(ring_keys)]), json={'causal-metadata': metadata})
+                        mine.append(time.perf_counter() - start)
+                    with lock:
+                        latencies.extend(mine)
+
+                def writer(n):
+                    session = requests.Session()
+                    i = 0
+                    while not stop.is_set():
+                        session.put('http://{}/kvs/{}'.format(address, ring_keys[(n + i) % len(ring_keys)]), json={'value': 'w' * 32, 'causal-metadata': None})
+                        i += args.clients
+
+                writers = [threading.Thread(target=writer, args=(n,)) for n in range(args.clients if writing else 0)]
+                readers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+                for thread in writers:
+                    thread.start()
+                start = time.perf_counter()
+                for thread in readers:
+                    thread.start()
+                for thread in readers:
+                    thread.join()
+                seconds = time.perf_counter() - start
+                stop.set()
+                for thread in writers:
+                    thread.join()
+                report('{} readers{}'.format(threads, ' + writes' if writing else ''), seconds, latencies, 0)
+
+
+REPLICA_ROUTES = ('/replica_kvs/<key>', '/replica_batch', '/update_metadata')
+
+
+def replica_messages(cluster):
+    '''Replica messages the nodes took so far, from the request counts in their /metrics.'''
+    total = 0
+    for address in cluster.addresses:
+        for line in requests.get('http://{}/metrics'.format(address)).text.splitlines():
+            if line.startswith('kvs_requests_total{') and any('route="{}"'.format(route) in line for route in REPLICA_ROUTES):
+                total += float(line.rsplit(' ', 1)[1])
+    return int(total)
+
+
+def bench_replication(args):
+    '''Replica messages per second with REPLICA_TRANSPORT http and frames. `clients` KVSClient sessions PUT
+    `requests` keys straight to their shards with write-mode local, so no client waits on a replica, and the
+    clock stops once every member of every shard holds them all. Also reports the bytes sent between the nodes
+    per replica message.'''
+    import kvsclient
+    for transport in ('http', 'frames'):
+        with LocalCluster(args.nodes, args.shards, env={'REPLICA_TRANSPORT': transport}) as cluster:
+            shard_map = kvsclient.ShardMap(cluster.addresses)
+            messages, (_, sent) = replica_messages(cluster), cluster.peer_traffic()
+            expected = {}
+            for n in range(args.requests):
+                shard_id = shard_map.shard_for('bench{}'.format(n))
+                expected[shard_id] = expected.get(shard_id, 0) + 1
+
+            def client(n):
+                session = kvsclient.KVSClient(shard_map)
+                for i in range(n, args.requests, args.clients):
+                    session.put('bench{}'.format(i), 'v' * 32, write_mode='local')
+
+            threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            written = time.perf_counter() - start
+            while True:
+                counts = {}
+                for address in cluster.addresses:
+                    shard_id = requests.get('http://{}/shard/node-shard-id'.format(address)).json()['node-shard-id']
+                    counts[address] = (shard_key_count(address), expected.get(shard_id, 0))
+                if all(count >= wanted for count, wanted in counts.values()):
+                    break
+                time.sleep(0.05)
+            seconds = time.perf_counter() - start
+            messages, sent = replica_messages(cluster) - messages, cluster.peer_traffic()[1] - sent
+            print('{:<8} {:>8} messages in {:>6.2f} s  {:>8.1f} messages/s   writes done in {:.2f} s   {:>5.0f} peer B/message'.format(
+                transport, messages, seconds, messages / seconds, written, sent / max(messages, 1)))
+
+
+def metric_totals(cluster, name):
+    '''{labels: value} of a /metrics counter summed over the nodes, labels as the text between the braces.'''
+    totals = {}
+    for address in cluster.addresses:
+        for line in requests.get('http://{}/metrics'.format(address)).text.splitlines():
+            if line.startswith(name + '{') or line.startswith(name + ' '):
+                sample, value = line.rsplit(' ', 1)
+                labels = sample[len(name):].strip('{}')
+                totals[labels] = totals.get(labels, 0) + float(value)
+    return totals
+
+
+def bench_compression(args):
+    '''PUT and GET throughput, peer bytes per write and bytes stored with COMPRESS_THRESHOLD 0 (off) and 512, for
+    `requests` JSON documents of about 4 KB written straight to their shards by `clients` KVSClient sessions.
+    Reports the compression ratio and the CPU time spent compressing and decompressing from /metrics.'''
+    import kvsclient
+
+    def document(n):
+        return {'user': 'user{}'.format(n % 100), 'events': [{'type': ('click', 'view', 'buy')[i % 3], 'page': '/products/{}'.format((n + i) % 40),
+                'ms': (n * 37 + i * 11) % 1000} for i in range(80)]}
+
+    for threshold in (0, 512):
+        with LocalCluster(args.nodes, args.shards, env={'COMPRESS_THRESHOLD': str(threshold)}) as cluster:
+            shard_map = kvsclient.ShardMap(cluster.addresses)
+            _, sent = cluster.peer_traffic()
+            timings = {}
+            for method in ('PUT', 'GET'):
+                def client(n):
+                    session = kvsclient.KVSClient(shard_map)
+                    for i in range(n, args.requests, args.clients):
+                        if method == 'PUT':
+                            session.put('doc{}'.format(i), document(i))
+                        else:
+                            session.get('doc{}'.format(i))
+
+                threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+                start = time.perf_counter()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                timings[method] = time.perf_counter() - start
+            sent = cluster.peer_traffic()[1] - sent
+            stored = sum(shard['bytes'] for address in cluster.addresses
+                    for shard in requests.get('http://{}/storage/buckets'.format(address)).json()['shards'].values())
+            sizes = metric_totals(cluster, 'kvs_compressed_bytes_total')
+            ratio = sizes.get('form="stored"', 0) / max(sizes.get('form="json"', 0), 1)
+            compress = metric_totals(cluster, 'kvs_compress_seconds_total').get('', 0)
+            decompress = metric_totals(cluster, 'kvs_decompress_seconds_total').get('', 0)
+            print('threshold {:<5} PUT {:>7.1f} req/s   GET {:>7.1f} req/s   {:>6.0f} peer B/PUT   {:>8.0f} KB stored   ratio {:.3f}   '
+                  'compress {:.1f} us/PUT   decompress {:.1f} us/GET'.format(threshold, args.requests / timings['PUT'], args.requests / timings['GET'],
+                    sent / args.requests, stored / 1024, ratio, compress / args.requests * 1e6, decompress / args.requests * 1e6))
+
+
+def resident_kb(process):
+    '''VmRSS of a node process in KB, from /proc.'''
+    with open('/proc/{}/status'.format(process.pid)) as status:
+        return int(next(line for line in status if line.startswith('VmRSS:')).split()[1])
+
+
+def bench_memory(args):
+    '''GET latency of hot keys (100 keys read over and over) and of cold ones (all `keys`, uniform) with no
+    MEMORY_BUDGET and with a budget of a fifth of the items, after loading `keys` values of 512 bytes (stored
+    uncompressed, COMPRESS_THRESHOLD=0). Reports what each node keeps in memory and spills (/storage/buckets)
+    and the resident size of the processes.'''
+    import kvsclient
+    value_size = 512
+    for budget in (0, args.keys * (value_size + 30) // 5 // (args.nodes // args.shards)):
+        with LocalCluster(args.nodes, args.shards, env={'MEMORY_BUDGET': str(budget), 'COMPRESS_THRESHOLD': '0'}) as cluster:
+            load_keys(cluster, args.keys, value_size)
+            shard_map = kvsclient.ShardMap(cluster.addresses)
+            session = requests.Session()
+            rng = random.Random(1)
+            for name, keys in (('hot', range(100)), ('cold', range(args.keys))):
+                latencies = []
+                for _ in range(args.requests):
+                    key = 'key{}'.format(rng.choice(keys))
+                    member = shard_map.members(shard_map.shard_for(key))[0]
+                    start = time.perf_counter()
+                    session.get('http://{}/kvs/{}'.format(member, key), json={'causal-metadata': None})
+                    latencies.append(time.perf_counter() - start)
+                print('budget {:<9} {:<5} GET p50 {:>6.2f} ms   p99 {:>6.2f} ms'.format(budget, name, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+            memory = requests.get('http://{}/storage/buckets'.format(cluster.addresses[0])).json()['memory']
+            print('budget {:<9} node 0: {} keys / {} KB in memory, {} keys / {} KB spilled   RSS {} KB per node'.format(budget, memory['resident-keys'],
+                    memory['resident-bytes'] // 1024, memory['spilled-keys'], memory['spilled-bytes'] // 1024,
+                    sum(resident_kb(process) for process in cluster.processes.values()) // len(cluster.processes)))
+
+
+def bench_remote_cache(args):
+    '''Zipf load of mostly GETs (--mix get=95,put=5 unless given), each client a causal session on its own node,
+    with REMOTE_CACHE_SIZE 0 (off) and 1000. Reports the load, the requests forwarded to other shards per request
+    and the remote read cache's hits, misses and lookups behind the client's clock from /metrics.'''
+    mix = parse_mix(args.mix if args.mix != 'put=50,get=45,delete=5' else 'get=95,put=5')
+    for size in (0, 1000):
+        with LocalCluster(args.nodes, args.shards, env={'REMOTE_CACHE_SIZE': str(size)}) as cluster:
+            load_keys(cluster, args.keys)
+            before = sum(forwarded_to(cluster).values())
+            load = LoadGenerator(cluster, args.clients, mix, args.keys, 'zipf', args.chain)
+            result = load.run(args.requests)
+            forwarded = sum(forwarded_to(cluster).values()) - before
+            print_result('remote-cache {}'.format(size), result, args)
+            lookups = metric_totals(cluster, 'kvs_remote_cache_total')
+            print('cache {:<5} {:.3f} forwarded per request   hits {:.0f}   misses {:.0f}   behind {:.0f}'.format(size, forwarded / result['requests'],
+                    lookups.get('result="hit"', 0), lookups.get('result="miss"', 0), lookups.get('result="behind"', 0)))
+
+
+def bench_stats(args):
+    '''`clients` dashboards polling the whole cluster's key counts for 5 seconds while a write load runs: each
+    asking /shard/key-count/<ID> of every shard in turn, then each polling /cluster/stats. Reports the polls
+    answered, their latency and the stats requests the shards' members served for them.'''
+    with LocalCluster(args.nodes, args.shards) as cluster:
+        load_keys(cluster, args.keys)
+        load = LoadGenerator(cluster, 4, {'put': 1}, args.keys)
+        load.start()
+        for name in ('key-count', 'cluster-stats'):
+            routes = ('/shard/key-count/<ID>', '/shard/stats/<ID>')
+            before = sum(value for labels, value in metric_totals(cluster, 'kvs_requests_total').items() if any(route in labels for route in routes))
+            latencies = []
+            stopped = threading.Event()
+
+            def dashboard(n):
+                session = requests.Session()
+                address = cluster.addresses[n % len(cluster.addresses)]
+                while not stopped.is_set():
+                    start = time.perf_counter()
+                    if name == 'key-count':
+                        for shard_id in range(args.shards):
+                            session.get('http://{}/shard/key-count/{}'.format(address, shard_id), timeout=30)
+                    else:
+                        session.get('http://{}/cluster/stats'.format(address), timeout=30)
+                    latencies.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=dashboard, args=(n,)) for n in range(args.clients)]
+            for thread in threads:
+                thread.start()
+            time.sleep(5)
+            stopped.set()
+            for thread in threads:
+                thread.join()
+            served = sum(value for labels, value in metric_totals(cluster, 'kvs_requests_total').items() if any(route in labels for route in routes)) - before
+            print('{:<14} {:>7.1f} polls/s   p50 {:>6.2f} ms   p99 {:>6.2f} ms   {:>5.0f} stats requests served'.format(name, len(latencies) / 5,
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, served))
+        load.stop()
+
+
+def bench_load(args):
+    '''Mixed load (--mix, --distribution, --keys, --chain) from `clients` threads for `requests` requests, after
+    loading the keys. The baseline the scenarios compare against.'''
+    with LocalCluster(args.nodes, args.shards) as cluster:
+        load_keys(cluster, args.keys)
+        load = LoadGenerator(cluster, args.clients, parse_mix(args.mix), args.keys, args.distribution, args.chain)
+        print_result('load {} {}'.format(args.distribution, args.mix), load.run(args.requests), args)
+
+
+def bench_scenarios(args):
+    '''The mixed load of bench_load running through a membership change: a node added to shard 0 with
+    /shard/add-member, a /shard/reshard to one more shard, and a node killed. Reports the load during the change
+    and how long the change took, then checks that every shard's members agree on its key count.'''
+    def during(name, change):
+        with LocalCluster(args.nodes, args.shards) as cluster:
+            load_keys(cluster, args.keys)
+            load = LoadGenerator(cluster, args.clients, parse_mix(args.mix), args.keys, args.distribution, args.chain)
+            load.start()
+            time.sleep(1)
+            start = time.perf_counter()
+            change(cluster)
+            seconds = time.perf_counter() - start
+            time.sleep(1)
+            result = load.stop()
+            result['change-seconds'] = round(seconds, 3)
+            print_result(name, result, args)
+            time.sleep(1) # let the last replica messages land
+            counts = {}
+            for address in cluster.addresses:
+                try:
+                    shard_id = requests.get('http://{}/shard/node-shard-id'.format(address), timeout=5).json()['node-shard-id']
+                    counts.setdefault(shard_id, set()).add(shard_key_count(address))
+                except requests.exceptions.RequestException:
+                    continue
+            print('{:<24} change took {:.2f} s   key counts per shard {}'.format('', seconds, {shard_id: sorted(values) for shard_id, values in sorted(counts.items())}))
+
+    def add_member(cluster):
+        address = cluster.add_node()
+        requests.put('http://{}/shard/add-member/0'.format(cluster.addresses[0]), json={'socket-address': address})
+
+    def reshard(cluster):
+        cluster.add_node() # two nodes for the new shard
+        cluster.add_node()
+        requests.put('http://{}/shard/reshard'.format(cluster.addresses[0]), json={'shard-count': args.shards + 1})
+
+    def kill(cluster):
+        address = cluster.addresses[-1]
+        cluster.kill_node(address)
+        cluster.addresses.remove(address)
+        time.sleep(2) # the load runs on with the node gone until the others drop it from their view
+
+    during('steady', lambda cluster: time.sleep(2))
+    during('add-member', add_member)
+    during('reshard', reshard)
+    during('kill', kill)
+
+
+def bench_compare(args):
+    '''Compares the results of two --json files (say from two commits) by name: throughput, p99 and bytes.'''
+    if len(args.files) != 2:
+        raise SystemExit('compare needs two result files: python benchmark.py compare OLD.json NEW.json')
+    old, new = ({json.loads(line)['name']: json.loads(line) for line in open(path) if line.strip()} for path in args.files)
+    print('{:<24} {:>16} {:>20} {:>20}'.format('', 'req/s', 'p99 ms (worst op)', 'peer B/req'))
+    for name in old.keys() & new.keys():
+        a, b = old[name], new[name]
+        p99 = [max((values['p99'] for values in result['latency-ms'].values()), default=0) for result in (a, b)]
+        peer = [result['peer-bytes'] / max(result['requests'], 1) for result in (a, b)]
+        print('{:<24} {:>7.1f} -> {:<7.1f} {:>9.1f} -> {:<9.1f} {:>9.0f} -> {:<9.0f}'.format(name, a['throughput'], b['throughput'], p99[0], p99[1], peer[0], peer[1]))
+
+
+BENCHMARKS = {
+    'clock-size': bench_clock_size,
+    'write-modes': bench_write_modes,
+    'shard-scaling': bench_shard_scaling,
+    'storage': bench_storage,
+    'join': bench_join,
+    'anti-entropy': bench_anti_entropy,
+    'forwarding': bench_forwarding,
+    'client': bench_client,
+    'reshard': bench_reshard,
+    'concurrency': bench_concurrency,
+    'read-scaling': bench_read_scaling,
+    'replication': bench_replication,
+    'compression': bench_compression,
+    'memory': bench_memory,
+    'remote-cache': bench_remote_cache,
+    'stats': bench_stats,
+    'load': bench_load,
+    'scenarios': bench_scenarios,
+    'compare': bench_compare,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='kvsservice benchmarks on a local cluster')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--nodes', type=int, default=6)
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--mix', default='put=50,get=45,delete=5', help='weights of the methods load and scenarios send')
+    parser.add_argument('--distribution', default='uniform', choices=('uniform', 'zipf', 'sequential'))
+    parser.add_argument('--keys', type=int, default=1000)
+    parser.add_argument('--chain', action=argparse.BooleanOptionalAction, default=True, help='pass causal-metadata from one request to the next')
+    parser.add_argument('--json', help='append the results of load and scenarios to this file, one JSON object per line')
+    parser.add_argument('files', nargs='*', help='the two --json files compare reads')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
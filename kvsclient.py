@@ -0,0 +1,171 @@
+###################
+# Client for the key value store that sends every request straight to a member of the key's shard, instead of
+# to any node that would then forward it there. It keeps a copy of the shard map from /shard/map and routes keys
+# with the same hash ring as the nodes (kvsring.py). Every response carries the node's X-Shard-Epoch; when it is
+# not the epoch of the cached map, the map is fetched again. A KVSClient is one causal session: it hands the
+# causal-metadata of every response to its next request.
+#
+#   shard_map = ShardMap(['10.10.0.2:8090', '10.10.0.3:8090'])
+#   client = KVSClient(shard_map)
+#   client.put('x', 1)
+#   client.get('x')
+###################
+
+import itertools
+import threading
+import time
+
+import requests
+
+from kvsring import HashRing
+
+
+class KVSError(Exception):
+    '''A request the store answered with an error. `status` is the HTTP status, `body` the JSON it sent.'''
+
+    def __init__(self, status, body):
+        super().__init__(f"{status}: {body.get('error', body)}")
+        self.status = status
+        self.body = body
+
+
+class ShardMap:
+    '''The shard map of the store `nodes` belong to, fetched from the first of them that answers. Can be shared
+    by many KVSClients (and threads).'''
+
+    def __init__(self, nodes, timeout=10):
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.turns = itertools.count()
+        self.epoch = None
+        self.shards = {}
+        self.ring = HashRing([])
+        self.refresh()
+
+    def refresh(self):
+        '''Fetch the map again. Raises the last RequestException if no known node answers.'''
+        error = None
+        for node in self.known_nodes():
+            try:
+                body = requests.get(f'http://{node}/shard/map', timeout=self.timeout).json()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                error = e
+                continue
+            with self.lock:
+                self.shards = {int(shard_id): members for shard_id, members in body['shards'].items()}
+                self.ring = HashRing(self.shards.keys(), body['vnodes'], body['buckets'], body['key-hash'])
+                self.epoch = body['epoch']
+            return
+        raise error or requests.exceptions.ConnectionError('No node to fetch the shard map from')
+
+    def known_nodes(self):
+        with self.lock:
+            members = [member for shard_members in self.shards.values() for member in shard_members]
+        return list(dict.fromkeys(members + self.nodes))
+
+    def shard_for(self, key):
+        with self.lock:
+            return self.ring.shard_for(key)
+
+    def members(self, shard_id):
+        '''The members of shard_id, starting with a different one every call so requests spread over them.'''
+        with self.lock:
+            members = list(self.shards.get(shard_id, []))
+        if not members:
+            return members
+        turn = next(self.turns) % len(members)
+        return members[turn:] + members[:turn]
+
+    def seen(self, epoch):
+        '''Called with the X-Shard-Epoch of every response, refreshes the map if it is not the cached one.'''
+        if epoch is not None and epoch != self.epoch:
+            self.refresh()
+
+
+class KVSClient:
+    '''One causal session against the store. `retries` is how often a request the store answered with 503
+    (causal dependencies not there yet) is sent again, with a growing pause, before KVSError is raised.'''
+
+    def __init__(self, shard_map, retries=5, timeout=30):
+        self.shard_map = shard_map
+        self.retries = retries
+        self.timeout = timeout
+        self.metadata = None
+        self.http = requests.Session()
+
+    def send(self, method, shard_id, path, body):
+        '''Sends body to a member of shard_id, to the next member if one cannot be reached. Returns the response.'''
+        for attempt in range(self.retries + 1):
+            response = None
+            for member in self.shard_map.members(shard_id):
+                try:
+                    response = self.http.request(method, f'http://{member}{path}', json=body, timeout=self.timeout)
+                    break
+                except requests.exceptions.RequestException:
+                    continue
+            if response is None: # every member we knew of is gone, the map must be old
+                self.shard_map.refresh()
+                continue
+            self.shard_map.seen(response.headers.get('X-Shard-Epoch'))
+            if response.status_code != 503:
+                return response
+            time.sleep(0.01 * 2 ** attempt)
+        if response is None:
+            raise requests.exceptions.ConnectionError(f'No member of shard {shard_id} could be reached')
+        return response
+
+    def request(self, method, key, **body):
+        body['causal-metadata'] = self.metadata
+        response = self.send(method, self.shard_map.shard_for(key), f'/kvs/{key}', body)
+        data = response.json()
+        if response.status_code >= 400:
+            raise KVSError(response.status_code, data)
+        self.metadata = data['causal-metadata']
+        return data
+
+    def get(self, key, default=None):
+        '''The value of key, `default` if it does not exist.'''
+        try:
+            return self.request('GET', key)['value']
+        except KVSError as e:
+            if e.status == 404:
+                return default
+            raise
+
+    def put(self, key, value, write_mode=None):
+        '''Returns "created" or "replaced".'''
+        extra = {'write-mode': write_mode} if write_mode else {}
+        return self.request('PUT', key, value=value, **extra)['result']
+
+    def delete(self, key, write_mode=None):
+        '''Returns False if key did not exist.'''
+        extra = {'write-mode': write_mode} if write_mode else {}
+        try:
+            self.request('DELETE', key, **extra)
+        except KVSError as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    def batch(self, operations, write_mode=None):
+        '''Runs /kvs/batch operations ({"op", "key", "value"}), one batch per shard sent straight to it, and
+        returns a result per operation in order. The shards' batches go one after the other, each depending on
+        the ones before it.'''
+        groups = {}
+        for index, operation in enumerate(operations):
+            groups.setdefault(self.shard_map.shard_for(operation['key']), []).append(index)
+        results = [None] * len(operations)
+        for shard_id, indexes in groups.items():
+            body = {'operations': [operations[index] for index in indexes], 'causal-metadata': self.metadata}
+            if write_mode:
+                body['write-mode'] = write_mode
+            response = self.send('POST', shard_id, '/kvs/batch', body)
+            data = response.json()
+            if response.status_code != 200:
+                raise KVSError(response.status_code, data)
+            self.metadata = data['causal-metadata']
+            for index, result in zip(indexes, data['results']):
+                results[index] = result
+        return results
@@ -0,0 +1,59 @@
+###################
+# The consistent hash ring that maps keys to shards. kvsservice.py routes with it and kvsclient.py uses the
+# same ring, so a client finds a key's shard exactly like the nodes do.
+###################
+
+import bisect
+import hashlib
+import zlib
+
+# Functions a key can be hashed into its bucket with. crc32 runs in C over the key's bytes and is several times
+# cheaper than md5, which is kept for keys that might be crafted to crowd one bucket
+KEY_HASHES = {
+    'crc32': lambda key: zlib.crc32(key.encode('utf-8')),
+    'md5': lambda key: int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:4], 'big'),
+}
+
+def ring_position(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest(), 16)
+
+## The bucket of key, out of `buckets`
+def bucket_of(key, buckets, key_hash='crc32'):
+    return KEY_HASHES[key_hash](key) % buckets
+
+# Every shard owns `vnodes` points on a ring of md5 values. A key is hashed into one of `buckets` buckets, and a
+# bucket belongs to the shard owning the first point at or after the bucket's own position, so all keys of a
+# bucket always live on the same shard and move together. The owner of every bucket is worked out once, here
+class HashRing:
+    def __init__(self, shard_ids, vnodes=256, buckets=4096, key_hash='crc32'):
+        if key_hash not in KEY_HASHES:
+            raise ValueError(f"Key hash: {key_hash} is not one of {', '.join(KEY_HASHES)}. // HashRing()")
+        self.vnodes = vnodes
+        self.buckets = buckets
+        self.key_hash = key_hash
+        points = sorted((ring_position(f'shard-{shard_id}-vnode-{i}'), shard_id) for shard_id in shard_ids for i in range(vnodes))
+        self.positions = [position for position, _ in points]
+        self.owners = [shard_id for _, shard_id in points]
+        self.bucket_owners = [self.owner_at(ring_position(f'bucket-{bucket}')) for bucket in range(buckets)] if points else []
+        self.shard_buckets = {shard_id: [] for shard_id in shard_ids}
+        for bucket, shard_id in enumerate(self.bucket_owners):
+            self.shard_buckets[shard_id].append(bucket)
+
+    def owner_at(self, position):
+        index = bisect.bisect_left(self.positions, position)
+        if index == len(self.positions): # wrap around past the last point
+            index = 0
+        return self.owners[index]
+
+    def bucket_of(self, key):
+        return bucket_of(key, self.buckets, self.key_hash)
+
+    # return the shard id owning key
+    def shard_for(self, key):
+        if not self.positions:
+            raise KeyError(f"Key: {key} has no shard, ring is empty. // shard_for()")
+        return self.bucket_owners[self.bucket_of(key)]
+
+    # the buckets shard_id owns
+    def buckets_of(self, shard_id):
+        return self.shard_buckets.get(shard_id, [])
@@ -1,9 +1,39 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, g
 import requests
+import urllib3
+from urllib.parse import urlsplit
 import os
+import socket
 import logging
 import hashlib
+import json
+import base64
+import struct
 import time
+import bisect
+import operator
+import random
+import heapq
+import threading
+import collections
+import contextlib
+import itertools
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, Future
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError: # only SERVER_MODE=async needs it
+    aiohttp = None
+try:
+    import msgpack
+except ImportError: # only REPLICA_TRANSPORT=frames needs it
+    msgpack = None
+
+import kvsstorage
+import kvsring
+from kvsring import HashRing
 
 app = Flask(__name__)
 
@@ -11,55 +41,1222 @@ logging.basicConfig(level=logging.DEBUG)
 
 # print(replicas)
 ERRMSG = "Method Not Allowed"
+VNODES = int(os.environ.get('VNODES', 256)) # virtual nodes per shard on the hash ring
+TRANSFER_CHUNK = int(os.environ.get('TRANSFER_CHUNK', 500)) # key value pairs per chunk when storage moves between nodes
+JOIN_CHUNK = int(os.environ.get('JOIN_CHUNK', 5000)) # key value pairs per page a joining node copies from a member
+FANOUT_WORKERS = int(os.environ.get('FANOUT_WORKERS', 32)) # threads sending to peers concurrently
+WRITE_MODES = ('all', 'quorum', 'local')
+WRITE_MODE = os.environ.get('WRITE_MODE', 'all') # default for client writes, a request can pick another with "write-mode"
+WRITE_QUORUM = int(os.environ.get('WRITE_QUORUM', 0)) # replicas (this one included) holding a quorum write, 0 for a majority of the shard
+METADATA_INTERVAL = float(os.environ.get('METADATA_INTERVAL', 0.05)) # seconds between merged clocks sent to other shards, 0 to send one per write
+HOLDBACK_TIMEOUT = float(os.environ.get('HOLDBACK_TIMEOUT', 10)) # seconds a causally early replica message is held before a 503
+CAUSAL_WAIT = float(os.environ.get('CAUSAL_WAIT', 5)) # seconds a client request waits for the dependencies in its causal-metadata
+POOL_SIZE = int(os.environ.get('POOL_SIZE', 16)) # keep-alive connections kept open to each peer
+PEER_CONNECT_TIMEOUT = float(os.environ.get('PEER_CONNECT_TIMEOUT', 3)) # seconds to open a connection to a peer
+PEER_TIMEOUT = float(os.environ.get('PEER_TIMEOUT', 30)) # seconds to wait for a peer's response
+FORWARD_POLICIES = ('least-outstanding', 'round-robin')
+FORWARD_POLICY = os.environ.get('FORWARD_POLICY', 'least-outstanding') # how a request for another shard picks the member it goes to
+PEER_BACKOFF = float(os.environ.get('PEER_BACKOFF', 1)) # seconds a member that failed a forwarded call is tried last, doubling while it keeps failing
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'memory') # 'memory', or 'log' to keep data, clock and shard map in DATA_DIR
+DATA_DIR = os.environ.get('DATA_DIR', 'data') # where the log storage engine keeps its files
+BUCKETS = int(os.environ.get('BUCKETS', 4096)) # hash buckets keys are grouped in, shards own and hand over whole buckets
+KEY_HASH = os.environ.get('KEY_HASH', 'crc32') # what hashes a key into its bucket, one of kvsring.KEY_HASHES
+ANTI_ENTROPY_INTERVAL = float(os.environ.get('ANTI_ENTROPY_INTERVAL', 10)) # seconds between hash tree comparisons with a shard peer, 0 to turn them off
+SERVER_MODES = ('threaded', 'async')
+SERVER_MODE = os.environ.get('SERVER_MODE', 'threaded') # 'threaded' Flask dev server, or 'async' aiohttp server (needs aiohttp)
+WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 64)) # threads running the Flask routes in async mode
+ASYNC_PEER_CONNECTIONS = int(os.environ.get('ASYNC_PEER_CONNECTIONS', 256)) # connections the async server keeps open to each peer
+KEY_STRIPES = int(os.environ.get('KEY_STRIPES', 64)) # locks the keys are striped over by bucket
+REPLICA_TRANSPORTS = ('http', 'frames')
+REPLICA_TRANSPORT = os.environ.get('REPLICA_TRANSPORT', 'http') # how replica messages travel, 'frames' for msgpack frames on a persistent connection (needs msgpack)
+REPLICA_PORT_OFFSET = int(os.environ.get('REPLICA_PORT_OFFSET', 1000)) # the frame listener's port is SOCKET_ADDRESS's port plus this
+REPLICA_WINDOW = int(os.environ.get('REPLICA_WINDOW', 64)) # replica messages sent to a peer before the oldest is answered
+REMOTE_CACHE_SIZE = int(os.environ.get('REMOTE_CACHE_SIZE', 0)) # values of other shards' keys kept for GETs forwarded from here, 0 to forward every GET
+METADATA_KEYS = int(os.environ.get('METADATA_KEYS', 1000)) # written keys named in one clock sent to other shards, past that the clock drops all their cached keys
+STATS_TTL = float(os.environ.get('STATS_TTL', 1)) # seconds /cluster/stats answers from what it gathered last
+STATS_TIMEOUT = float(os.environ.get('STATS_TIMEOUT', 2)) # seconds /cluster/stats waits for a shard member's stats before trying the next one
+RATE_WINDOW = int(os.environ.get('RATE_WINDOW', 10)) # seconds of requests the request rates in the stats are averaged over
+
+# A threading.Condition that coroutines of the async server can wait on too. A coroutine cannot block the event
+# loop in wait(), so it registers a future instead and every notify_all() resolves the registered futures, from
+# whatever thread it runs on
+class AsyncCondition(threading.Condition):
+    def __init__(self, lock=None):
+        super().__init__(lock)
+        self.futures = []
+
+    def notify_all(self):
+        super().notify_all()
+        futures, self.futures = self.futures, []
+        for loop, future in futures:
+            loop.call_soon_threadsafe(resolve_future, future)
+
+    # wait_for() for coroutines. The lock is only held to test the predicate
+    async def wait_for_async(self, predicate, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self:
+                if predicate():
+                    return True
+                future = loop.create_future()
+                self.futures.append((loop, future))
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                with self:
+                    if (loop, future) in self.futures:
+                        self.futures.remove((loop, future))
+                    return predicate()
+
+def resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+# a reshard's per-shard transfers fan out again themselves, so they get their own pool instead of waiting on fanout_pool
+transfer_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='transfer')
+
+### LOCKS ###
+# write_lock guards the vector clock: ticks, merges and relayouts, and queueing replica messages in clock order.
+# A local write or a delivered replica message changes storage under it too, so its tick covers the change.
+# Every change of a key also holds the key's stripe (key_lock()), so its value and version change together.
+# Repairs and copies that do not move the clock (anti-entropy, imports) take only the stripes and leave client
+# requests alone. The view and shard map are swapped copy-on-write under membership_lock (see MEMBERSHIP).
+# Locks are taken in this order: write_lock, membership_lock, stripes (in stripe order), version_lock
+write_lock = threading.Lock() # a local write, its clock tick and queueing its messages happen as one step
+clock_changed = AsyncCondition(write_lock) # notified (under write_lock) whenever vc moves forward
+key_locks = [threading.Lock() for _ in range(KEY_STRIPES)]
+membership_lock = threading.RLock()
+version_lock = threading.Lock() # the Lamport clock of the versions
+
+def key_lock(key):
+    return key_locks[bucket_of(key) % KEY_STRIPES]
+
+## Holds the stripes of all of keys, taken in stripe order so two holders never wait on each other
+@contextlib.contextmanager
+def keys_locked(keys):
+    stripes = [key_locks[stripe] for stripe in sorted({bucket_of(key) % KEY_STRIPES for key in keys})]
+    for stripe in stripes:
+        stripe.acquire()
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            stripe.release()
 
 ### VECTOR CLOCK ###
+# Short name of a clock layout (the sorted replica addresses), sent with every clock instead of the addresses
+def layout_digest(members):
+    return hashlib.md5('\n'.join(members).encode('utf-8')).hexdigest()[:8]
+
+# Clients get the clock as "<layout digest>:<counters>", the counters as base64 varints in layout order
+def pack_clock(digest, counts):
+    packed = bytearray()
+    for count in counts:
+        while count > 0x7f:
+            packed.append(count & 0x7f | 0x80)
+            count >>= 7
+        packed.append(count)
+    return f'{digest}:{base64.urlsafe_b64encode(bytes(packed)).decode().rstrip("=")}'
+
+# Inverse of pack_clock(), returns (digest, counts). Raises ValueError if message_clock is not a packed clock
+def unpack_clock(message_clock):
+    digest, separator, packed = message_clock.partition(':')
+    if not separator:
+        raise ValueError(f"Clock: {message_clock} is not a packed clock. // unpack_clock()")
+    counts, count, shift = [], 0, 0
+    for byte in base64.urlsafe_b64decode(packed + '=' * (-len(packed) % 4)):
+        count |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            counts.append(count)
+            count, shift = 0, 0
+    return digest, counts
+
 class VectorClock: # view is Vector Clock
-    # initialize clock as dictionary
+    # Counters live in a list indexed by the replica's position among the sorted addresses of the view, so every
+    # node with the same view agrees on the positions. `digest` names that layout on the wire and `layouts` keeps
+    # every layout this node has had, so clocks made in an earlier view can still be read
     def __init__(self, replicas):
-        self.clock = {}
-        for replica in replicas:
-            self.add_replica(replica)
+        self.members = []
+        self.counts = []
+        self.layouts = {}
+        self.relayout(replicas)
+
+    # move the counters to the layout of `replicas`, counters of replicas that stay keep their value
+    def relayout(self, replicas, counts=None):
+        old = counts if counts is not None else self.clock
+        self.members = sorted(set(replicas))
+        self.index = {replica_address: position for position, replica_address in enumerate(self.members)}
+        self.counts = [old.get(replica_address, 0) for replica_address in self.members]
+        self.digest = layout_digest(self.members)
+        self.layouts[self.digest] = self.members
+
+    # {address: count}, for copying the whole clock to a new replica
+    @property
+    def clock(self):
+        return dict(zip(self.members, self.counts))
+
+    @clock.setter
+    def clock(self, clock):
+        self.relayout(set(self.members) | set(clock), clock)
+
+    def get(self, replica_address):
+        return self.counts[self.index[replica_address]] if replica_address in self.index else 0
+
+    # (digest, counts) copy of the clock as it is now
+    def snapshot(self):
+        return self.digest, list(self.counts)
 
     # used to increment the host clock at the senders position
     def increment(self, sender_address):
-        if sender_address in self.clock.keys():
-            self.clock[sender_address] += 1
+        if sender_address in self.index:
+            self.counts[self.index[sender_address]] += 1
         else:
-            raise KeyError(f"Key: {self.socket} not in vc. // increment()")
+            raise KeyError(f"Key: {sender_address} not in vc. // increment()")
     
     def add_replica(self, replica_address):
-        if replica_address not in self.clock.keys():
-            # raise KeyError(f"Key: {replica_address} already in vc. // add_replica()")
-            self.clock[replica_address] = 0
+        if replica_address not in self.index:
+            self.relayout(self.members + [replica_address])
 
     def delete_replica(self, replica_address):
-        if replica_address in self.clock.keys():
-            del self.clock[replica_address]
-
-    # Compare two vector clocks.
-    # Return boolean True if replica_vc happens before or is concurrent to other_clock, False otherwise
-    def is_causal(self, message_clock, sender_address=None):
-        if not isinstance(message_clock, dict):
-            raise TypeError("Other clock must be a dictionary. // is_causal()")
-        
-        if sender_address != None: # None indicates a client call and !none is from replica
-            if message_clock[sender_address] != self.clock[sender_address] + 1:
-                return False
+        if replica_address in self.index:
+            self.relayout([member for member in self.members if member != replica_address])
+
+    # counters of a (digest, counts) clock, moved to the current layout. Raises KeyError for an unknown layout
+    def align(self, message_clock):
+        digest, counts = message_clock
+        if digest == self.digest:
+            return counts
+        aligned = [0] * len(self.members)
+        for replica_address, count in zip(self.layouts[digest], counts):
+            if replica_address in self.index:
+                aligned[self.index[replica_address]] = count
+        return aligned
+
+    # counters of an {address: count} clock in the current layout, missing addresses count 0
+    def counts_of(self, message_clock):
+        return [message_clock.get(replica_address, 0) for replica_address in self.members]
+
+    # {address: count} without the zero counters, the full clock form of replica messages
+    def sparse(self):
+        return {replica_address: count for replica_address, count in zip(self.members, self.counts) if count}
+
+    def encode(self, counts=None):
+        return pack_clock(self.digest, self.counts if counts is None else counts)
+
+    # Compare message_counts (in the current layout) with this clock, or with `counts` for a client call.
+    # Return boolean True if every counter is already delivered here, except the sender's which must be the next one
+    def is_causal(self, message_counts, sender_address=None, counts=None):
+        if sender_address == None: # None indicates a client call and !none is from replica
+            return all(map(operator.le, message_counts, self.counts if counts is None else counts))
+        sender = self.index[sender_address]
+        # the sender's counter is one ahead, so it must be the only counter ahead of this clock
+        return message_counts[sender] == self.counts[sender] + 1 and sum(map(operator.gt, message_counts, self.counts)) == 1
+
+## The clock as clients get it. A view change swaps the layout and the counters, so they are read under write_lock
+def current_clock():
+    with write_lock:
+        clock = vc.snapshot()
+    return pack_clock(*clock)
+
+### CONSISTENT HASH RING ###
+# Every shard owns VNODES points on a ring of md5 positions and a key belongs to the first point at or after
+# its own position. Shard ids are stable, so going from N to N+1 shards only hands over the arcs claimed by
+# the new shard's points, which is about 1/(N+1) of the keys. Keys are grouped into BUCKETS hash buckets and
+# the ring places buckets rather than keys, so storage keeps every bucket's keys together and a shard's keys are
+# the keys of its buckets. The ring itself is in kvsring.py, which kvsclient.py shares to route keys the same way.
+
+# Replace the shard map and rebuild the ring that hash_of_key() reads. The ring is built before anything is swapped
+def set_shards(new_shards):
+    global shards, shard_count, ring, epoch
+    new_ring = HashRing(new_shards.keys(), VNODES, BUCKETS, KEY_HASH)
+    new_epoch = hashlib.md5(json.dumps([VNODES, BUCKETS, KEY_HASH, sorted((shard_id, sorted(members)) for shard_id, members in new_shards.items())]).encode('utf-8')).hexdigest()[:8]
+    with membership_lock:
+        ring = new_ring
+        shards = new_shards
+        shard_count = len(new_shards)
+        epoch = new_epoch
+    remote_cache.clear() # cached keys may belong to other shards now
+
+def bucket_of(key):
+    return kvsring.bucket_of(key, BUCKETS, KEY_HASH)
+
+## Names the shard map: every node with the same map (and VNODES) has the same epoch. set_shards() works it out
+## once per map. Every response carries it as X-Shard-Epoch, so a client that caches the map sees when its copy
+## went stale
+def shard_epoch():
+    return epoch
+
+### MEMBERSHIP ###
+# The view (replicas) and the shard map (shards) are never changed in place. A change builds new lists under
+# membership_lock and swaps the global, so a request that took `replicas` or `shards` once reads one version
+# of them without a lock. The clock's layout follows the view separately, under write_lock
+
+## Adds address to the view. False if it was in it already
+def view_add(address):
+    global replicas
+    with membership_lock:
+        if address in replicas:
+            return False
+        replicas = replicas + [address]
+    return True
+
+## Takes address out of the view and out of its shard. False if it was not in the view
+def view_remove(address):
+    global replicas
+    with membership_lock:
+        if address not in replicas:
+            return False
+        replicas = [replica for replica in replicas if replica != address]
+        set_shards({shard_id: [member for member in members if member != address] for shard_id, members in shards.items()})
+    return True
+
+## Adds address to the members of shard_id, if there is such a shard and address is not in it yet
+def shard_add(shard_id, address):
+    with membership_lock:
+        if shard_id in shards and address not in shards[shard_id]:
+            set_shards({**shards, shard_id: shards[shard_id] + [address]})
+
+### REPLICA MESSAGE CLOCKS ###
+# A replica message carries its clock either in full, as {address: count} without the zero counters, packed like a
+# client clock (the frame transport, whose pipelined messages cannot count on the peer holding a base), or as a
+# delta: {"digest": layout, "base": sum of the base clock, "delta": [position, count, ...]} listing the counters
+# that changed since the last clock the peer took from this sender (see Outbox.compact()). The last few clocks
+# taken from every sender are kept here as bases, keyed by layout and sum, which a sender's clocks never repeat
+RECEIVED_BASES = 4
+received_clocks = {}
+
+## Returns {"senders-address", "coalesced", "clock": (digest, counts)} for a replica message's causal-metadata.
+## Raises LookupError if its clock is a delta against a base this node does not have, the sender then resends it in full,
+## or if it is packed in a layout resolve_layout() did not find
+def read_replica_metadata(metadata):
+    sender = metadata["senders-address"]
+    message_clock = metadata["message-clock"]
+    if isinstance(message_clock, str): # packed, as the frame transport sends it
+        clock = unpack_clock(message_clock)
+        if clock[0] not in vc.layouts:
+            raise LookupError(f"Clock: layout {clock[0]} from {sender} not known. // read_replica_metadata()")
+    elif "delta" in message_clock:
+        base = received_clocks.get(sender, {}).get((message_clock["digest"], message_clock["base"]))
+        if base is None:
+            raise LookupError(f"Clock: base {message_clock['base']} from {sender} not known. // read_replica_metadata()")
+        counts = list(base)
+        delta = message_clock["delta"]
+        for position, count in zip(delta[::2], delta[1::2]):
+            counts[position] = count
+        clock = (message_clock["digest"], counts)
+    else:
+        clock = (vc.digest, vc.counts_of(message_clock))
+    return {"senders-address": sender, "coalesced": metadata.get("coalesced", False), "clock": clock}
+
+## Asks the peers for the layout of a replica message's packed clock if this node does not know it. Called before
+## write_lock is taken for the delivery, read_replica_metadata() never asks the peers itself
+def resolve_layout(metadata):
+    message_clock = metadata.get("message-clock") if isinstance(metadata, dict) else None
+    if isinstance(message_clock, str):
+        try:
+            digest = unpack_clock(message_clock)[0]
+        except ValueError:
+            return
+        if digest not in vc.layouts:
+            fetch_layout(digest)
+
+## Keeps a delivered message's clock as a base for the sender's next delta. Must be called with write_lock held
+def remember_clock(message):
+    digest, counts = message["clock"]
+    bases = received_clocks.setdefault(message["senders-address"], {})
+    bases.pop((digest, sum(counts)), None)
+    bases[(digest, sum(counts))] = counts
+    while len(bases) > RECEIVED_BASES:
+        del bases[next(iter(bases))]
+
+### PERSISTENCE ###
+# With STORAGE_ENGINE=log the clock and the shard map are logged next to the data (kvsstorage.LogStorage),
+# so a restarted node picks up where it stopped instead of pulling everything from a peer again.
+# Must be called with write_lock held, after the change it records was applied to storage
+def persist_state():
+    storage.save_state(vc, shards)
+
+## For membership and shard map changes, which happen outside write_lock
+def persist_membership():
+    with write_lock:
+        persist_state()
+
+### VERSIONS ###
+# Every write stamps its key with a version, [lamport time, writer's address]: the writer takes the next tick of
+# its Lamport clock and every node moves its own past the versions it takes from others. A write that causally
+# follows another write of the same key always has the higher version, so when anti-entropy finds two replicas
+# holding different values, the one with the higher version wins (see sync_with())
+lamport = 0
+
+## Must be called with write_lock held, so versions go out in the order of the writes
+def next_version():
+    global lamport
+    with version_lock:
+        lamport += 1
+        return [lamport, socket_address]
+
+def observe_version(version):
+    global lamport
+    with version_lock:
+        lamport = max(lamport, version[0])
+
+## True if version a is newer than version b, no version is older than any version
+def newer(a, b):
+    return (a or [0, '']) > (b or [0, ''])
+
+## Stamps key with the version a replica message or copy carried, if it carried one. Must be called with the
+## key's stripe held
+def record_version(key, version):
+    if version is not None:
+        storage.set_version(key, version)
+        observe_version(version)
+
+### VALUE COMPRESSION ###
+# A value whose JSON has COMPRESS_THRESHOLD (kvsstorage) bytes or more is zlib-compressed once, by the node a
+# client writes it to, and stays a kvsstorage.Compressed through storage, replica messages, anti-entropy and
+# resharding until a client reads it. /metrics counts the bytes before and after and the time spent both ways
+
+## The value to store for a client write
+def compress_value(value):
+    start = time.thread_time() # CPU time, wall time would count the other threads' turns
+    stored, size = kvsstorage.compress(value)
+    if 0 < kvsstorage.COMPRESS_THRESHOLD <= size:
+        count_event("kvs_compress_seconds_total", time.thread_time() - start)
+        count_event("kvs_compressed_bytes_total", size, form="json")
+        count_event("kvs_compressed_bytes_total", len(stored) if isinstance(stored, kvsstorage.Compressed) else size, form="stored")
+    return stored
+
+## The value to send a client for a stored one
+def decompress_value(stored):
+    if not isinstance(stored, kvsstorage.Compressed):
+        return stored
+    start = time.thread_time()
+    value = stored.value()
+    count_event("kvs_decompress_seconds_total", time.thread_time() - start)
+    return value
+
+### HOLDBACK QUEUE ###
+# Replica messages that arrive before their causal dependencies are held here, keyed by (sender, sender's count),
+# instead of being refused with a 503. Every delivery retries the held messages, so a held message goes through
+# the moment the message it depends on arrives, and its request thread is woken through clock_changed.
+# While a node joins a shard (initialize_kvs()) it is `buffering`: replica messages are taken but not applied
+# until the copy of the shard is in, then release() delivers the ones the copy did not already cover.
+# A message from a sender that is not in the view (it was removed by a view change or reshard while its message
+# was on the way) has no counter here to be ordered by, so it is refused with SenderNotInView
+class SenderNotInView(Exception):
+    pass
+
+class HoldbackQueue:
+    def __init__(self):
+        self.held = {}
+        self.buffering = False
+        self.buffered = []
+
+    # Must be called with write_lock held. Runs apply() right after handle_replica_metadata() counts the message
+    # and returns what it returned, or None if the message was already delivered (the sender resent it).
+    # Raises TimeoutError if the dependencies do not arrive within `timeout` seconds (HOLDBACK_TIMEOUT by default),
+    # LookupError if the message's clock is a delta against a clock this node does not have (read_replica_metadata()), and
+    # SenderNotInView if the sender is not in the view, or left it while the message was held
+    def deliver(self, metadata, apply, timeout=None):
+        if metadata == None:
+            raise TimeoutError("Message has no causal-metadata. // deliver()")
+        message = read_replica_metadata(metadata)
+        if message["senders-address"] not in vc.index:
+            raise SenderNotInView(f"Sender: {message['senders-address']} is not in the view. // deliver()")
+        if self.buffering:
+            self.buffered.append((message, apply))
+            remember_clock(message)
+            return "buffered"
+        sender = message["senders-address"]
+        count = vc.align(message["clock"])[vc.index[sender]]
+        if handle_replica_metadata(message):
+            result = apply()
+            persist_state()
+            remember_clock(message)
+            clock_changed.notify_all()
+            self.drain()
+            return result
+        if count <= vc.get(sender) and not message["coalesced"]:
+            remember_clock(message)
+            return None
+        entry = {"message": message, "apply": apply, "delivered": False, "result": None}
+        self.held[(sender, count)] = entry
+        start = time.perf_counter()
+        delivered = clock_changed.wait_for(lambda: entry["delivered"] or entry.get("gone"), HOLDBACK_TIMEOUT if timeout is None else timeout)
+        observe("kvs_holdback_wait_seconds", time.perf_counter() - start)
+        if entry.get("gone"):
+            raise SenderNotInView(f"Sender: {sender} left the view while message {count} was held. // deliver()")
+        if not delivered:
+            count_event("kvs_holdback_timeouts_total")
+            if self.held.get((sender, count)) is entry:
+                del self.held[(sender, count)]
+            raise TimeoutError(f"Message {count} from {sender} is still missing dependencies. // deliver()")
+        return entry["result"]
+
+    # deliver every held message whose dependencies are now met, oldest first, until none is left that can go
+    def drain(self):
+        progress = True
+        while progress and self.held:
+            progress = False
+            for held_key in sorted(self.held, key=lambda held_key: held_key[1]):
+                entry = self.held[held_key]
+                if held_key[0] not in vc.index:
+                    del self.held[held_key]
+                    entry["gone"] = True
+                    continue
+                if handle_replica_metadata(entry["message"]):
+                    del self.held[held_key]
+                    entry["result"] = entry["apply"]()
+                    entry["delivered"] = True
+                    persist_state()
+                    remember_clock(entry["message"])
+                    progress = True
+        clock_changed.notify_all()
+
+    # Must be called with write_lock held, once the clock covers the copied shard. Buffered messages the
+    # clock already covers are dropped, the rest are held and delivered in causal order
+    def release(self):
+        self.buffering = False
+        for message, apply in self.buffered:
+            sender = message["senders-address"]
+            if sender not in vc.index: # left the view while this node was joining
+                continue
+            count = vc.align(message["clock"])[vc.index[sender]]
+            if count <= vc.get(sender) and not message["coalesced"]:
+                continue
+            self.held.setdefault((sender, count), {"message": message, "apply": apply, "delivered": False, "result": None})
+        self.buffered = []
+        self.drain()
+
+holdback = HoldbackQueue()
+
+### PEER CONNECTIONS ###
+# Every call to another node goes through peer_request(), which keeps one requests.Session per peer with a pool
+# of up to POOL_SIZE keep-alive connections, instead of opening (and leaving in TIME_WAIT) a connection per call
+connection_stats = {"requests": 0, "new-connections": 0, "bytes-sent": 0, "bytes-received": 0} # bytes of request and response bodies
+connection_stats_lock = threading.Lock()
+
+def count_connection(stat, amount=1):
+    with connection_stats_lock:
+        connection_stats[stat] += amount
+
+class CountingConnectionPool(urllib3.HTTPConnectionPool):
+    def _new_conn(self):
+        count_connection("new-connections")
+        return super()._new_conn()
+
+class PeerAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, http=CountingConnectionPool)
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+def peer_session(peer):
+    with sessions_lock:
+        if peer not in sessions:
+            session = requests.Session()
+            session.mount('http://', PeerAdapter(pool_connections=1, pool_maxsize=POOL_SIZE))
+            sessions[peer] = session
+        return sessions[peer]
+
+## Same arguments as requests.request(). A call without its own timeout gives up after PEER_CONNECT_TIMEOUT
+## seconds connecting or PEER_TIMEOUT seconds waiting, and raises a RequestException like any other failure
+def peer_request(method, url, **kwargs):
+    kwargs.setdefault('timeout', (PEER_CONNECT_TIMEOUT, PEER_TIMEOUT))
+    count_connection("requests")
+    response = peer_session(urlsplit(url).netloc).request(method, url, **kwargs)
+    count_connection("bytes-sent", len(response.request.body or b''))
+    count_connection("bytes-received", len(response.content))
+    return response
+
+## (connect, read) timeout of replica messages: the peer may hold one up to HOLDBACK_TIMEOUT before it answers 503,
+## and a read timing out before that would count a live peer waiting on a dependency as dead
+def replica_timeout():
+    return PEER_CONNECT_TIMEOUT, PEER_TIMEOUT + HOLDBACK_TIMEOUT
+
+### METRICS ###
+# Counters and latency histograms for /metrics, which serves them in the Prometheus text format together with
+# gauges read at scrape time. Recording is a bisect and two additions under metrics_lock, so it stays on
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # seconds
+METRICS = { # name: (type, help)
+    "kvs_requests_total": ("counter", "Requests served, by route, method and status"),
+    "kvs_request_seconds": ("histogram", "Time to serve a request, by route and method"),
+    "kvs_replication_seconds": ("histogram", "Time from sending a replica message to its delivery on the peer, retries included"),
+    "kvs_replication_retries_total": ("counter", "Replica messages a peer answered 503 (dependencies missing) and that were sent again"),
+    "kvs_holdback_wait_seconds": ("histogram", "Time replica messages were held for their causal dependencies"),
+    "kvs_holdback_timeouts_total": ("counter", "Held replica messages whose dependencies did not arrive in HOLDBACK_TIMEOUT"),
+    "kvs_causal_wait_seconds": ("histogram", "Time client requests waited for the writes in their causal-metadata"),
+    "kvs_causal_refusals_total": ("counter", "Client requests refused with 503 because their dependencies did not arrive"),
+    "kvs_forwarded_total": ("counter", "Requests forwarded to another shard's member, by peer and result"),
+    "kvs_forward_seconds": ("histogram", "Round trip of forwarded requests, by peer"),
+    "kvs_storage_keys": ("gauge", "Keys held, by shard"),
+    "kvs_storage_bytes": ("gauge", "Bytes of the items held, by shard"),
+    "kvs_storage_spilled_keys": ("gauge", "Keys whose values are in the spill file instead of memory (MEMORY_BUDGET), by shard"),
+    "kvs_storage_spilled_bytes": ("gauge", "Bytes of the items in the spill file, by shard"),
+    "kvs_outbox_pending": ("gauge", "Replica messages queued for a peer"),
+    "kvs_holdback_held": ("gauge", "Replica messages held for their dependencies right now"),
+    "kvs_compressed_bytes_total": ("counter", "JSON bytes of the values that went through zlib (form json) and the bytes stored for them (form stored)"),
+    "kvs_compress_seconds_total": ("counter", "CPU time spent compressing values on client writes"),
+    "kvs_decompress_seconds_total": ("counter", "CPU time spent decompressing values for client reads"),
+    "kvs_remote_cache_total": ("counter", "Forwarded GETs looked up in the remote read cache, by result (hit, miss, or behind the client's clock)"),
+    "kvs_remote_cache_entries": ("gauge", "Answers for other shards' keys in the remote read cache"),
+}
+metrics_lock = threading.Lock()
+histograms = {} # (name, labels): [count per bucket, the last one past every bound, sum]
+counters = collections.Counter() # (name, labels): count
+request_seconds = collections.deque() # [second, requests served in it] for the last RATE_WINDOW seconds
+
+def observe(name, seconds, **labels):
+    index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    key = (name, tuple(labels.items()))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][index] += 1
+        histogram[1] += seconds
+
+def count_event(name, amount=1, **labels):
+    with metrics_lock:
+        counters[(name, tuple(labels.items()))] += amount
+
+## Counts a served request in kvs_requests_total and in the requests of the current second, for request_rate()
+def count_request(route, method, status):
+    second = int(time.monotonic())
+    with metrics_lock:
+        counters[("kvs_requests_total", (("route", route), ("method", method), ("status", status)))] += 1
+        if request_seconds and request_seconds[-1][0] == second:
+            request_seconds[-1][1] += 1
+        else:
+            request_seconds.append([second, 1])
+            while request_seconds[0][0] < second - RATE_WINDOW:
+                request_seconds.popleft()
+
+## Requests per second served over the last RATE_WINDOW whole seconds
+def request_rate():
+    now = int(time.monotonic())
+    with metrics_lock:
+        served = sum(count for second, count in request_seconds if now - RATE_WINDOW <= second < now)
+    return round(served / RATE_WINDOW, 1)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+## The text for /metrics: what was recorded so far and `gauges`, a list of (name, labels, value)
+def render_metrics(gauges):
+    with metrics_lock:
+        samples = [(name, labels, value) for (name, labels), value in counters.items()]
+        for (name, labels), (buckets, total) in histograms.items():
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                cumulative += bucket_count
+                samples.append((name + '_bucket', labels + (('le', bound),), cumulative))
+            samples.append((name + '_sum', labels, total))
+            samples.append((name + '_count', labels, cumulative))
+    samples.extend(gauges)
+    lines = []
+    for name in METRICS:
+        family = [sample for sample in samples if sample[0] == name or sample[0].rsplit('_', 1)[0] == name and METRICS[name][0] == 'histogram']
+        if not family:
+            continue
+        lines.append(f'# HELP {name} {METRICS[name][1]}')
+        lines.append(f'# TYPE {name} {METRICS[name][0]}')
+        lines.extend(f'{sample_name}{format_labels(labels)} {value}' for sample_name, labels, value in family)
+    return '\n'.join(lines) + '\n'
+
+### FORWARDING ###
+# Requests for a shard this node does not serve go to one of its members. Members are taken in turn
+# ('round-robin'), and with 'least-outstanding' the ones with the fewest requests this node has in flight to
+# them come first. A member whose average latency is over four times the fastest one's goes after the others,
+# and one that could not be reached or timed out goes last for PEER_BACKOFF seconds, doubling while it keeps
+# failing. A call that fails moves on to the next member, so one node down does not fail its shard's requests
+class PeerHealth:
+    def __init__(self):
+        self.outstanding = 0 # forwarded requests in flight
+        self.latency = None # moving average of the seconds a forwarded request took
+        self.failures = 0 # failed calls in a row
+        self.down_until = 0
+        self.forwarded = 0
+
+    def stats(self):
+        return {"outstanding": self.outstanding, "latency-ms": None if self.latency is None else round(self.latency * 1000, 2),
+                "failures": self.failures, "backing-off": self.down_until > time.time(), "forwarded": self.forwarded}
+
+peer_health = collections.defaultdict(PeerHealth)
+peer_health_lock = threading.Lock()
+forward_turns = collections.Counter() # shard id: requests forwarded to it
+
+## The members of shard_id to try, in order
+def forward_order(shard_id):
+    members = [member for member in shards[shard_id] if member != socket_address] or list(shards[shard_id])
+    now = time.time()
+    with peer_health_lock:
+        turn = forward_turns[shard_id] % max(len(members), 1)
+        forward_turns[shard_id] += 1
+        members = members[turn:] + members[:turn]
+        fastest = min((peer_health[member].latency for member in members if peer_health[member].latency is not None), default=None)
+        def rank(member):
+            health = peer_health[member]
+            slow = fastest is not None and health.latency is not None and health.latency > 4 * fastest
+            busy = health.outstanding if FORWARD_POLICY == 'least-outstanding' else 0
+            return (health.down_until > now, slow, busy)
+        return sorted(members, key=rank)
+
+## peer_request() to `path` on a member of shard_id, moving on to the next member when one cannot be reached or
+## times out. Raises the last member's RequestException if none answered
+def forward_to_shard(shard_id, method, path, **kwargs):
+    error = requests.exceptions.ConnectionError(f"Shard {shard_id} has no members. // forward_to_shard()")
+    for member in forward_order(shard_id):
+        start = forward_started(member)
+        try:
+            response = peer_request(method, f'http://{member}{path}', **kwargs)
+        except requests.exceptions.RequestException as e:
+            forward_failed(member, e)
+            error = e
+            continue
+        forward_succeeded(member, start)
+        return response
+    raise error
+
+## forward_started() before a forwarded call to member, then forward_failed() or forward_succeeded() with what it returned
+def forward_started(member):
+    with peer_health_lock:
+        peer_health[member].outstanding += 1
+    return time.perf_counter()
+
+def forward_failed(member, error):
+    count_event("kvs_forwarded_total", peer=member, result="failed")
+    with peer_health_lock:
+        health = peer_health[member]
+        health.outstanding -= 1
+        health.failures += 1
+        health.down_until = time.time() + PEER_BACKOFF * 2 ** min(health.failures - 1, 6)
+    app.logger.debug(f'forward_to_shard: {member} failed, trying the next member: {error}')
+
+def forward_succeeded(member, start):
+    elapsed = time.perf_counter() - start
+    count_event("kvs_forwarded_total", peer=member, result="ok")
+    observe("kvs_forward_seconds", elapsed, peer=member)
+    with peer_health_lock:
+        health = peer_health[member]
+        health.outstanding -= 1
+        health.failures = 0
+        health.down_until = 0
+        health.forwarded += 1
+        health.latency = elapsed if health.latency is None else 0.8 * health.latency + 0.2 * elapsed
+
+### REMOTE READ CACHE ###
+# With REMOTE_CACHE_SIZE > 0 a node keeps the answers of the GETs it forwarded to other shards, dropping the least
+# recently used past that many. An answer is kept with the clock the owner sent along, which covers every write
+# the owner had when it read the value. Only writes of the owner's shard can change the key, and every write the
+# client depends on that did is counted there, so a GET whose causal-metadata is not ahead of that clock on the
+# counters of the owner's shard (is_causal()) gets the kept answer; any other GET is forwarded and its answer
+# kept instead. The clocks a shard sends the others (broadcast_to_replicas(), flush_metadata()) name the keys
+# written since the last one, and metadata_update() drops those here. A clock that names none (more than
+# METADATA_KEYS, or a sender that does not cache) drops every kept key of the sender's shard.
+# A kept answer also covers the writes of every later clock that did not drop it: a member whose clocks all came
+# after the GET was sent moves its counter in the answer's clock up to its latest one. So a key written rarely
+# keeps being served while the rest of its shard is written
+class RemoteCache:
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key: (response body, (digest, counts) of the owner's clock, `seen` when it was sent)
+        self.drops = collections.OrderedDict() # key: the drop that last dropped it, for the last `size` keys dropped
+        self.dropped = 0 # drops so far
+        self.floor = 0 # answers to GETs sent before this drop are not kept at all
+        self.seen = {} # sender: its own counter in the last clock it sent, None if that clock could not be read
+
+    # taken before a GET is forwarded and handed to keep() with its answer, so an answer that was on its way
+    # while its key was dropped is not kept
+    def ticket(self):
+        with self.lock:
+            return self.dropped, dict(self.seen)
+
+    # the kept answer for a GET of key with `metadata`, None if it has to be forwarded
+    def lookup(self, key, metadata):
+        if not self.size:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            seen = dict(self.seen)
+        if entry is None:
+            count_event("kvs_remote_cache_total", result="miss")
+            return None
+        body, tag, since = entry
+        if metadata is not None:
+            try:
+                message_clock = metadata["message-clock"]
+                if isinstance(message_clock, str) and unpack_clock(message_clock)[0] not in vc.layouts:
+                    raise KeyError(message_clock) # the owner asks its peers for the layout
+                message_clock = read_client_clock(message_clock)
+                with write_lock:
+                    members = [member for member in shards[hash_of_key(key)] if member in vc.index]
+                    client, owner = vc.align(message_clock), vc.align(tag)
+                    covered = vc.is_causal([client[vc.index[member]] for member in members],
+                            counts=[self.covers(owner[vc.index[member]], since.get(member, 0), seen.get(member, 0)) for member in members])
+            except (KeyError, ValueError, TypeError):
+                covered = False
+            if not covered:
+                count_event("kvs_remote_cache_total", result="behind")
+                return None
+        count_event("kvs_remote_cache_total", result="hit")
+        return body
+
+    # A member's counter in a kept answer's clock, `count`, moved up to its latest clock `now` if every clock it
+    # sent after `then` (its clock when the GET was sent) came after the GET and so would have dropped the answer
+    @staticmethod
+    def covers(count, then, now):
+        if then is None or now is None or then > count:
+            return count
+        return max(count, now)
+
+    def keep(self, key, ticket, body):
+        if not self.size:
+            return
+        try:
+            tag = unpack_clock(body["causal-metadata"]["message-clock"])
+        except (KeyError, TypeError, ValueError):
+            return
+        if tag[0] not in vc.layouts:
+            return
+        dropped, since = ticket
+        with self.lock:
+            if dropped < self.floor or self.drops.get(key, 0) > dropped:
+                return
+            self.entries[key] = (body, tag, since)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    # for a clock another shard's member sent with the keys it wrote since its last one: drops `keys`, or every
+    # key of the sender's shard if None, and takes the sender's counter
+    def invalidate(self, keys, metadata):
+        if not self.size:
+            return
+        sender = metadata.get('senders-address')
+        count = sender_count(metadata)
+        owner = next((shard_id for shard_id, members in shards.items() if sender in members), None)
+        with self.lock:
+            self.dropped += 1
+            if keys is not None:
+                for key in keys:
+                    self.entries.pop(key, None)
+                    self.drops[key] = self.dropped
+                    self.drops.move_to_end(key)
+                while len(self.drops) > self.size:
+                    _, self.floor = self.drops.popitem(last=False)
+            else:
+                self.floor = self.dropped
+                for key in [key for key in self.entries if owner is None or hash_of_key(key) == owner]:
+                    del self.entries[key]
+            self.seen[sender] = None if count is None else max(count, self.seen.get(sender) or 0)
+
+    def clear(self):
+        with self.lock:
+            self.dropped += 1
+            self.floor = self.dropped
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+## The sender's own counter in the clock of a replica message's causal-metadata (see REPLICA MESSAGE CLOCKS),
+## 0 for a delta that did not change it, None if the clock's layout is not known here
+def sender_count(metadata):
+    sender, message_clock = metadata.get("senders-address"), metadata.get("message-clock")
+    if isinstance(message_clock, str):
+        try:
+            digest, counts = unpack_clock(message_clock)
+        except ValueError:
+            return None
+    elif isinstance(message_clock, dict) and "delta" in message_clock:
+        digest, delta = message_clock["digest"], message_clock["delta"]
+        counts = collections.defaultdict(int, zip(delta[::2], delta[1::2]))
+    elif isinstance(message_clock, dict):
+        return message_clock.get(sender, 0)
+    else:
+        return None
+    members = vc.layouts.get(digest, [])
+    return counts[members.index(sender)] if sender in members else None
+
+remote_cache = RemoteCache(REMOTE_CACHE_SIZE)
+written_keys = set() # keys this node wrote since the last flush_metadata(), up to past METADATA_KEYS
+
+## The "keys" of a clock sent to other shards for writes of `keys`, None if there are too many to name
+def named_keys(keys):
+    return sorted(keys) if len(keys) <= METADATA_KEYS else None
+
+### REPLICA FRAMES ###
+# REPLICA_TRANSPORT=frames sends replica messages (/replica_kvs/<key>, /replica_batch and /update_metadata) over one
+# persistent TCP connection per peer, on the peer's port plus REPLICA_PORT_OFFSET, instead of as HTTP requests.
+# A frame is a 4 byte big-endian length and a msgpack array: [id, method, path, body] for a request and
+# [id, status, body] for its response. A sender keeps up to REPLICA_WINDOW requests on the wire. The receiver
+# runs them in the order they came, which is the order the sender's clock made them, and answers everything it
+# ran after one storage.wait_durable() once no whole frame is left to read. Clients, and every other call
+# between nodes, stay on HTTP and JSON
+FRAME_HEADER = struct.Struct('>I')
+FRAME_ROUTES = { # path prefix: (route, handler(method, rest of the path, body) returning body and status)
+    '/replica_kvs/': ('/replica_kvs/<key>', lambda method, key, body: replica_write(method, key, body)),
+    '/replica_batch': ('/replica_batch', lambda method, _, body: replica_batch_write(body)),
+    '/update_metadata': ('/update_metadata', lambda method, _, body: metadata_update(body)),
+}
+FrameResponse = collections.namedtuple('FrameResponse', ['status_code', 'body'])
+
+def frame_address(peer):
+    host, port = peer.rsplit(':', 1)
+    return host, int(port) + REPLICA_PORT_OFFSET
+
+def encode_frame(message):
+    payload = msgpack.packb(message, use_bin_type=True)
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+# Splits the bytes read from a socket into frames. A socket timeout in read() keeps what was read so far
+class FrameReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    # the length of the whole frame at the start of the buffer, None if it is not all there yet
+    def ready(self):
+        if len(self.buffer) < FRAME_HEADER.size:
+            return None
+        end = FRAME_HEADER.size + FRAME_HEADER.unpack_from(self.buffer)[0]
+        return end if len(self.buffer) >= end else None
+
+    # returns the next frame and its size in bytes, (None, 0) once the other side closed the connection
+    def read(self):
+        end = self.ready()
+        while end is None:
+            chunk = self.sock.recv(256 * 1024)
+            if not chunk:
+                return None, 0
+            self.buffer += chunk
+            end = self.ready()
+        message = msgpack.unpackb(self.buffer[FRAME_HEADER.size:end], raw=False)
+        del self.buffer[:end]
+        return message, end
+
+# The sending side of one peer's frame connection. call() puts a request on the wire and returns a Future of its
+# FrameResponse right away; a reader thread resolves the futures as the answers come. If the connection fails, or
+# a request stays unanswered for replica_timeout() seconds, every pending future fails with an OSError
+class FrameConnection:
+    def __init__(self, peer):
+        self.peer = peer
+        self.sock = socket.create_connection(frame_address(peer), timeout=PEER_CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.settimeout(replica_timeout()[1])
+        count_connection("new-connections")
+        self.reader = FrameReader(self.sock)
+        self.ids = itertools.count()
+        self.pending = {} # request id: Future
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.error = None
+        threading.Thread(target=self.receive, name=f'frames-{peer}', daemon=True).start()
+
+    def call(self, method, path, body):
+        future = Future()
+        with self.lock:
+            if self.error:
+                raise self.error
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+            frame = encode_frame([request_id, method, path, body])
+        try:
+            with self.send_lock: # not self.lock, receive() has to keep reading while a send blocks
+                self.sock.sendall(frame)
+        except OSError as e:
+            self.fail(e)
+            raise
+        count_connection("requests")
+        count_connection("bytes-sent", len(frame))
+        return future
+
+    def receive(self):
+        try:
+            while True:
+                try:
+                    frame, size = self.reader.read()
+                except socket.timeout:
+                    if self.pending:
+                        raise
+                    continue
+                if frame is None:
+                    raise ConnectionError(f"{self.peer} closed the frame connection. // FrameConnection.receive()")
+                count_connection("bytes-received", size)
+                request_id, status, body = frame
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future:
+                    future.set_result(FrameResponse(status, body))
+        except (OSError, ValueError) as e: # ValueError: a frame msgpack cannot read
+            self.fail(e)
+
+    def fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error if isinstance(error, OSError) else ConnectionError(str(error))
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(self.error)
+        self.sock.close()
+
+    def close(self):
+        self.fail(ConnectionError(f"Frame connection to {self.peer} closed. // FrameConnection.close()"))
+
+## Runs one replica request that came in a frame, returns its response body and status
+def serve_frame(method, path, body):
+    for prefix, (route, handler) in FRAME_ROUTES.items():
+        if path.startswith(prefix):
+            start = time.perf_counter()
+            body, status = handler(method, path[len(prefix):], body)
+            observe("kvs_request_seconds", time.perf_counter() - start, route=route, method=method)
+            count_request(route, method, status)
+            return body, status
+    return {"error": f"{path} is not a replica route"}, 404
+
+def serve_frame_connection(connection):
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    peer = connection.getpeername()
+    reader = FrameReader(connection)
+    answers = []
+    try:
+        while True:
+            if answers and reader.ready() is None: # nothing more to run before the peer hears back
+                storage.wait_durable()
+                connection.sendall(b''.join(answers))
+                answers = []
+            frame, _ = reader.read()
+            if frame is None:
+                return
+            request_id, method, path, body = frame
+            body, status = serve_frame(method, path, body)
+            answers.append(encode_frame([request_id, status, body]))
+    except (OSError, ValueError) as e:
+        app.logger.debug(f'frame connection from {peer} error: {e}')
+    finally:
+        connection.close()
+
+## Listens for frame connections on port (SOCKET_ADDRESS's plus REPLICA_PORT_OFFSET), a thread per connection
+def serve_frames(host, port):
+    if msgpack is None:
+        raise RuntimeError("REPLICA_TRANSPORT=frames needs msgpack (pip install msgpack). // serve_frames()")
+    listener = socket.create_server((host, port), backlog=128)
+    def accept():
+        while True:
+            connection, address = listener.accept()
+            threading.Thread(target=serve_frame_connection, args=(connection,), name=f'frames-from-{address[0]}:{address[1]}', daemon=True).start()
+    threading.Thread(target=accept, name='frames-accept', daemon=True).start()
+
+### OUTBOX ###
+# Counts the peers that took one message, for client writes waiting on all, a quorum or none of them
+class Acks:
+    def __init__(self, peers):
+        self.pending = set(peers)
+        self.delivered = 0
+        self.changed = AsyncCondition()
+
+    def record(self, peer, delivered):
+        with self.changed:
+            if peer in self.pending:
+                self.pending.discard(peer)
+                if delivered:
+                    self.delivered += 1
+                self.changed.notify_all()
+
+    # block until `needed` peers took the message (every peer if None) or none is pending anymore
+    def wait(self, needed=None):
+        with self.changed:
+            self.changed.wait_for(lambda: self.done(needed))
+            return self.delivered
+
+    async def wait_async(self, needed=None):
+        await self.changed.wait_for_async(lambda: self.done(needed))
+        return self.delivered
+
+    def done(self, needed):
+        return not self.pending or (needed is not None and self.delivered >= needed)
+
+# One queue and one sender thread per peer. Messages leave in the order they were queued, which is the order
+# this node's clock produced them, so the peer sees them in causal order whoever is waiting on them.
+# A message stays queued until the peer takes it; if the peer cannot be reached it is dropped from the view.
+# The log storage engine keeps the queue too (storage.queue_message()), so the messages of writes that were
+# answered before their peers had them ('local', 'quorum') are sent again after a crash
+class Outbox:
+    def __init__(self, peer):
+        self.peer = peer
+        self.messages = collections.deque()
+        self.changed = threading.Condition()
+        self.closed = False
+        self.acked = None # (digest, counts) of the last clock the peer took
+        threading.Thread(target=self.run, name=f'outbox-{peer}', daemon=True).start()
+
+    # `clock` is the (digest, counts) snapshot in data's causal-metadata, if it has one. `message_id` is given
+    # for a message storage kept from before a restart
+    def put(self, method, url, data, acks, clock=None, message_id=None):
+        with self.changed:
+            if not self.closed:
+                if message_id is None:
+                    message_id = storage.queue_message(self.peer, [method, url, data, clock])
+                self.messages.append((method, url, data, acks, clock, message_id))
+                self.changed.notify()
+                return
+        acks.record(self.peer, False)
+
+    def close(self):
+        with self.changed:
+            self.closed = True
+            dropped = list(self.messages)
+            self.messages.clear()
+            self.changed.notify()
+        storage.drop_messages(self.peer)
+        for message in dropped:
+            message[3].record(self.peer, False)
+
+    # The peer keeps the last clock it took from this node, so once it has one only the counters that moved
+    # since then are sent. Returns data itself when the full clock has to go (first message, view changed)
+    def compact(self, data, clock):
+        if clock is None or self.acked is None or self.acked[0] != clock[0]:
+            return data
+        digest, counts = clock
+        base = self.acked[1]
+        delta = [value for position, (old, new) in enumerate(zip(base, counts)) if old != new for value in (position, new)]
+        metadata = dict(data["causal-metadata"])
+        metadata["message-clock"] = {"digest": digest, "base": sum(base), "delta": delta}
+        return dict(data, **{"causal-metadata": metadata})
+
+    # The frame transport sends the clock packed, so a message never depends on the peer holding a base
+    def packed(self, data, clock):
+        if clock is None:
+            return data
+        metadata = dict(data["causal-metadata"], **{"message-clock": pack_clock(*clock)})
+        return dict(data, **{"causal-metadata": metadata})
+
+    def wake(self, future):
+        with self.changed:
+            self.changed.notify()
+
+    def run(self):
+        if REPLICA_TRANSPORT == 'frames':
+            return self.run_pipelined()
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.messages or self.closed)
+                if self.closed:
+                    return
+                method, url, data, acks, clock, message_id = self.messages[0]
+            storage.wait_durable() # a peer never sees a write this node could lose in a crash
+            start = time.perf_counter()
+            try:
+                body = self.compact(data, clock)
+                response = send_until_delivered(method, url, body)
+                if response.status_code == 409 and body is not data: # peer lost the base clock
+                    response = send_until_delivered(method, url, data)
+            except requests.exceptions.RequestException as e:
+                app.logger.debug(f'outbox {self.peer} error: exception raised: {e}')
+                close_outbox(self.peer)
+                broadcast_delete_view(self.peer)
+                return
+            observe("kvs_replication_seconds", time.perf_counter() - start, peer=self.peer)
+            if clock is not None and response.status_code in (200, 201, 404): # 404: delivered, the key was already gone
+                self.acked = clock
+            with self.changed:
+                if self.messages and self.messages[0][3] is acks:
+                    self.messages.popleft()
+            storage.message_delivered(self.peer, message_id)
+            acks.record(self.peer, response.status_code != 410) # 410: the peer dropped this node from its view
+
+    # REPLICA_TRANSPORT=frames: up to REPLICA_WINDOW queued messages are on the connection at once. Answers are
+    # taken oldest first, so acks come in queue order as with HTTP. A 503 sends that message and every one after
+    # it again, the peer answers "already delivered" for those it had taken
+    def run_pipelined(self):
+        sent = collections.deque() # (message, start, future) for the first len(sent) messages
+        backoff = 0.01
+        try:
+            connection = FrameConnection(self.peer)
+            while True:
+                with self.changed:
+                    self.changed.wait_for(lambda: self.closed or (sent and sent[0][2].done()) or len(sent) < min(len(self.messages), REPLICA_WINDOW))
+                    if self.closed:
+                        connection.close()
+                        return
+                    unsent = list(itertools.islice(self.messages, len(sent), REPLICA_WINDOW))
+                if unsent and not (sent and sent[0][2].done()):
+                    storage.wait_durable() # a peer never sees a write this node could lose in a crash
+                    for message in unsent:
+                        method, url, data, _, clock, _ = message
+                        future = connection.call(method, urlsplit(url).path, self.packed(data, clock))
+                        sent.append((message, time.perf_counter(), future))
+                        future.add_done_callback(self.wake)
+                    continue
+                message, start, future = sent.popleft()
+                if future.result().status_code == 503:
+                    count_event("kvs_replication_retries_total", peer=self.peer)
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 1)
+                    sent.clear()
+                    continue
+                backoff = 0.01
+                observe("kvs_replication_seconds", time.perf_counter() - start, peer=self.peer)
+                with self.changed:
+                    if self.messages and self.messages[0] is message:
+                        self.messages.popleft()
+                storage.message_delivered(self.peer, message[5])
+                message[3].record(self.peer, future.result().status_code != 410)
+        except OSError as e:
+            app.logger.debug(f'outbox {self.peer} error: exception raised: {e}')
+            close_outbox(self.peer)
+            broadcast_delete_view(self.peer)
+
+outboxes = {}
+outboxes_lock = threading.Lock()
+
+def outbox_for(peer):
+    with outboxes_lock:
+        if peer not in outboxes:
+            outboxes[peer] = Outbox(peer)
+        return outboxes[peer]
+
+def close_outbox(peer):
+    with outboxes_lock:
+        outbox = outboxes.pop(peer, None)
+    if outbox:
+        outbox.close()
+
+## Calls send(peer) for every peer at the same time on the fan-out pool and waits for all of them.
+## Returns {peer: whatever send returned, or the exception it raised}, so a broadcast takes as long as the
+## slowest peer instead of the sum of all of them. send must not fan out on the same pool or it can starve it
+def fan_out(peers, send, pool=None):
+    pool = pool or fanout_pool
+    futures = {peer: pool.submit(send, peer) for peer in peers}
+    results = {}
+    for peer, future in futures.items():
+        try:
+            results[peer] = future.result()
+        except Exception as e:
+            results[peer] = e
+    return results
 
-        for replica_address in self.clock:
-            if replica_address != sender_address: # exclude the sender address
-                if replica_address in message_clock:
-                    if message_clock[replica_address] > self.clock[replica_address]:
-                        return False
-                # else: # CLIENT COULD HAVE A MISSING VC BUT THE REPLICAS WILL NOT
-                #     raise KeyError(f"Key: {replica_address} from local clock not in message vc. // update_from_message()")     
-        return True
-        
 def forwarding_request(method, key, fwdaddress):
         url = f"http://{fwdaddress}/kvs/{key}"  #format url that we will forward to
         try:
             #forward request to url, store response
-            response = requests.request(method, url, headers=request.headers, data=request.get_data())
+            response = peer_request(method, url, headers=request.headers, data=request.get_data())
             return response.json(), response.status_code        #return response
         except: #case of failure
             return jsonify({"error": "Cannot forward request"}), 503
@@ -67,21 +1264,21 @@ def forwarding_request(method, key, fwdaddress):
 ## Used to broadcast a new replica's address to all replicas in its initial view
 def broadcast_put_view(sentaddress):
     data = {'socket-address': sentaddress}
-    for replica in replicas:
-        if replica != sentaddress:
-            try:
-                # response = requests.put(f'http://{replica}/view', json=data, headers={'Content-Type': 'application/json'})
-                response = requests.put(f'http://{replica}/view', json=data)
-                print(f'broadcast_put_view: {replica} response:', response.json())
-            except requests.exceptions.RequestException as e:
-                print(f'broadcast_put_view error: exception raised: {e}')
+    peers = [replica for replica in replicas if replica != sentaddress]
+    for replica, response in fan_out(peers, lambda replica: peer_request('PUT', f'http://{replica}/view', json=data)).items():
+        if isinstance(response, Exception):
+            print(f'broadcast_put_view error: exception raised: {response}')
+        else:
+            print(f'broadcast_put_view: {replica} response:', response.json())
 
 
 
 ## Used to copy existing storage from a kvs when a new replica is made
-## Now should also copy shards and vector clock (done in /getall)
+## Joins shard `id`: registers with every member (from then on they replicate their writes here), streams the
+## shard from all of them in parallel, one key range each, and takes over the clock the copy covers.
+## Replica messages are buffered meanwhile and delivered after the copy (HoldbackQueue.release()), and
+## client requests for the shard are forwarded to another member until then
 def initialize_kvs(id): #now wait until put add-member before using this
-    global shards
     if viewenv:
         if len(replicas) == 1: # if there is only 1 replica in the view
             return
@@ -93,134 +1290,482 @@ def initialize_kvs(id): #now wait until put add-member before using this
         #First retrieve shards dictionary so we can pull kvs from correct shard
         try:
             url = f'http://{existingreplica}/getshards'
-            response = requests.get(url)
+            response = peer_request('GET', url)
             if response.status_code == 200:
                 data = response.json()
-                shards = {int(k): v for k, v in data["shards"].items()} #this converts all the keys to ints bc json will return them as strings
+                set_shards({int(k): v for k, v in data["shards"].items()}) #this converts all the keys to ints bc json will return them as strings
         except requests.exceptions.RequestException as e:
             print(f"initialize_kvs failed:  exception raised {e}")
 
-        # app.logger.debug(shards)
-        #change existing replica to be a replica in shards so we can pull data from the correct shard
-        existingreplica = shards[id][0]
-        try:
-            url = f'http://{existingreplica}/getall'
-            response = requests.get(url)
-            if response.status_code == 200:
-                data = response.json()
-                vc.clock = data["message-clock"] # copy the clock from the previously existing replica
-                for key, value in data["storage"].items():
-                    storage[key] = value
+        with write_lock:
+            holdback.buffering = True
+        members = [member for member in shards.get(id, []) if member != socket_address]
+        registered = {}
+        for member, response in fan_out(members, lambda member: peer_request('PUT', f'http://{member}/shard/join/{id}', json={"socket-address": socket_address})).items():
+            if isinstance(response, Exception) or response.status_code != 200:
+                app.logger.error(f"initialize_kvs: {member} did not register this node: {response}")
             else:
-                print(f"initialize_kvs failed: status code from getall - {response.status_code}")
+                registered[member] = vc.align(read_client_clock(response.json()["message-clock"]))
+        #Every write a member made before it registered this node has to come with the copy: donors wait until
+        #they delivered all of them before listing keys. Later writes arrive as replica messages
+        covered = [0] * len(vc.members)
+        for member, clock in registered.items():
+            covered[vc.index[member]] = clock[vc.index[member]]
+        storage.drop_buckets(ring.buckets_of(id)) # left from an earlier membership
+        donors = list(registered)
+        #Until every part is copied the node keeps buffering replica messages and forwarding client requests for
+        #the shard (serves()), so parts no donor finished are tried again from where they stopped
+        cursors = {part: '' for part in range(len(donors))}
+        copied = 0
+        backoff = 0.1
+        while cursors:
+            for part, result in fan_out(list(cursors), lambda part: copy_part(id, part, donors, vc.encode(covered), cursors[part])).items():
+                if isinstance(result, Exception):
+                    app.logger.error(f"initialize_kvs: copying part {part} of shard {id} failed: {result}")
+                    if isinstance(result, IncompleteCopy):
+                        cursors[part] = result.cursor
+                        copied += result.copied
+                else:
+                    copied += result
+                    del cursors[part]
+            if cursors:
+                if not any(donor in shards.get(id, []) for donor in donors):
+                    app.logger.error(f"initialize_kvs: every donor of shard {id} left it, {len(cursors)} parts are not copied")
+                    break
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5)
+        app.logger.info(f"initialize_kvs: copied {copied} keys of shard {id} from {donors}")
+        storage.wait_durable()
+        with write_lock:
+            for clock in registered.values(): # what the members knew about the other shards
+                for position, count in enumerate(clock):
+                    vc.counts[position] = max(vc.counts[position], count)
+            for member in registered:
+                vc.counts[vc.index[member]] = covered[vc.index[member]]
+            persist_state()
+            holdback.release()
+
+## Copies the values and versions of keys another node sent into storage, under the keys' stripes
+def import_items(values, versions):
+    with keys_locked(values.keys() | versions.keys()):
+        storage.update(values)
+        for key, version in versions.items():
+            record_version(key, version)
+
+# A part of a join's copy that no donor finished. `cursor` is where the next try goes on from, `copied` the keys
+# copied until then
+class IncompleteCopy(Exception):
+    def __init__(self, part, cursor, copied):
+        super().__init__(f"Part {part}: no donor finished the copy, stopped at cursor {cursor!r}. // copy_part()")
+        self.cursor = cursor
+        self.copied = copied
+
+## Streams key range `part` of shard_id (a slice of its buckets, see /storage/export) from donors[part], moving on to
+## the next donor from the same cursor if one fails. Returns the number of keys copied, raises IncompleteCopy if
+## every donor failed or kept answering 503
+def copy_part(shard_id, part, donors, clock, cursor=''):
+    copied = 0
+    for donor in donors[part:] + donors[:part]:
+        params = {"shard": shard_id, "part": part, "parts": len(donors), "limit": JOIN_CHUNK, "clock": clock, "session": f'{socket_address}/{shard_id}/{part}/{time.time()}'}
+        waits = 0
+        try:
+            while cursor is not None and waits < 3:
+                response = peer_request('GET', f'http://{donor}/storage/export', params=dict(params, cursor=cursor))
+                if response.status_code == 503: # donor still delivering writes the copy must include
+                    waits += 1
+                    continue
+                response.raise_for_status()
+                body = response.json()
+                import_items(kvsstorage.join_values(body["storage"], body.get("zlib", {})), body.get("versions", {}))
+                copied += len(body["storage"]) + len(body.get("zlib", {}))
+                cursor = body["next-cursor"]
+            if cursor is None:
+                return copied
         except requests.exceptions.RequestException as e:
-            print(f"initialize_kvs failed:  exception raised {e}")
+            app.logger.error(f"copy_part: {donor} failed at cursor {cursor}: {e}")
+    raise IncompleteCopy(part, cursor, copied)
 
 def broadcast_delete_view(sent_address):
     data = {'socket-address': sent_address}
-    replicas.remove(sent_address) # remove from view here
-    vc.delete_replica(sent_address)
-    for shard in range(shard_count):
-        if socket_address in shards[shard]:
-            shards[shard].remove(socket_address)
-    for replica in replicas:
-        if replica != sent_address:
-            try:
-                # response = requests.put(f'http://{replica}/view', json=data, headers={'Content-Type': 'application/json'})
-                response = requests.delete(f'http://{replica}/view', json=data)
-                print(f'broadcast_delete_view: {replica} response:', response.json())
-            except requests.exceptions.RequestException as e:
-                print(f'broadcast_delete_view error: exception raised: {e}')
+    view_remove(sent_address) # several broadcasts can notice the same dead replica
+    close_outbox(sent_address)
+    with write_lock:
+        vc.delete_replica(sent_address)
+        persist_state()
+    peers = [replica for replica in replicas if replica != sent_address]
+    for replica, response in fan_out(peers, lambda replica: peer_request('DELETE', f'http://{replica}/view', json=data)).items():
+        if isinstance(response, Exception):
+            print(f'broadcast_delete_view error: exception raised: {response}')
+        else:
+            print(f'broadcast_delete_view: {replica} response:', response.json())
 
-def broadcast_to_replicas(method, key, data, shard_id):
+## Sends one message to a peer, resending while it answers 503 (causal dependencies not satisfied yet).
+## The wait doubles from 10ms up to a second, a dependency usually arrives well before a full second
+def send_until_delivered(method, url, data):
+    response = peer_request(method, url, json=data, timeout=replica_timeout())
+    backoff = 0.01
+    while response.status_code == 503:
+        count_event("kvs_replication_retries_total", peer=urlsplit(url).netloc)
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 1)
+        response = peer_request(method, url, json=data, timeout=replica_timeout())
+    return response
+
+## Queues the write (sent as `method` to `path` on the other replicas in shard_id). The other shards learn about it
+## from the next merged clock flush_metadata() sends them, or right away if METADATA_INTERVAL is 0, with the
+## written `keys` when REMOTE_CACHE_SIZE is set. Must be called under write_lock right after the clock tick.
+## Returns the acks of both groups of peers
+def broadcast_to_replicas(method, path, data, shard_id, keys):
     # format data for sending to other replicas
-    data["causal-metadata"]= {"senders-address": socket_address, "message-clock": vc.clock}
+    data["causal-metadata"]= {"senders-address": socket_address, "message-clock": vc.sparse()}
+    clock = vc.snapshot()
 
-    #Broadcast request to replicas in shard_id
-    for replica in shards[shard_id]:
-        if replica != socket_address:
-            try:
-                replica_url = f'http://{replica}/replica_kvs/{key}'
-                response = requests.request(method, replica_url, json=data)
-                while response.status_code == 503:
-                    time.sleep(1)
-                    response = requests.request(method, replica_url, json=data)
-            except requests.exceptions.RequestException as e:
-                broadcast_delete_view(replica)
-                app.logger.debug(f'broadcast_to_replicas error: exception raised: {e}')
+    replication = [replica for replica in shards[shard_id] if replica != socket_address]
+    others = [replica for other_id, other_id_replicas in shards.items() if other_id != shard_id for replica in other_id_replicas]
+    if METADATA_INTERVAL > 0:
+        others = []
+        if REMOTE_CACHE_SIZE and len(written_keys) <= METADATA_KEYS:
+            written_keys.update(keys)
+    update = {"causal-metadata": data["causal-metadata"]}
+    if REMOTE_CACHE_SIZE:
+        update["keys"] = named_keys(keys)
+    replication_acks, metadata_acks = Acks(replication), Acks(others)
+    for replica in replication:
+        outbox_for(replica).put(method, f'http://{replica}{path}', data, replication_acks, clock)
+    for replica in others:
+        outbox_for(replica).put('PUT', f'http://{replica}/update_metadata', update, metadata_acks, clock)
+    return replication_acks, metadata_acks
 
-    #Broadcast update to metadata for all non-shard_id replicas
-    for other_id, other_id_replicas in shards.items():
-        if other_id != shard_id:    #Request goes to all shards that aren't shard_id
-            for replica in other_id_replicas:
-                try:
-                    url = f'http://{replica}/update_metadata'
-                    response = requests.put(url, json={"causal-metadata": data["causal-metadata"]})
-                    while response.status_code == 503:
-                        time.sleep(1)
-                        response = requests.request(method, replica_url, json=data)
-                except requests.exceptions.RequestException as e:
-                    broadcast_delete_view(replica)
-                    app.logger.debug(f'broadcast_to_replicas error: exception raised: {e}')
+## Every METADATA_INTERVAL seconds, if this node wrote anything since the last round, queue one merged clock
+## for every replica of the other shards, however many writes it covers. Runs on its own thread
+def flush_metadata():
+    flushed = 0
+    while True:
+        time.sleep(METADATA_INTERVAL)
+        with write_lock:
+            if vc.get(socket_address) == flushed:
+                continue
+            flushed = vc.get(socket_address)
+            update = {"causal-metadata": {"senders-address": socket_address, "message-clock": vc.sparse(), "coalesced": True}}
+            if REMOTE_CACHE_SIZE:
+                update["keys"] = named_keys(written_keys)
+                written_keys.clear()
+            clock = vc.snapshot()
+            others = [replica for members in shards.values() if socket_address not in members for replica in members]
+            acks = Acks(others)
+            for replica in others:
+                outbox_for(replica).put('PUT', f'http://{replica}/update_metadata', update, acks, clock)
+
+## What a client write waits for before it is answered, as (acks, how many of them or None for all): every peer
+## of the write for 'all', WRITE_QUORUM replicas of the shard (a majority by default) for 'quorum', none for 'local'
+def write_waits(mode, shard_id, replication_acks, metadata_acks):
+    if mode == 'all':
+        return [(replication_acks, None), (metadata_acks, None)]
+    elif mode == 'quorum':
+        quorum = WRITE_QUORUM or len(shards[shard_id]) // 2 + 1
+        return [(replication_acks, min(quorum, len(shards[shard_id])) - 1)]
+    return []
+
+## Holds a client write until the peers its write mode asks for have it
+def wait_for_write(mode, shard_id, replication_acks, metadata_acks):
+    for acks, needed in write_waits(mode, shard_id, replication_acks, metadata_acks):
+        acks.wait(needed)
+
+## Applies a client PUT or DELETE locally and queues it for the peers.
+## Returns the result, the clock right after this write and what the response has to wait for (write_waits())
+def local_write(method, key, value, data, shard_id):
+    with write_lock:
+        with key_lock(key):
+            if method == 'DELETE':
+                storage.pop(key, None)
+                result = "deleted"
+            else:
+                result = "replaced" if key in storage else "created"
+                storage[key] = value
+            data["version"] = next_version()
+            storage.set_version(key, data["version"])
+        vc.increment(socket_address)
+        persist_state()
+        clock_changed.notify_all()
+        clock = vc.snapshot()
+        acks = broadcast_to_replicas(method, f'/replica_kvs/{key}', data, shard_id, [key])
+    return result, pack_clock(*clock), write_waits(data.get('write-mode', WRITE_MODE), shard_id, *acks)
+
+## Runs one shard's operations of a batch here in a single pass: one clock tick for all of its writes and one
+## replication message per peer. Returns a result per operation and the clock right after them
+def local_batch(operations, data, shard_id):
+    results = []
+    writes = []
+    values = [compress_value(operation['value']) if operation['op'] == 'put' else None for operation in operations]
+    with write_lock, keys_locked(operation['key'] for operation in operations):
+        for operation, value in zip(operations, values):
+            key = operation['key']
+            if operation['op'] == 'put':
+                results.append({"key": key, "result": "replaced" if key in storage else "created", "shard-id": shard_id})
+                storage[key] = value
+                writes.append({"op": "put", "key": key, **kvsstorage.value_fields(value)})
+            elif key not in storage:
+                results.append({"key": key, "error": "Key does not exist", "status": 404})
+            elif operation['op'] == 'get':
+                results.append({"key": key, "result": "found", "value": decompress_value(storage[key]), "shard-id": shard_id})
+            else:
+                storage.pop(key)
+                results.append({"key": key, "result": "deleted", "shard-id": shard_id})
+                writes.append(operation)
+        if writes:
+            version = next_version()
+            for operation in writes:
+                storage.set_version(operation['key'], version)
+            vc.increment(socket_address)
+            persist_state()
+            clock_changed.notify_all()
+            acks = broadcast_to_replicas('PUT', '/replica_batch', {"operations": writes, "version": version}, shard_id, [operation['key'] for operation in writes])
+        clock = vc.snapshot()
+    if writes:
+        storage.wait_durable()
+        wait_for_write(data.get('write-mode', WRITE_MODE), shard_id, *acks)
+    return results, pack_clock(*clock)
+
+## Asks the peers for the addresses of a clock layout this node never had (it started after that view)
+def fetch_layout(digest):
+    for replica in [replica for replica in replicas if replica != socket_address]:
+        try:
+            response = peer_request('GET', f'http://{replica}/clock/layout/{digest}')
+        except requests.exceptions.RequestException:
+            continue
+        if response.status_code == 200 and layout_digest(response.json()["members"]) == digest:
+            vc.layouts[digest] = response.json()["members"]
+            return
+
+## Reads the message-clock a client sent back, packed (pack_clock()) or as {address: count}, into (digest, counts).
+## Raises KeyError if the clock's layout is not known here or at any peer, ValueError if it is not a clock
+def read_client_clock(message_clock):
+    if isinstance(message_clock, dict):
+        return vc.digest, vc.counts_of(message_clock)
+    if not isinstance(message_clock, str):
+        raise ValueError(f"Clock: {message_clock} is not a clock. // read_client_clock()")
+    digest, counts = unpack_clock(message_clock)
+    if digest not in vc.layouts:
+        fetch_layout(digest)
+    if digest not in vc.layouts:
+        raise KeyError(f"Clock: layout {digest} not known. // read_client_clock()")
+    return digest, counts
+
+## Entry-wise maximum of client clocks, packed. A clock that cannot be read is left out, like
+## handle_client_metadata() the operations that depended on it were refused
+def merge_clocks(*clocks):
+    merged = [0] * len(vc.members)
+    for message_clock in clocks:
+        try:
+            counts = vc.align(read_client_clock(message_clock))
+        except (KeyError, ValueError):
+            continue
+        merged = [max(count, other) for count, other in zip(merged, counts)]
+    return vc.encode(merged)
 
-        
 def handle_client_metadata(metadata):
     if metadata == None: # clients first request so the causal-metadata is null
         return True
-    else:
-        message_clock = metadata["message-clock"]
-
-    app.logger.debug(f'IN CLIENT METADATA: \nLOCAL CLOCK: {vc.clock}\n MESSAGE CLOCK: {message_clock}')
-    if vc.is_causal(message_clock):
-        return True
-    else:
+    try:
+        message_clock = read_client_clock(metadata["message-clock"])
+    except (KeyError, ValueError): # a clock from a view nobody knows anymore cannot be waited for
         return False
+
+    app.logger.debug(f'IN CLIENT METADATA: \nLOCAL CLOCK: {vc.clock}\n MESSAGE CLOCK: {metadata["message-clock"]}')
+    #wait for the replica messages the client depends on, clock_changed wakes us up on every delivery
+    start = time.perf_counter()
+    with write_lock:
+        satisfied = clock_changed.wait_for(lambda: vc.is_causal(vc.align(message_clock)), CAUSAL_WAIT)
+    observe("kvs_causal_wait_seconds", time.perf_counter() - start)
+    if not satisfied:
+        count_event("kvs_causal_refusals_total")
+    return satisfied
     #for checking causal consistency of passed in metadata
 
-def handle_replica_metadata(metadata):
-    if metadata == None:
+## Takes a message read by read_replica_metadata()
+def handle_replica_metadata(message):
+    if message == None:
         return False
     else:
-        message_clock = metadata["message-clock"]
-        senders_address = metadata["senders-address"]
+        message_counts = vc.align(message["clock"])
+        senders_address = message["senders-address"]
 
-    app.logger.debug(f'IN REPLICA METADATA: \nSENDERS_ADDRESS: {senders_address}\nLOCAL CLOCK: {vc.clock}\n MESSAGE CLOCK: {message_clock}')
-    if vc.is_causal(message_clock, senders_address):
+    app.logger.debug(f'IN REPLICA METADATA: \nSENDERS_ADDRESS: {senders_address}\nLOCAL CLOCK: {vc.clock}\n MESSAGE CLOCK: {message_counts}')
+    if message["coalesced"]:
+        #A merged clock from another shard can cover many writes. Only this shard's entries must already be
+        #delivered here; the rest is what the sender knows about other shards and is merged in
+        local_positions = {vc.index[replica] for members in shards.values() if socket_address in members for replica in members if replica in vc.index}
+        if all(message_counts[position] <= vc.counts[position] for position in local_positions):
+            for position, count in enumerate(message_counts):
+                if position not in local_positions and count > vc.counts[position]:
+                    vc.counts[position] = count
+            return True
+        return False
+    if vc.is_causal(message_counts, senders_address):
         vc.increment(senders_address)
         return True
     else:
         return False
     #for checking causal consistency of passed in metadata
 
-#Shard assignment by hash of key, each key is assigned a unique shard based on its keyhash
+### ANTI-ENTROPY ###
+# Replication alone can leave the replicas of a shard holding different data for good: two replicas apply
+# concurrent writes of a key in opposite orders, or a node misses writes while it is cut off from its shard.
+# Every ANTI_ENTROPY_INTERVAL seconds a node compares its hash tree (kvsstorage.MemoryStorage.merkle_levels())
+# with a random other member of its shard, top down, only descending into the subtrees whose hashes differ.
+# For the differing leaves the two swap the versions of their keys, and every key that differs is copied from
+# the side with the newer version, deletes included. Replicas that agree cost one call with the root hash
+
+## Applies {key: {"value", "zlib" or "deleted", "version"}} items a peer sent, each only if it is newer than what this
+## node has. Returns how many were applied
+def apply_items(items):
+    applied = 0
+    for key, item in items.items():
+        with key_lock(key):
+            if not newer(item["version"], storage.versions.get(key)):
+                continue
+            if item.get("deleted"):
+                storage.pop(key, None)
+            else:
+                storage[key] = kvsstorage.value_from(item)
+            record_version(key, item["version"])
+        applied += 1
+    storage.wait_durable()
+    return applied
+
+def local_items(keys):
+    items = {}
+    for key in keys:
+        version = storage.versions.get(key)
+        value = storage.peek(key, MISSING)
+        if value is not MISSING:
+            items[key] = {**kvsstorage.value_fields(value), "version": version}
+        elif version is not None:
+            items[key] = {"deleted": True, "version": version}
+    return items
+
+## One anti-entropy round with `peer` over shard_id. Returns what it cost and repaired
+def sync_with(peer, shard_id):
+    stats = {"peer": peer, "calls": 0, "bytes": 0, "leaves": 0, "pulled": 0, "pushed": 0}
+    def call(method, path, body):
+        response = peer_request(method, f'http://{peer}{path}', json=body)
+        response.raise_for_status()
+        stats["calls"] += 1
+        stats["bytes"] += len(json.dumps(body)) + len(response.content)
+        return response.json()
+
+    levels = storage.merkle_levels()
+    nodes = [0]
+    for level in range(len(levels)):
+        hashes = call('POST', '/antientropy/tree', {"level": level, "nodes": nodes})["hashes"]
+        nodes = [node for node, theirs in zip(nodes, hashes) if levels[level][node] != theirs]
+        if not nodes or level == len(levels) - 1:
+            break
+        nodes = [child for node in nodes for child in range(node * kvsstorage.MERKLE_FANOUT, min((node + 1) * kvsstorage.MERKLE_FANOUT, len(levels[level + 1])))]
+    stats["leaves"] = len(nodes)
+    if not nodes:
+        return stats
+
+    mine = storage.leaf_versions(nodes)
+    theirs = call('POST', '/antientropy/versions', {"leaves": nodes})["versions"]
+    keys = [key for key in set(mine) | set(theirs) if hash_of_key(key) == shard_id]
+    pull = [key for key in keys if newer(theirs.get(key), mine.get(key))]
+    push = [key for key in keys if newer(mine.get(key), theirs.get(key))]
+    if pull:
+        stats["pulled"] = apply_items(call('POST', '/antientropy/items', {"keys": pull})["items"])
+    if push:
+        stats["pushed"] = call('PUT', '/antientropy/items', {"items": local_items(push)})["applied"]
+    app.logger.debug(f'ANTI-ENTROPY: {stats}')
+    return stats
+
+## The shard this node serves and a random other member of it, or None if it has nobody to compare with
+def anti_entropy_peer():
+    shard_id = next((shard_id for shard_id, members in shards.items() if socket_address in members), None)
+    if shard_id is None or holdback.buffering:
+        return None
+    peers = [member for member in shards[shard_id] if member != socket_address]
+    return (random.choice(peers), shard_id) if peers else None
+
+## Runs on its own thread
+def anti_entropy():
+    while True:
+        time.sleep(ANTI_ENTROPY_INTERVAL)
+        partner = anti_entropy_peer()
+        if partner is None:
+            continue
+        try:
+            sync_with(*partner)
+        except requests.exceptions.RequestException:
+            continue
+
+#Shard assignment by hash of key, each key is assigned a unique shard based on its position on the hash ring
 def hash_of_key(key):
-    app.logger.debug(f'shard count is {shard_count}')
-    keyhash = int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16)
-    return keyhash % shard_count
-
-#Key redistribution to be used when resharding is done
-def redistribute_keys():
-    global storage
-    deleted_keys = []
-    for key, value in storage.items():
-        correct_shard = hash_of_key(key)
-        app.logger.debug(f'key is {key}, shard is {correct_shard}')
-        if socket_address not in shards[correct_shard]:
-            data = {{"value": value, "causal-metadata": {"message-clock": vc.clock}}}
-
-            for correct_node in shards[correct_shard]:
-                if correct_node != socket_address:
-                    try:
-                        url = f"http://{correct_node}/kvs/{key}"
-                        response = requests.put(url, json=data, headers={"Content-Type": "application/json"})
-                    except requests.exceptions.RequestException as e:
-                        app.logger.error(f"exception raised in redistribute_keys: {e}")
-
-            deleted_keys.append(key)
-    for key in deleted_keys:
-        del storage[key]
-    
-    app.logger.debug(f'storage is now {storage}')
+    return ring.shard_for(key)
+
+#True if this node answers client requests for shard_id: it is a member and done joining it
+def serves(shard_id):
+    return socket_address in shards[shard_id] and not holdback.buffering
+
+## Yields the key value pairs of local storage that belong to shard_id, at most `limit` at a time.
+## The keys are those of the shard's buckets, values are read chunk by chunk as they are sent
+def storage_chunks(shard_id, limit=TRANSFER_CHUNK):
+    keys = storage.keys_in(ring.buckets_of(shard_id))
+    for start in range(0, len(keys), limit):
+        chunk = {}
+        for key in keys[start:start + limit]:
+            value = storage.peek(key, MISSING) # may have been deleted since the keys were listed
+            if value is not MISSING:
+                chunk[key] = value
+        if chunk:
+            yield chunk
+
+## Streams every key of local storage to the members of its new shard that do not already hold it,
+## which are the members that were not in this node's old shard. Called on one source per old shard
+def transfer_storage(old_shards):
+    old_members = []
+    for members in old_shards.values():
+        if socket_address in members:
+            old_members = members
+    moved = 0
+    for shard_id, members in shards.items():
+        destinations = [node for node in members if node not in old_members]
+        if not destinations:
+            continue
+        for chunk in storage_chunks(shard_id):
+            cursor = max(chunk)
+            versions = {key: storage.versions[key] for key in chunk if key in storage.versions}
+            plain, packed = kvsstorage.split_values(chunk)
+            send = lambda destination: peer_request('PUT', f'http://{destination}/storage/import', json={"storage": plain, "zlib": packed, "versions": versions, "cursor": cursor})
+            for destination, response in fan_out(destinations, send).items():
+                if isinstance(response, Exception):
+                    app.logger.error(f"exception raised in transfer_storage: {destination}: {response}")
+                elif response.status_code != 200:
+                    app.logger.error(f'transfer_storage: {destination} rejected chunk ending at {cursor}: {response.status_code}')
+            moved += len(chunk)
+    return moved
+
+## Drops the buckets this node's shard no longer owns, run once all transfers of a reshard are done
+def prune_storage():
+    kept = {bucket for shard_id, members in shards.items() if socket_address in members for bucket in ring.buckets_of(shard_id)}
+    return storage.drop_buckets([bucket for bucket in storage.held_buckets() if bucket not in kept])
+
+## Assigns every replica in the view to one of num_shards shards. Nodes stay in their current shard
+## where they can, so a reshard only moves the nodes (and the data) it has to
+def assign_shards(num_shards):
+    new_shards = {shard: [node for node in shards.get(shard, []) if node in replicas] for shard in range(num_shards)}
+    assigned = [node for members in new_shards.values() for node in members]
+    pool = sorted(node for node in replicas if node not in assigned)
+    base, extra = divmod(len(replicas), num_shards)
+    # the shards that are already the largest keep the extra nodes
+    by_size = sorted(new_shards, key=lambda shard: (-len(new_shards[shard]), shard))
+    targets = {shard: base + (1 if rank < extra else 0) for rank, shard in enumerate(by_size)}
+    for shard in new_shards:
+        while len(new_shards[shard]) > targets[shard]:
+            pool.append(new_shards[shard].pop())
+    for shard in new_shards:
+        while len(new_shards[shard]) < targets[shard]:
+            new_shards[shard].append(pool.pop(0))
+    return new_shards
 
 
 @app.route('/getshards', methods=['GET'])
@@ -229,49 +1774,190 @@ def getshards():
 
 @app.route('/getall', methods=['GET'])
 def getall():
-    return jsonify({"storage": storage, "message-clock": vc.clock}), 200
-
-@app.route('/replica_kvs/<key>', methods=['GET', 'PUT', 'DELETE'])
-def replica_kvs(key):
+    with write_lock:
+        clock = vc.clock
+    return jsonify({"storage": {key: kvsstorage.decompress(value) for key, value in storage.items()}, "message-clock": clock}), 200
 
+## A replica PUT or DELETE of key, as the body and status of its response. Shared by /replica_kvs/<key> and
+## the frame transport; the caller waits for storage.wait_durable() before it answers
+def replica_write(method, key, data):
     if len(key) > 50:
-        return jsonify({"error": "Key is too long"}), 400
-    
-    if request.method == 'PUT':
-        data = request.get_json()   #returns dictionary
-        if data and ('value' in data) and ('causal-metadata' in data):
-            value = data['value']   #pulls value from json body
+        return {"error": "Key is too long"}, 400
+
+    if method == 'PUT':
+        if data and ('value' in data or 'zlib' in data) and ('causal-metadata' in data):
+            value = kvsstorage.value_from(data)   #pulls value from json body
             metadata = data['causal-metadata'] #pulls metadata
 
-            if handle_replica_metadata(metadata): 
-                if key in storage:    #key already exists
-                    storage[key] = value
-                    return jsonify({"result": "replaced", "causal-metadata": metadata}), 200 #INCLUDE NEW METADATA
-                else:   #key does not exist
+            def apply():
+                with key_lock(key):
+                    result = "replaced" if key in storage else "created"
                     storage[key] = value
-                    print("here in replica_kvs")
-                    return jsonify({"result": "created", "causal-metadata": metadata}), 201 #INCLUDE NEW METADATA
-            else:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-            
+                    record_version(key, data.get('version'))
+                return result
+            resolve_layout(metadata) # not under write_lock, it may ask the peers
+            try:
+                with write_lock:
+                    result = holdback.deliver(metadata, apply)
+            except TimeoutError:
+                return {"error": "Causal dependencies not satisfied; try again later"}, 503
+            except SenderNotInView as e:
+                return {"error": str(e)}, 410
+            except LookupError:
+                return {"error": "Base clock not known; resend the full clock"}, 409
+            if result == None:
+                return {"result": "already delivered", "causal-metadata": metadata}, 200
+            return {"result": result, "causal-metadata": metadata}, 201 if result == "created" else 200 #INCLUDE NEW METADATA
+
         else:   #passed in data is invalid
-            return jsonify({"error": "PUT request does not specify a value or metadata"}), 400
-        
-    if request.method == 'DELETE':
-        data = request.get_json()   #returns dictionary
+            return {"error": "PUT request does not specify a value or metadata"}, 400
+
+    if method == 'DELETE':
         if data and 'causal-metadata' in data:
             metadata = data['causal-metadata']
-            if handle_replica_metadata(metadata):
-                if key in storage:
-                    storage.pop(key)
-                    return jsonify({"result": "deleted", "causal-metadata": metadata}), 200 #INCLUDE NEW METADATA
-                else:
-                    return jsonify({"error": "Key does not exist"}), 404
+            def apply():
+                with key_lock(key):
+                    record_version(key, data.get('version'))
+                    if key in storage:
+                        storage.pop(key)
+                        return "deleted"
+                return "missing"
+            resolve_layout(metadata) # not under write_lock, it may ask the peers
+            try:
+                with write_lock:
+                    result = holdback.deliver(metadata, apply)
+            except TimeoutError:
+                return {"error": "Causal dependencies not satisfied; try again later"}, 503
+            except SenderNotInView as e:
+                return {"error": str(e)}, 410
+            except LookupError:
+                return {"error": "Base clock not known; resend the full clock"}, 409
+            if result == None:
+                return {"result": "already delivered", "causal-metadata": metadata}, 200
+            elif result == "deleted" or result == "buffered":
+                return {"result": result, "causal-metadata": metadata}, 200 #INCLUDE NEW METADATA
             else:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
+                return {"error": "Key does not exist"}, 404
         else:
-            return jsonify({"error": "DELETE request does not specify metadata"}), 400
-    
+            return {"error": "DELETE request does not specify metadata"}, 400
+    return {"error": ERRMSG}, 405
+
+## The writes of a client batch from another replica of the shard, applied in one delivery
+def replica_batch_write(data):
+    if data and ('operations' in data) and ('causal-metadata' in data):
+        metadata = data['causal-metadata']
+        def apply():
+            with keys_locked(operation['key'] for operation in data['operations']):
+                for operation in data['operations']:
+                    if operation['op'] == 'put':
+                        storage[operation['key']] = kvsstorage.value_from(operation)
+                    else:
+                        storage.pop(operation['key'], None)
+                    record_version(operation['key'], data.get('version'))
+            return "applied"
+        resolve_layout(metadata) # not under write_lock, it may ask the peers
+        try:
+            with write_lock:
+                result = holdback.deliver(metadata, apply)
+        except TimeoutError:
+            return {"error": "Causal dependencies not satisfied; try again later"}, 503
+        except SenderNotInView as e:
+            return {"error": str(e)}, 410
+        except LookupError:
+            return {"error": "Base clock not known; resend the full clock"}, 409
+        return {"result": result or "already delivered", "causal-metadata": metadata}, 200
+    else:
+        return {"error": "Batch does not specify operations or metadata"}, 400
+
+## A clock from a replica of another shard, which only moves this node's clock and drops the keys it wrote
+## from remote_cache
+def metadata_update(data):
+    if data and 'causal-metadata' in data:
+        metadata = data['causal-metadata']
+        remote_cache.invalidate(data.get('keys'), metadata)
+        resolve_layout(metadata) # not under write_lock, it may ask the peers
+        try:
+            with write_lock:
+                holdback.deliver(metadata, lambda: "metadata updated")
+        except TimeoutError:
+            return {"result": "metadata failed to update"}, 503 #RETRY UNTIL SUCCESS HERE
+        except SenderNotInView as e:
+            return {"error": str(e)}, 410
+        except LookupError:
+            return {"error": "Base clock not known; resend the full clock"}, 409
+        return {"result": "metadata updated"}, 200
+    else:
+        return {"error": "Request does not contain 'causal-metadata'"}, 400
+
+@app.route('/replica_kvs/<key>', methods=['GET', 'PUT', 'DELETE'])
+def replica_kvs(key):
+    body, status = replica_write(request.method, key, request.get_json(silent=True))
+    storage.wait_durable()
+    return jsonify(body), status
+
+@app.route('/replica_batch', methods=['PUT'])
+def replica_batch():
+    body, status = replica_batch_write(request.get_json(silent=True))
+    storage.wait_durable()
+    return jsonify(body), status
+
+#Many operations under one causal-metadata. The operations are grouped by shard: this node's group runs here in one
+#pass and every other group is forwarded as one batch to its shard. Results come back in the order of the operations
+@app.route('/kvs/batch', methods=['POST'])
+def kvs_batch():
+    data = request.get_json()
+    if not data or ('operations' not in data) or ('causal-metadata' not in data):
+        return jsonify({"error": "Batch does not specify operations or metadata"}), 400
+    operations = data['operations']
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in ('get', 'put', 'delete') or not isinstance(operation.get('key'), str):
+            return jsonify({"error": f"Operation {index} needs an op (get, put or delete) and a key"}), 400
+        if len(operation['key']) > 50:
+            return jsonify({"error": f"Operation {index}: Key is too long"}), 400
+        if operation['op'] == 'put' and 'value' not in operation:
+            return jsonify({"error": f"Operation {index}: PUT does not specify a value"}), 400
+    if data.get('write-mode', WRITE_MODE) not in WRITE_MODES:
+        return jsonify({"error": f"write-mode must be one of {', '.join(WRITE_MODES)}"}), 400
+
+    groups = {}
+    for index, operation in enumerate(operations):
+        groups.setdefault(hash_of_key(operation['key']), []).append(index)
+
+    def forward(shard_id):
+        body = dict(data, operations=[operations[index] for index in groups[shard_id]])
+        return forward_to_shard(shard_id, 'POST', '/kvs/batch', json=body)
+    remote = {shard_id: fanout_pool.submit(forward, shard_id) for shard_id in groups if not serves(shard_id)}
+
+    results = [None] * len(operations)
+    metadata = data['causal-metadata']
+    clocks = [metadata["message-clock"]] if metadata else []
+    for shard_id, indexes in groups.items():
+        if shard_id in remote:
+            continue
+        if handle_client_metadata(metadata):
+            group_results, clock = local_batch([operations[index] for index in indexes], data, shard_id)
+            clocks.append(clock)
+        else:
+            group_results = [{"key": operations[index]['key'], "error": "Causal dependencies not satisfied; try again later", "status": 503} for index in indexes]
+        for index, result in zip(indexes, group_results):
+            results[index] = result
+
+    for shard_id, future in remote.items():
+        try:
+            response = future.result()
+            body = response.json()
+        except Exception as e:
+            response, body = None, {"error": f"Cannot forward batch: {e}"}
+        if response is not None and response.status_code == 200:
+            group_results = body["results"]
+            clocks.append(body["causal-metadata"]["message-clock"])
+        else:
+            status = response.status_code if response is not None else 503
+            group_results = [{"key": operations[index]['key'], "error": body.get("error"), "status": status} for index in groups[shard_id]]
+        for index, result in zip(groups[shard_id], group_results):
+            results[index] = result
+
+    return jsonify({"results": results, "causal-metadata": {"message-clock": merge_clocks(*clocks)}}), 200
 
 @app.route('/kvs/<key>', methods=['GET', 'PUT', 'DELETE'])
 def kvs(key):
@@ -281,68 +1967,65 @@ def kvs(key):
     
     print("here in kvs")
     shard_id = hash_of_key(key)
-    #Key does not belong to this replica's shard (based on its hash)
-    if socket_address not in shards[shard_id]:
-        correct_shard_replica = shards[shard_id][0]
-        forward_url = f"http://{correct_shard_replica}/kvs/{key}"
-        response = requests.request(request.method, forward_url, json=request.get_json(), headers={"Content-Type": "application/json"})
-        return jsonify(response.json()), response.status_code        #SHOULD RETURN SHARD ID ASWELL !!!!!
+    #Key does not belong to this replica's shard (based on its hash), or this replica is still joining it
+    if not serves(shard_id):
+        data = request.get_json()
+        if request.method == 'GET' and isinstance(data, dict) and 'causal-metadata' in data:
+            cached = remote_cache.lookup(key, data['causal-metadata'])
+            if cached is not None:
+                return jsonify(cached), 200
+        ticket = remote_cache.ticket()
+        try:
+            response = forward_to_shard(shard_id, request.method, f"/kvs/{key}", json=data, headers={"Content-Type": "application/json"})
+        except requests.exceptions.RequestException:
+            return jsonify({"error": "Cannot forward request"}), 503
+        body = response.json()
+        if request.method == 'GET' and response.status_code == 200:
+            remote_cache.keep(key, ticket, body)
+        return jsonify(body), response.status_code        #SHOULD RETURN SHARD ID ASWELL !!!!!
     
-    if request.method == 'PUT':
-        data = request.get_json()   #returns dictionary
-        if data and ('value' in data) and ('causal-metadata' in data):
-            value = data['value']   #pulls value from json body
-            metadata = data['causal-metadata'] #pulls metadata
+    data = request.get_json()   #returns dictionary
+    error = kvs_request_error(request.method, data)
+    if error:
+        return jsonify(error[0]), error[1]
+    if not handle_client_metadata(data['causal-metadata']):
+        return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
+    body, status, waits = kvs_serve(request.method, key, data, shard_id)
+    if waits is not None:
+        storage.wait_durable()
+        for acks, needed in waits:
+            acks.wait(needed)
+    return jsonify(body), status
 
-            if handle_client_metadata(metadata): 
-                if key in storage:    #key already exists
-                    storage[key] = value
-                    vc.increment(socket_address)
-                    broadcast_to_replicas(request.method, key, data, shard_id)
-                    return jsonify({"result": "replaced", "causal-metadata": {"message-clock": vc.clock}, "shard-id": shard_id}), 200 #INCLUDE NEW METADATA
-                else:   #key does not exist
-                    storage[key] = value
-                    vc.increment(socket_address)
-                    broadcast_to_replicas(request.method, key, data, shard_id)
-                    return jsonify({"result": "created", "causal-metadata": {"message-clock": vc.clock}, "shard-id": shard_id}), 201 #INCLUDE NEW METADATA
-            else:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-            
-        else:   #passed in data is invalid
-            return jsonify({"error": "PUT request does not specify a value or metadata"}), 400
+## Checks the body of a client request to /kvs/<key>. Returns (error, status) or None if it is fine
+def kvs_request_error(method, data):
+    if method == 'PUT' and not (data and ('value' in data) and ('causal-metadata' in data)):
+        return {"error": "PUT request does not specify a value or metadata"}, 400
+    if method != 'PUT' and not (data and 'causal-metadata' in data):
+        return {"error": f"{method} request does not specify metadata"}, 400
+    if method != 'GET' and data.get('write-mode', WRITE_MODE) not in WRITE_MODES:
+        return {"error": f"write-mode must be one of {', '.join(WRITE_MODES)}"}, 400
+    return None
 
-    if request.method == 'GET':
-        data = request.get_json()   #returns dictionary
-        if data and 'causal-metadata' in data:
-            metadata = data['causal-metadata']
-            if handle_client_metadata(metadata):
-                if key in storage:
-                    value = storage[key]
-                    # Could be problems below
-                    return jsonify({"result": "found", "value": value, "causal-metadata": {"message-clock": vc.clock}, "shard-id": shard_id}), 200 #INCLUDE NEW METADATA
-                else:
-                    return jsonify({"error": "Key does not exist"}), 404
-            else:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-        else:
-            return jsonify({"error": "GET request does not specify metadata"}), 400
-        
-    if request.method == 'DELETE':
-        data = request.get_json()   #returns dictionary
-        if data and 'causal-metadata' in data:
-            metadata = data['causal-metadata']
-            if handle_client_metadata(metadata):
-                if key in storage:
-                    storage.pop(key)
-                    vc.increment(socket_address)
-                    broadcast_to_replicas(request.method, key, data, shard_id)
-                    return jsonify({"result": "deleted", "causal-metadata": {"message-clock": vc.clock}, "shard-id": shard_id}), 200 #INCLUDE NEW METADATA
-                else:
-                    return jsonify({"error": "Key does not exist"}), 404
-            else:
-                return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
-        else:
-            return jsonify({"error": "DELETE request does not specify metadata"}), 400
+MISSING = object() # what storage.get() returns for a key it does not have, a stored value can be null
+
+## Serves a client request for a key of this node's shard once its causal dependencies are in. Returns the
+## response body, status and, for a write, what the response has to wait for (write_waits()), otherwise None
+def kvs_serve(method, key, data, shard_id):
+    if method == 'GET':
+        value = storage.get(key, MISSING)
+        if value is not MISSING:
+            return {"result": "found", "value": decompress_value(value), "causal-metadata": {"message-clock": current_clock()}, "shard-id": shard_id}, 200, None
+        return {"error": "Key does not exist"}, 404, None
+    if method == 'DELETE' and key not in storage:
+        return {"error": "Key does not exist"}, 404, None
+    value = None
+    replica_data = {"write-mode": data["write-mode"]} if "write-mode" in data else {} # none of the client's other fields
+    if method == 'PUT': # the replicas get the stored form
+        value = compress_value(data['value'])
+        replica_data.update(kvsstorage.value_fields(value))
+    result, clock, waits = local_write(method, key, value, replica_data, shard_id)
+    return {"result": result, "causal-metadata": {"message-clock": clock}, "shard-id": shard_id}, 201 if result == "created" else 200, waits
 
    
 @app.route('/view', methods=['GET', 'PUT', 'DELETE'])
@@ -351,11 +2034,12 @@ def view():
         data = request.get_json()
         if data and 'socket-address' in data:
             socket_address = data['socket-address'] #pulls socket address from json body
-            if socket_address in replicas:
+            if not view_add(socket_address):
                 return jsonify({"result": "already present"}), 200
             else: 
-                replicas.append(socket_address)
-                vc.add_replica(socket_address)
+                with write_lock:
+                    vc.add_replica(socket_address)
+                    persist_state()
                 return jsonify({"result": "added"}), 201
         else:
             return jsonify({"error": "PUT request does not specify a socket-address"})
@@ -367,12 +2051,11 @@ def view():
         data = request.get_json()
         if data and 'socket-address' in data:
             socket_address = data['socket-address'] #pulls socket address from json body
-            if socket_address in replicas:
-                replicas.remove(socket_address)
-                vc.delete_replica(socket_address)
-                for shard in range(shard_count):
-                    if socket_address in shards[shard]:
-                        shards[shard].remove(socket_address)
+            if view_remove(socket_address):
+                close_outbox(socket_address)
+                with write_lock:
+                    vc.delete_replica(socket_address)
+                    persist_state()
                 return jsonify({"result": "deleted"}), 200
             else:
                 return jsonify({"error": "View has no such replica"}), 404
@@ -381,17 +2064,121 @@ def view():
 
 @app.route('/update_metadata', methods=['PUT'])
 def update_metadata():
-    data = request.get_json() #data = causal metadata
-    if 'causal-metadata' in data:
-        metadata = data['causal-metadata']
-        if handle_replica_metadata(metadata):
-            return jsonify({"result": "metadata updated"}), 200
-        else:
-            return jsonify({"result": "metadata failed to update"}), 503 #RETRY UNTIL SUCCESS HERE
-    else:
-        return jsonify({"error": "Request does not contain 'causal-metadata'"}), 400
+    body, status = metadata_update(request.get_json(silent=True))
+    storage.wait_durable()
+    return jsonify(body), status
 
      
+#Addresses of a clock layout, for a node that gets a packed clock from before it started
+@app.route('/clock/layout/<digest>', methods=['GET'])
+def clock_layout(digest):
+    if digest in vc.layouts:
+        return jsonify({"members": vc.layouts[digest]}), 200
+    return jsonify({"error": "Layout not known"}), 404
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    if 'started' in g:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        observe("kvs_request_seconds", time.perf_counter() - g.started, route=route, method=request.method)
+        count_request(route, request.method, response.status_code)
+    return response
+
+#Prometheus text format, see METRICS
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    gauges = []
+    for shard_id in shards:
+        keys, items = storage.bucket_totals(ring.buckets_of(shard_id))
+        gauges.append(("kvs_storage_keys", (("shard", shard_id),), keys))
+        gauges.append(("kvs_storage_bytes", (("shard", shard_id),), items))
+        spilled, spilled_bytes = storage.spill_totals(ring.buckets_of(shard_id))
+        gauges.append(("kvs_storage_spilled_keys", (("shard", shard_id),), spilled))
+        gauges.append(("kvs_storage_spilled_bytes", (("shard", shard_id),), spilled_bytes))
+    with outboxes_lock:
+        for peer, outbox in outboxes.items():
+            gauges.append(("kvs_outbox_pending", (("peer", peer),), len(outbox.messages)))
+    gauges.append(("kvs_holdback_held", (), len(holdback.held)))
+    if REMOTE_CACHE_SIZE:
+        gauges.append(("kvs_remote_cache_entries", (), len(remote_cache)))
+    return render_metrics(gauges), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/connections', methods=['GET'])
+def connections():
+    with connection_stats_lock:
+        stats = dict(connection_stats)
+    stats["reused-connections"] = stats["requests"] - stats["new-connections"]
+    stats["pool-size"] = POOL_SIZE
+    with peer_health_lock:
+        stats["forwarding"] = {peer: health.stats() for peer, health in peer_health.items()}
+    return jsonify(stats), 200
+
+### CLUSTER STATS ###
+# /cluster/stats gathers the stats of every shard from one of its members at once: every shard's request goes
+# out on fanout_pool, to the members in forward_order() (the healthy ones first), each waited for at most
+# STATS_TIMEOUT before the next member is tried. A shard none of whose members answered is reported with the
+# error instead of failing the whole answer. What was gathered is served for STATS_TTL seconds, and requests
+# that come in while it is being gathered wait for it instead of gathering again, so any number of dashboards
+# polling it cost the shards one round every STATS_TTL. Key counts and bytes are the shard's (every member holds
+# them), the clock and the request rate are those of the member that answered
+stats_lock = threading.Lock()
+gathered_stats = None # (time.monotonic() it was gathered at, the body of /cluster/stats)
+
+## The stats of shard_id as this node, a member of it, has them
+def shard_stats(shard_id):
+    keys, items = storage.bucket_totals(ring.buckets_of(shard_id))
+    spilled, spilled_bytes = storage.spill_totals(ring.buckets_of(shard_id))
+    with write_lock:
+        clock = vc.snapshot()
+    return {"member": socket_address, "key-count": keys, "bytes": items, "spilled-keys": spilled, "spilled-bytes": spilled_bytes,
+            "clock-entries": len(clock[1]), "clock-bytes": len(pack_clock(*clock)), "requests-per-second": request_rate()}
+
+def gather_cluster_stats():
+    def fetch(shard_id):
+        if serves(shard_id):
+            return shard_stats(shard_id)
+        response = forward_to_shard(shard_id, 'GET', f'/shard/stats/{shard_id}', timeout=(PEER_CONNECT_TIMEOUT, STATS_TIMEOUT))
+        if response.status_code != 200:
+            raise requests.exceptions.RequestException(response.json().get("error", response.status_code))
+        return response.json()
+    start = time.perf_counter()
+    results = fan_out(list(shards), fetch)
+    stats = {}
+    for shard_id, result in sorted(results.items()):
+        stats[shard_id] = {"error": f"No member answered: {result}"} if isinstance(result, Exception) else result
+    answered = [result for result in stats.values() if "error" not in result]
+    return {"shards": stats, "shard-count": len(stats), "unreachable-shards": len(stats) - len(answered),
+            "key-count": sum(result["key-count"] for result in answered), "bytes": sum(result["bytes"] for result in answered),
+            "requests-per-second": round(sum(result["requests-per-second"] for result in answered), 1),
+            "gather-ms": round((time.perf_counter() - start) * 1000, 2)}
+
+@app.route('/cluster/stats', methods=['GET'])
+def cluster_stats():
+    global gathered_stats
+    with stats_lock:
+        if gathered_stats is None or time.monotonic() - gathered_stats[0] >= STATS_TTL:
+            gathered_stats = (time.monotonic(), gather_cluster_stats())
+        gathered, stats = gathered_stats
+    return jsonify(dict(stats, **{"age-ms": round((time.monotonic() - gathered) * 1000, 2)})), 200
+
+#The stats of a shard for /cluster/stats, from a member of it
+@app.route('/shard/stats/<ID>', methods=['GET'])
+def get_shard_stats(ID):
+    shard_id = int(ID)
+    if shard_id not in shards:
+        return jsonify({"error": "Shard does not exist"}), 404
+    if serves(shard_id):
+        return jsonify(shard_stats(shard_id)), 200
+    try:
+        response = forward_to_shard(shard_id, 'GET', f"/shard/stats/{shard_id}", timeout=(PEER_CONNECT_TIMEOUT, STATS_TIMEOUT))
+    except requests.exceptions.RequestException:
+        return jsonify({"error": "Cannot forward request"}), 503
+    return jsonify(response.json()), response.status_code
+
 @app.route('/shard/ids', methods=['GET'])
 def get_shard_ids():
     return jsonify({"shard-ids": list(shards.keys())}), 200
@@ -415,19 +2202,31 @@ def get_keycount(ID):
     shard_id = int(ID)
     if shard_id in shards:
         counter = 0
-        if socket_address in shards[shard_id]:
-            return jsonify({"shard-key-count": len(storage)}), 200
+        if serves(shard_id):
+            keys, items = storage.bucket_totals(ring.buckets_of(shard_id))
+            spilled, spilled_bytes = storage.spill_totals(ring.buckets_of(shard_id))
+            return jsonify({"shard-key-count": keys, "resident-keys": keys - spilled, "spilled-keys": spilled,
+                    "resident-bytes": items - spilled_bytes, "spilled-bytes": spilled_bytes}), 200
         else:
-            correct_shard_replica = shards[shard_id][0]
-            url = f"http://{correct_shard_replica}/shard/key-count/{shard_id}"
             try:
-                response = requests.get(url)
+                response = forward_to_shard(shard_id, 'GET', f"/shard/key-count/{shard_id}")
                 return jsonify(response.json()), response.status_code
             except requests.exceptions.RequestException as e:
                 app.logger.debug(f'get_keycount error: exception raised: {e}')
+                return jsonify({"error": "Cannot forward request"}), 503
     else:
         return jsonify({"error": "Shard does not exist"}), 404
 
+#The shard map for clients that route requests themselves (kvsclient.py)
+@app.route('/shard/map', methods=['GET'])
+def get_shard_map():
+    return jsonify({"epoch": shard_epoch(), "vnodes": VNODES, "buckets": BUCKETS, "key-hash": KEY_HASH, "shards": shards}), 200
+
+@app.after_request
+def add_shard_epoch(response):
+    response.headers['X-Shard-Epoch'] = shard_epoch()
+    return response
+
 #For client request to add-member
 @app.route('/shard/add-member/<ID>', methods=['PUT'])
 def add_member(ID):
@@ -439,11 +2238,12 @@ def add_member(ID):
                 initialize_kvs(id)
         if id in list(shards.keys()) and node_id in replicas:
             # add {"node_id": shard_id} to shard_view
-            shards[id].append(node_id)
-            for replica in replicas:
-                if replica != socket_address:
-                    url = f"http://{replica}/shard/broadcast-add-member/{id}"
-                    response = requests.put(url, json=data)
+            shard_add(id, node_id) # the joining node may have registered itself already
+            persist_membership()
+            peers = [replica for replica in replicas if replica != socket_address]
+            for replica, response in fan_out(peers, lambda replica: peer_request('PUT', f"http://{replica}/shard/broadcast-add-member/{id}", json=data)).items():
+                if isinstance(response, Exception):
+                    app.logger.error(f"exception when attempting /shard/broadcast-add-member: {replica}: {response}")
             return jsonify({"result": "node added to shard"}), 200
         else:
             return jsonify({"error": "shard_id not found in shard_list or node_id not found in shard_view"}), 404
@@ -463,7 +2263,8 @@ def broadcast_add_member(ID):
                 initialize_kvs(id)
         if id in list(shards.keys()) and node_id in replicas:
             # add {"node_id": shard_id} to shard_view
-            shards[id].append(node_id)
+            shard_add(id, node_id) # the joining node may have registered itself already
+            persist_membership()
             # if(node_id == socket_address):
                 #retrieve kvs, shards, and vector clock
             return jsonify({"result": "node added to shard"}), 200
@@ -472,6 +2273,21 @@ def broadcast_add_member(ID):
     else:
         return 400 # unkown error (temporary)
 
+#A node joining shard ID registers here before copying the shard: every write this node makes from now on is
+#also replicated to it. Returns the clock at that point, the writes the joining node has to copy
+@app.route('/shard/join/<ID>', methods=['PUT'])
+def join_shard(ID):
+    id = int(ID)
+    data = request.get_json()
+    node_id = data.get('socket-address') if data else None
+    if id not in shards or node_id not in replicas:
+        return jsonify({"error": "shard_id not found in shard_list or node_id not found in shard_view"}), 404
+    with write_lock:
+        shard_add(id, node_id)
+        persist_state()
+        clock = vc.snapshot()
+    return jsonify({"message-clock": pack_clock(*clock)}), 200
+
 @app.route('/shard/reshard', methods=['PUT']) 
 def reshard():
 
@@ -480,85 +2296,306 @@ def reshard():
     if length < num_shards * 2:
         return jsonify({"error": "Not enough nodes to provide fault tolerance with requested shard count"}), 400
     else:
-        global shard_count 
-        shard_count = num_shards
-        localshard = -1
-        global shards
-        shards = {}
-        
-        #Change shards list to match reshard
-        for x in range (num_shards):
-            shards[x] = []
-        replicas.sort()
-        for x in range (len(replicas)):
-            shard = x % num_shards
-            shards[shard].append(replicas[x]) #assigns each IP a shard in the global view
-            if replicas[x] == socket_address:
-                localshard = shard    #set local shard id
+        old_shards = {shard: list(members) for shard, members in shards.items()}
+        set_shards(assign_shards(num_shards))
         
-        for replica in replicas:
-            try:
-                url = f"http://{replica}/shard/reshard/update_shards" 
-                response = requests.put(url, json={"new_shards": shards})
-            except requests.exceptions.RequestException as e:
-                app.logger.debug(f"exception raised in reshard: {e}")
+        for replica, response in fan_out(replicas, lambda replica: peer_request('PUT', f"http://{replica}/shard/reshard/update_shards", json={"new_shards": shards})).items():
+            if isinstance(response, Exception):
+                app.logger.debug(f"exception raised in reshard: {response}")
 
         #NOW ALL REPLICAS SHOULD HAVE UPDATE SHARDS{}
 
-        fullstorage = {}
-        for replica in replicas:
-            try:
-                response = requests.get(f"http://{replica}/get_fullstorage")
-                fullstorage.update(response.json())
-            except Exception as e:
-                app.logger.error(f"exception when attempting /get_fullstorage: {replica}: {e}")
-            #Map shards to their storage
-            new_storage = {shard: {} for shard in range(shard_count)}
-
-        #Redistribute keys to their corresponding shard
-        for key, value in fullstorage.items():
-            keyshard = hash_of_key(key) % shard_count
-            new_storage[keyshard][key] = value
-
-        #Update each replica with their storage based on their shard
-        for shard_id, shard_store in new_storage.items():
-            for replica in shards[shard_id]:
+        #One replica of every old shard streams its keys straight to the nodes of their new shards,
+        #the coordinator only tells it to start. Fall back to the next member if a source is down.
+        #transfer_storage fans out the chunks itself, so these run on transfer_pool, and the coordinator's own
+        #shard is transferred right here instead of through a request to itself
+        def transfer_from(old_id):
+            for source in old_shards[old_id]:
+                if source == socket_address:
+                    return transfer_storage(old_shards)
                 try:
-                    response = requests.put(f"http://{replica}/update_storage", json=shard_store)
-                except Exception as e:
-                    app.logger.error(f"exception when attempting /update_storage: {e}")
+                    response = peer_request('PUT', f"http://{source}/shard/reshard/transfer", json={"old_shards": old_shards}, timeout=None) # as long as the shard takes to stream
+                    if response.status_code == 200:
+                        return response.json()['moved']
+                except requests.exceptions.RequestException as e:
+                    app.logger.error(f"exception when attempting /shard/reshard/transfer: {source}: {e}")
+            return None
+        for old_id, moved in fan_out(old_shards, transfer_from, transfer_pool).items():
+            app.logger.debug(f"reshard: moved {moved} keys of old shard {old_id}")
+
+        #Every key now lives on its new shard, so each replica drops what it no longer owns
+        for replica, response in fan_out(replicas, lambda replica: peer_request('PUT', f"http://{replica}/shard/reshard/prune")).items():
+            if isinstance(response, Exception):
+                app.logger.error(f"exception when attempting /shard/reshard/prune: {replica}: {response}")
         return jsonify({"result": "resharded"}), 200
 
 @app.route('/shard/reshard/update_shards', methods=['PUT'])
 def update_shards():
     data = request.get_json()
-    global shards
     incomingshards = data.get('new_shards', {})
-    shards = {int(k): v for k, v in incomingshards.items()}
-    global shard_count 
-    shard_count = len(shards)
-    redistribute_keys()
+    set_shards({int(k): v for k, v in incomingshards.items()})
+    persist_membership()
+    if holdback.buffering and any(socket_address in members for members in shards.values()):
+        with write_lock: # a node that was waiting for add-member got a shard from the reshard instead
+            holdback.release()
     if shards:
         return jsonify({"result": "shards list updated"}), 200
     else:
         return jsonify({"error": "new-shard not provided"}), 400
-    
-@app.route('/update_storage', methods=['PUT'])
-def update_storage():
-    global storage
-    storage = request.get_json()
-    return jsonify({"result": "storage updated"}), 200
 
-@app.route('/get_fullstorage', methods=['GET'])
-def get_fullstorage():
-    return jsonify(storage), 200
+@app.route('/shard/reshard/transfer', methods=['PUT'])
+def reshard_transfer():
+    data = request.get_json()
+    if data and 'old_shards' in data:
+        old_shards = {int(k): v for k, v in data['old_shards'].items()}
+        return jsonify({"result": "transferred", "moved": transfer_storage(old_shards)}), 200
+    else:
+        return jsonify({"error": "Request does not contain 'old_shards'"}), 400
+
+@app.route('/shard/reshard/prune', methods=['PUT'])
+def reshard_prune():
+    return jsonify({"result": "pruned", "pruned": prune_storage()}), 200
+
+export_sessions = {} # session: (time of last page, sorted keys it covers)
+export_sessions_lock = threading.Lock()
+EXPORT_SESSION_TIMEOUT = 60 # seconds an idle export session is kept
+
+## The buckets of shard_id (or all buckets) in slice `part` of `parts`
+def export_buckets(shard_id, part, parts):
+    buckets = range(BUCKETS) if shard_id is None else ring.buckets_of(shard_id)
+    return [bucket for bucket in buckets if bucket % parts == part]
+
+## Keys of shard_id (or all keys) in slice `part` of `parts`, sorted
+def export_keys(shard_id, part, parts):
+    return sorted(storage.keys_in(export_buckets(shard_id, part, parts)))
+
+#Paginated export of local storage in key order after `cursor`, optionally only the keys of one shard and one of `parts` slices
+#of them. With a `session` the sorted key list is made once and paged through, instead of per page. With a
+#packed `clock` the donor first waits (up to CAUSAL_WAIT, else 503) until it delivered every write in it
+@app.route('/storage/export', methods=['GET'])
+def export_storage():
+    shard_id = request.args.get('shard', type=int)
+    cursor = request.args.get('cursor', '')
+    limit = request.args.get('limit', TRANSFER_CHUNK, type=int)
+    part = request.args.get('part', 0, type=int)
+    parts = request.args.get('parts', 1, type=int)
+    session = request.args.get('session')
+    if request.args.get('clock') and not handle_client_metadata({"message-clock": request.args['clock']}):
+        return jsonify({"error": "Causal dependencies not satisfied; try again later"}), 503
+    if session is None:
+        keys = heapq.nsmallest(limit + 1, (key for key in storage.keys_in(export_buckets(shard_id, part, parts)) if key > cursor))
+    else:
+        with export_sessions_lock:
+            now = time.time()
+            for expired in [name for name, (used, _) in export_sessions.items() if now - used > EXPORT_SESSION_TIMEOUT]:
+                del export_sessions[expired]
+            if session not in export_sessions:
+                export_sessions[session] = (now, export_keys(shard_id, part, parts))
+            session_keys = export_sessions[session][1]
+            export_sessions[session] = (now, session_keys)
+        start = bisect.bisect_right(session_keys, cursor) if cursor else 0
+        keys = session_keys[start:start + limit + 1]
+    page = {key: value for key, value in ((key, storage.peek(key, MISSING)) for key in keys[:limit]) if value is not MISSING}
+    versions = {key: storage.versions[key] for key in page if key in storage.versions}
+    page, packed = kvsstorage.split_values(page)
+    next_cursor = keys[limit - 1] if len(keys) > limit else None
+    if session is not None and next_cursor is None:
+        with export_sessions_lock:
+            export_sessions.pop(session, None)
+    return jsonify({"storage": page, "zlib": packed, "versions": versions, "next-cursor": next_cursor}), 200
+
+#Keys and bytes held per bucket (the non-empty ones) and per shard, from counts storage keeps as keys change
+@app.route('/storage/buckets', methods=['GET'])
+def storage_buckets():
+    buckets = {bucket: {"keys": keys, "bytes": items} for bucket, (keys, items) in storage.bucket_stats().items()}
+    totals = {shard_id: dict(zip(("keys", "bytes"), storage.bucket_totals(ring.buckets_of(shard_id)))) for shard_id in shards}
+    return jsonify({"buckets": buckets, "shards": totals, "memory": storage.memory_stats()}), 200
+
+#Chunked import into local storage, the cursor is echoed back so the sender knows where to resume
+@app.route('/storage/import', methods=['PUT'])
+def import_storage():
+    data = request.get_json()
+    if data and 'storage' in data:
+        import_items(kvsstorage.join_values(data['storage'], data.get('zlib', {})), data.get('versions', {}))
+        storage.wait_durable()
+        return jsonify({"result": "imported", "cursor": data.get('cursor')}), 200
+    else:
+        return jsonify({"error": "Request does not contain 'storage'"}), 400
+
+#Hashes of the `nodes` of one `level` of this node's hash tree (level 0 is the root)
+@app.route('/antientropy/tree', methods=['POST'])
+def antientropy_tree():
+    data = request.get_json()
+    if not data or 'level' not in data or 'nodes' not in data:
+        return jsonify({"error": "Request does not contain 'level' and 'nodes'"}), 400
+    if holdback.buffering:
+        return jsonify({"error": "Still copying the shard; try again later"}), 503
+    levels = storage.merkle_levels()
+    if not 0 <= data['level'] < len(levels):
+        return jsonify({"error": "No such level"}), 400
+    level = levels[data['level']]
+    return jsonify({"hashes": [level[node] if 0 <= node < len(level) else None for node in data['nodes']]}), 200
+
+#Versions of the keys (deleted ones included) in the given leaves of the hash tree
+@app.route('/antientropy/versions', methods=['POST'])
+def antientropy_versions():
+    data = request.get_json()
+    if not data or 'leaves' not in data:
+        return jsonify({"error": "Request does not contain 'leaves'"}), 400
+    return jsonify({"versions": storage.leaf_versions(data['leaves'])}), 200
+
+#POST reads the given keys with their versions, PUT applies the ones newer than what this node has
+@app.route('/antientropy/items', methods=['POST', 'PUT'])
+def antientropy_items():
+    data = request.get_json()
+    if request.method == 'POST':
+        if not data or 'keys' not in data:
+            return jsonify({"error": "Request does not contain 'keys'"}), 400
+        return jsonify({"items": local_items(data['keys'])}), 200
+    if not data or 'items' not in data:
+        return jsonify({"error": "Request does not contain 'items'"}), 400
+    return jsonify({"applied": apply_items(data['items'])}), 200
+
+#Runs an anti-entropy round now, with the member given as "socket-address" or a random one
+@app.route('/antientropy/sync', methods=['PUT'])
+def antientropy_sync():
+    data = request.get_json(silent=True) or {}
+    partner = anti_entropy_peer()
+    if partner is None:
+        return jsonify({"error": "No other member of this node's shard to compare with"}), 400
+    peer, shard_id = partner
+    if 'socket-address' in data:
+        if data['socket-address'] not in shards[shard_id]:
+            return jsonify({"error": "Not a member of this node's shard"}), 400
+        peer = data['socket-address']
+    try:
+        return jsonify(sync_with(peer, shard_id)), 200
+    except requests.exceptions.RequestException:
+        return jsonify({"error": f"{peer} did not answer"}), 503
+
+
+### ASYNC SERVER ###
+# SERVER_MODE=async serves the node with aiohttp instead of the Flask dev server. /kvs/<key>, the route clients
+# hit, runs on the event loop: a request for another shard is forwarded with a non-blocking client, and causal
+# dependencies and replica acks are awaited without holding a thread, so one node keeps thousands of client
+# connections open. Every other route is the same Flask route, run on one of WSGI_THREADS threads. Replication
+# stays on the per-peer outbox threads, whose number does not grow with the clients
+
+async def handle_client_metadata_async(metadata):
+    if metadata == None:
+        return True
+    try:
+        message_clock = metadata["message-clock"]
+        if isinstance(message_clock, str) and unpack_clock(message_clock)[0] not in vc.layouts: # asks the peers
+            message_clock = await asyncio.get_running_loop().run_in_executor(None, read_client_clock, message_clock)
+        else:
+            message_clock = read_client_clock(message_clock)
+    except (KeyError, ValueError):
+        return False
+    start = time.perf_counter()
+    satisfied = await clock_changed.wait_for_async(lambda: vc.is_causal(vc.align(message_clock)), CAUSAL_WAIT)
+    observe("kvs_causal_wait_seconds", time.perf_counter() - start)
+    if not satisfied:
+        count_event("kvs_causal_refusals_total")
+    return satisfied
+
+## forward_to_shard() on the event loop. Returns the status and body of the first member that answered
+async def forward_to_shard_async(peers, shard_id, method, path, **kwargs):
+    error = aiohttp.ClientConnectionError(f"Shard {shard_id} has no members. // forward_to_shard_async()")
+    for member in forward_order(shard_id):
+        start = forward_started(member)
+        try:
+            async with peers.request(method, f'http://{member}{path}', **kwargs) as response:
+                body = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            forward_failed(member, e)
+            error = e
+            continue
+        forward_succeeded(member, start)
+        return response.status, body
+    raise error
+
+## Same as kvs(), returns the response body and status
+async def kvs_async_response(peers, method, key, data):
+    if len(key) > 50:
+        return {"error": "Key is too long"}, 400
+    shard_id = hash_of_key(key)
+    if not serves(shard_id):
+        if method == 'GET' and isinstance(data, dict) and 'causal-metadata' in data:
+            cached = remote_cache.lookup(key, data['causal-metadata'])
+            if cached is not None:
+                return cached, 200
+        ticket = remote_cache.ticket()
+        try:
+            status, body = await forward_to_shard_async(peers, shard_id, method, f"/kvs/{key}", json=data)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return {"error": "Cannot forward request"}, 503
+        body = json.loads(body)
+        if method == 'GET' and status == 200:
+            remote_cache.keep(key, ticket, body)
+        return body, status
+    error = kvs_request_error(method, data)
+    if error:
+        return error
+    if not await handle_client_metadata_async(data['causal-metadata']):
+        return {"error": "Causal dependencies not satisfied; try again later"}, 503
+    body, status, waits = kvs_serve(method, key, data, shard_id)
+    if waits is not None:
+        if storage.persistent:
+            await asyncio.get_running_loop().run_in_executor(None, storage.wait_durable)
+        for acks, needed in waits:
+            await acks.wait_async(needed)
+    return body, status
+
+async def kvs_async(request):
+    start = time.perf_counter()
+    try:
+        data = json.loads(await request.read() or b'null')
+    except ValueError:
+        data = None
+    body, status = await kvs_async_response(request.app['peers'], request.method, request.match_info['key'], data)
+    observe("kvs_request_seconds", time.perf_counter() - start, route='/kvs/<key>', method=request.method)
+    count_request('/kvs/<key>', request.method, status)
+    return web.json_response(body, status=status, headers={'X-Shard-Epoch': shard_epoch()})
+
+## Runs the Flask app for a request on a WSGI thread
+async def wsgi_async(request):
+    environ = EnvironBuilder(path=request.rel_url.raw_path, query_string=request.rel_url.raw_query_string, method=request.method, headers=list(request.headers.items()),
+            data=await request.read()).get_environ()
+    environ['REMOTE_ADDR'] = request.remote or ''
+    def call():
+        app_iter, status, headers = run_wsgi_app(app, environ, buffered=True)
+        try:
+            return int(status.split(' ', 1)[0]), headers, b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(request.app['wsgi'], call)
+    headers = {name: value for name, value in headers.items() if name.lower() not in ('content-length', 'transfer-encoding', 'connection')}
+    return web.Response(status=status, headers=headers, body=body)
+
+def serve_async(host, port):
+    if aiohttp is None:
+        raise RuntimeError("SERVER_MODE=async needs aiohttp (pip install aiohttp). // serve_async()")
+    async def open_peers(web_app):
+        web_app['peers'] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=ASYNC_PEER_CONNECTIONS),
+                timeout=aiohttp.ClientTimeout(total=PEER_TIMEOUT, sock_connect=PEER_CONNECT_TIMEOUT))
+    async def close_peers(web_app):
+        await web_app['peers'].close()
+    web_app = web.Application(client_max_size=64 * 1024 * 1024)
+    web_app['wsgi'] = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+    web_app.on_startup.append(open_peers)
+    web_app.on_cleanup.append(close_peers)
+    for method in ('GET', 'PUT', 'DELETE'):
+        web_app.router.add_route(method, '/kvs/{key}', kvs_async)
+    web_app.router.add_route('*', '/{path:.*}', wsgi_async)
+    web.run_app(web_app, host=host, port=int(port), backlog=4096, print=None, access_log=None)
 
 
 if __name__ == '__main__':
-    storage = {}
+    storage = kvsstorage.open_storage(STORAGE_ENGINE, DATA_DIR, bucket_of)
     replicas = [] #List of all replica addresses
-    shards = {}
-    shard_count = 0
+    set_shards({})
     try:
         socket_address = os.environ.get('SOCKET_ADDRESS')
         viewenv = os.environ.get('VIEW').split(',')
@@ -570,21 +2607,50 @@ if __name__ == '__main__':
     #On initial startup, all nodes are given shardcount, but afterwards, nodes must be assigned
     try:
         shard_count = int(os.environ.get('SHARD_COUNT'))
-        shards = {i: [] for i in range(shard_count)} #initializes shards list, maps shard_count amount of shards to empty lists
+        initial_shards = {i: [] for i in range(shard_count)} #initializes shards list, maps shard_count amount of shards to empty lists
         shard_id = 0
         #Iterate through our shard dictionary adding each node to one shard at a time for even distribution
         for replica in replicas:
             if shard_id == shard_count:
                 shard_id = 0
-            shards[shard_id].append(replica)
+            initial_shards[shard_id].append(replica)
             shard_id += 1
+        set_shards(initial_shards)
         print(shards)
     except:
-        shards = {}
+        set_shards({})
         print("Shard_count not specified, wait for add-member request")
+
+    #Restarted on its own data (STORAGE_ENGINE=log): take back the clock and shard map it had
+    saved = storage.load_state()
+    if saved:
+        vc.clock, saved_shards = saved
+        set_shards(saved_shards)
+        app.logger.info(f"Recovered {len(storage)} keys from {DATA_DIR}, shards: {shards}")
+    lamport = max((version[0] for version in storage.versions.values()), default=0)
+    persist_membership()
+    #Replica messages storage kept from before the restart go out again first, in the order they were queued
+    for peer, messages in storage.queued_messages().items():
+        if peer not in replicas:
+            storage.drop_messages(peer)
+            continue
+        for message_id, (method, url, data, clock) in messages:
+            outbox_for(peer).put(method, url, data, Acks([peer]), clock and tuple(clock), message_id)
+    #A node outside every shard waits for add-member. Replica messages that reach it before it copied its
+    #shard are buffered until then (initialize_kvs())
+    holdback.buffering = not any(socket_address in members for members in shards.values())
     
         
+    if REPLICA_TRANSPORT == 'frames': # listening before any peer learns about this node
+        serve_frames(*frame_address(socket_address))
     #Load environment variables and VectorClock
     broadcast_put_view(socket_address)
+    if METADATA_INTERVAL > 0:
+        threading.Thread(target=flush_metadata, name='flush-metadata', daemon=True).start()
+    if ANTI_ENTROPY_INTERVAL > 0:
+        threading.Thread(target=anti_entropy, name='anti-entropy', daemon=True).start()
     host, port = os.getenv("SOCKET_ADDRESS").split(':')
-    app.run(host=host, port=port)
+    if SERVER_MODE == 'async':
+        serve_async(host, port)
+    else:
+        app.run(host=host, port=port)
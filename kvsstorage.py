@@ -0,0 +1,700 @@
+###################
+# Storage engines behind kvsservice's `storage`. Both are dicts, so the service reads and writes them like the
+# plain dict it used to have; the log engine also writes every change to disk. Both keep a version per key,
+# a hash tree over their items for anti-entropy between replicas, and the keys of every hash bucket
+# (kvsring.bucket_of()) with their count and bytes, so a shard's keys are found without scanning the others.
+###################
+
+import base64
+import collections
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+SYNC_INTERVAL = float(os.environ.get('SYNC_INTERVAL', 0.005)) # seconds a group of writes waits for others to share its fsync
+SNAPSHOT_RECORDS = int(os.environ.get('SNAPSHOT_RECORDS', 100000)) # log records after which the log is compacted into a snapshot
+MERKLE_LEAVES = int(os.environ.get('MERKLE_LEAVES', 1024)) # leaf buckets of the hash tree
+MERKLE_FANOUT = 32 # children per inner node of the hash tree
+COMPRESS_THRESHOLD = int(os.environ.get('COMPRESS_THRESHOLD', 512)) # JSON bytes from which a value is kept zlib-compressed, 0 to never compress
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6)) # zlib level, 1 fastest to 9 smallest
+MEMORY_BUDGET = int(os.environ.get('MEMORY_BUDGET', 0)) # bytes of items (as JSON) kept in memory, the least recently used values past it go to a spill file; 0 for no limit
+SPILL_COMPACT_BYTES = int(os.environ.get('SPILL_COMPACT_BYTES', 64 * 1024 * 1024)) # dead bytes in the spill file before it is rewritten
+
+
+# A value kept as its JSON, zlib-compressed. The node a client wrote it to compresses it once, and from then on it
+# stays compressed in storage, in the log, in replica messages and when shards move, until a client reads it.
+# Between nodes it travels base64-encoded under "zlib" instead of "value" (value_fields()), so no client value
+# can be taken for a compressed one
+class Compressed(bytes):
+    def value(self):
+        return json.loads(zlib.decompress(self))
+
+    def wire(self):
+        return base64.b64encode(self).decode('ascii')
+
+    @classmethod
+    def from_wire(cls, text):
+        return cls(base64.b64decode(text))
+
+
+## Returns value as Compressed if its JSON has at least COMPRESS_THRESHOLD bytes and gets smaller, value otherwise.
+## Also returns the JSON's size, for the compression ratio
+def compress(value):
+    if isinstance(value, Compressed) or COMPRESS_THRESHOLD <= 0:
+        return value, 0
+    encoded = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(encoded) < COMPRESS_THRESHOLD:
+        return value, len(encoded)
+    packed = zlib.compress(encoded, COMPRESS_LEVEL)
+    return (Compressed(packed) if len(packed) < len(encoded) else value), len(encoded)
+
+def decompress(value):
+    return value.value() if isinstance(value, Compressed) else value
+
+## {"value": value}, or {"zlib": base64} for a Compressed value: how a value goes between nodes in JSON
+def value_fields(value):
+    if isinstance(value, Compressed):
+        return {"zlib": value.wire()}
+    return {"value": value}
+
+## The value in fields that value_fields() made. Raises KeyError if it has neither
+def value_from(fields):
+    if "zlib" in fields:
+        return Compressed.from_wire(fields["zlib"])
+    return fields["value"]
+
+## {key: value} as ({key: value}, {key: base64}), the plain and the compressed values, for pages of storage
+def split_values(values):
+    plain, packed = {}, {}
+    for key, value in values.items():
+        if isinstance(value, Compressed):
+            packed[key] = value.wire()
+        else:
+            plain[key] = value
+    return plain, packed
+
+def join_values(plain, packed):
+    values = dict(plain)
+    values.update((key, Compressed.from_wire(text)) for key, text in packed.items())
+    return values
+
+def leaf_of(key):
+    return zlib.crc32(key.encode('utf-8')) % MERKLE_LEAVES
+
+def encode_item(key, value):
+    if isinstance(value, Compressed):
+        value = {"zlib": value.wire()}
+    return json.dumps([key, value], sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+def item_hash(encoded):
+    return int.from_bytes(hashlib.md5(encoded).digest()[:8], 'big')
+
+def default_bucket_of(key):
+    return zlib.crc32(key.encode('utf-8')) % 4096
+
+
+# Stands in the dict for a value evicted to the spill file: where its record is, and the hash and size of its item,
+# so the hash tree and the bucket bytes are kept without reading it back
+class Spilled:
+    __slots__ = ('offset', 'length', 'hash', 'size')
+
+    def __init__(self, offset, length, hash, size):
+        self.offset = offset
+        self.length = length
+        self.hash = hash
+        self.size = size
+
+
+# Keeps everything in memory, a restarted node comes back empty.
+# `leaves` holds the XOR of item_hash() over the items of every leaf bucket and is updated on every change, so
+# two replicas with the same items have the same leaves whatever order the writes came in. `versions` maps a key
+# to the [lamport time, writer] of its last write, deleted keys keep theirs as a tombstone.
+# Every key is put in its bucket by `bucket_of` when it is written. `bucket_keys` holds the keys (and
+# `bucket_versions` the versioned keys, tombstones included) of every non-empty bucket, `bucket_bytes` the size of
+# their items encoded as JSON.
+# With a `budget` (MEMORY_BUDGET) the items kept in memory stay under that many bytes: past it the least recently
+# used values are appended to a spill file in `spill_dir`, unlinked as soon as it is opened, and a Spilled marker
+# takes their place. Reading a spilled value brings it back into memory. `recent` orders the values in memory,
+# least recently used first, and `bucket_spilled` / `bucket_spilled_bytes` count the spilled items per bucket.
+# Keys are interned, so storage, versions and buckets share one string per key
+class MemoryStorage(dict):
+    persistent = False
+
+    def __init__(self, *args, bucket_of=default_bucket_of, budget=None, spill_dir=None, **kwargs):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.bucket_of = bucket_of
+        self.versions = {}
+        self.leaves = [0] * MERKLE_LEAVES
+        self.bucket_keys = collections.defaultdict(set)
+        self.bucket_versions = collections.defaultdict(set)
+        self.bucket_bytes = collections.Counter()
+        self.budget = MEMORY_BUDGET if budget is None else budget
+        self.spill_dir = spill_dir or tempfile.gettempdir()
+        self.recent = collections.OrderedDict() # key: item size, only with a budget
+        self.resident_bytes = 0
+        self.bucket_spilled = collections.Counter()
+        self.bucket_spilled_bytes = collections.Counter()
+        self.spill_file = None # file descriptor
+        self.spill_end = 0
+        self.spill_live = 0 # bytes of the records still in use
+        for key, value in dict(*args, **kwargs).items():
+            self.put(key, value)
+
+    # put() and drop() change the dict, its leaf and its bucket, must be called with self.lock held (or before sharing)
+    def put(self, key, value):
+        key = sys.intern(key)
+        leaf = leaf_of(key)
+        bucket = self.bucket_of(key)
+        encoded = encode_item(key, value)
+        if key in self:
+            old_hash, old_size = self.release(key, bucket, dict.__getitem__(self, key))
+            self.leaves[leaf] ^= old_hash
+            self.bucket_bytes[bucket] -= old_size
+        else:
+            self.bucket_keys[bucket].add(key)
+        self.leaves[leaf] ^= item_hash(encoded)
+        self.bucket_bytes[bucket] += len(encoded)
+        dict.__setitem__(self, key, value)
+        if self.budget:
+            self.recent[key] = len(encoded)
+            self.resident_bytes += len(encoded)
+            self.evict()
+
+    def drop(self, key):
+        value = dict.pop(self, key)
+        bucket = self.bucket_of(key)
+        if isinstance(value, Spilled):
+            marker, value = value, self.load(value)
+            self.release(key, bucket, marker)
+            old_hash, old_size = marker.hash, marker.size
+        else:
+            old_hash, old_size = self.release(key, bucket, value)
+        self.leaves[leaf_of(key)] ^= old_hash
+        self.bucket_keys[bucket].discard(key)
+        self.bucket_bytes[bucket] -= old_size
+        if not self.bucket_keys[bucket]:
+            del self.bucket_keys[bucket]
+            del self.bucket_bytes[bucket]
+        return value
+
+    # Takes a value that is being replaced or dropped out of the spill or recent bookkeeping. Returns its item's
+    # hash and size
+    def release(self, key, bucket, value):
+        if isinstance(value, Spilled):
+            self.bucket_spilled[bucket] -= 1
+            self.bucket_spilled_bytes[bucket] -= value.size
+            if not self.bucket_spilled[bucket]:
+                del self.bucket_spilled[bucket]
+                del self.bucket_spilled_bytes[bucket]
+            self.spill_live -= value.length
+            return value.hash, value.size
+        encoded = encode_item(key, value)
+        size = self.recent.pop(key, None)
+        if size is not None:
+            self.resident_bytes -= size
+        return item_hash(encoded), len(encoded)
+
+    # Moves the least recently used values to the spill file until the rest fit the budget
+    def evict(self):
+        while self.resident_bytes > self.budget and self.recent:
+            key, size = self.recent.popitem(last=False)
+            self.resident_bytes -= size
+            value = dict.__getitem__(self, key)
+            encoded = encode_item(key, value)
+            record = b'z' + value if isinstance(value, Compressed) else b'j' + encoded
+            os.write(self.spill(), record)
+            dict.__setitem__(self, key, Spilled(self.spill_end, len(record), item_hash(encoded), len(encoded)))
+            self.spill_end += len(record)
+            self.spill_live += len(record)
+            bucket = self.bucket_of(key)
+            self.bucket_spilled[bucket] += 1
+            self.bucket_spilled_bytes[bucket] += len(encoded)
+        if self.spill_end - self.spill_live > SPILL_COMPACT_BYTES:
+            self.compact_spill()
+
+    def spill(self):
+        if self.spill_file is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_file, path = tempfile.mkstemp(prefix='spill-', suffix='.dat', dir=self.spill_dir)
+            os.unlink(path) # lives as long as the process, a restarted node has no use for it
+        return self.spill_file
+
+    def load(self, marker):
+        record = os.pread(self.spill_file, marker.length, marker.offset)
+        if record[:1] == b'z':
+            return Compressed(record[1:])
+        return json.loads(record[1:])[1]
+
+    # Copies the records still in use to a new spill file
+    def compact_spill(self):
+        old, self.spill_file = self.spill_file, None
+        self.spill_end = self.spill_live = 0
+        for key, marker in [(key, value) for key, value in dict.items(self) if isinstance(value, Spilled)]:
+            os.write(self.spill(), os.pread(old, marker.length, marker.offset))
+            dict.__setitem__(self, key, Spilled(self.spill_end, marker.length, marker.hash, marker.size))
+            self.spill_end += marker.length
+            self.spill_live += marker.length
+        os.close(old)
+
+    # The value of key, read back into memory if it was spilled. With `touch` it becomes the most recently used
+    def read(self, key, default=None, touch=True):
+        if not self.budget:
+            return dict.get(self, key, default)
+        with self.lock:
+            if key not in self:
+                return default
+            value = dict.__getitem__(self, key)
+            if isinstance(value, Spilled):
+                if not touch:
+                    return self.load(value)
+                marker, value = value, self.load(value)
+                self.release(key, self.bucket_of(key), marker)
+                dict.__setitem__(self, key, value)
+                self.recent[key] = marker.size
+                self.resident_bytes += marker.size
+                self.evict()
+            elif touch:
+                self.recent.move_to_end(key)
+            return value
+
+    def __getitem__(self, key):
+        value = self.read(key, Spilled)
+        if value is Spilled:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.read(key, default)
+
+    # The value of key without counting it as used, for copies of storage that would otherwise push out hot values
+    def peek(self, key, default=None):
+        return self.read(key, default, touch=False)
+
+    # a list copy, so callers can go through it while writers change the dict
+    def items(self):
+        with self.lock:
+            return self.loaded_items() if self.budget else list(dict.items(self))
+
+    # (key, value) of every item, spilled values read back without keeping them. Must be called with self.lock held
+    def loaded_items(self):
+        return [(key, self.load(value) if isinstance(value, Spilled) else value) for key, value in dict.items(self)]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.put(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.drop(key)
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                return dict.pop(self, key, *default)
+            return self.drop(key)
+
+    def update(self, other=(), **kwargs):
+        with self.lock:
+            for key, value in dict(other, **kwargs).items():
+                self.put(key, value)
+
+    def set_version(self, key, version):
+        with self.lock:
+            self.tag_version(key, version)
+
+    # drop the version (or tombstone) of a key this node no longer keeps
+    def forget(self, key):
+        with self.lock:
+            self.untag_version(key)
+
+    # tag_version() and untag_version() change the versions and their buckets, must be called with self.lock held
+    def tag_version(self, key, version):
+        key = sys.intern(key)
+        self.versions[key] = version
+        self.bucket_versions[self.bucket_of(key)].add(key)
+
+    def untag_version(self, key):
+        if self.versions.pop(key, None) is None:
+            return False
+        bucket = self.bucket_of(key)
+        self.bucket_versions[bucket].discard(key)
+        if not self.bucket_versions[bucket]:
+            del self.bucket_versions[bucket]
+        return True
+
+    # The keys in `buckets`
+    def keys_in(self, buckets):
+        with self.lock:
+            return [key for bucket in buckets if bucket in self.bucket_keys for key in self.bucket_keys[bucket]]
+
+    # (spilled keys, their bytes) in `buckets`
+    def spill_totals(self, buckets):
+        keys = items = 0
+        with self.lock:
+            for bucket in buckets:
+                if bucket in self.bucket_spilled:
+                    keys += self.bucket_spilled[bucket]
+                    items += self.bucket_spilled_bytes[bucket]
+        return keys, items
+
+    # The budget and the keys and bytes in memory and spilled
+    def memory_stats(self):
+        with self.lock:
+            spilled, spilled_bytes = sum(self.bucket_spilled.values()), sum(self.bucket_spilled_bytes.values())
+            return {"budget": self.budget, "resident-keys": len(self) - spilled, "resident-bytes": sum(self.bucket_bytes.values()) - spilled_bytes,
+                    "spilled-keys": spilled, "spilled-bytes": spilled_bytes, "spill-file-bytes": self.spill_end}
+
+    # (keys, bytes) in `buckets`, without looking at any key
+    def bucket_totals(self, buckets):
+        keys = items = 0
+        with self.lock:
+            for bucket in buckets:
+                if bucket in self.bucket_keys:
+                    keys += len(self.bucket_keys[bucket])
+                    items += self.bucket_bytes[bucket]
+        return keys, items
+
+    # {bucket: (keys, bytes)} of the buckets holding keys
+    def bucket_stats(self):
+        with self.lock:
+            return {bucket: (len(keys), self.bucket_bytes[bucket]) for bucket, keys in self.bucket_keys.items()}
+
+    # Buckets holding keys or versions
+    def held_buckets(self):
+        with self.lock:
+            return set(self.bucket_keys) | set(self.bucket_versions)
+
+    # Drops every key and version in `buckets`, for buckets that moved to another shard. Returns how many keys
+    def drop_buckets(self, buckets):
+        keys = self.keys_in(buckets)
+        for key in keys:
+            self.pop(key, None)
+        with self.lock:
+            versioned = [key for bucket in buckets if bucket in self.bucket_versions for key in self.bucket_versions[bucket]]
+        for key in versioned:
+            self.forget(key)
+        return len(keys)
+
+    # Hashes of the hash tree, level 0 is the root and the last level are the leaves
+    def merkle_levels(self):
+        levels = [['%016x' % leaf for leaf in self.leaves]]
+        while len(levels[0]) > 1:
+            below = levels[0]
+            levels.insert(0, [hashlib.md5(''.join(below[start:start + MERKLE_FANOUT]).encode('utf-8')).hexdigest()[:16]
+                    for start in range(0, len(below), MERKLE_FANOUT)])
+        return levels
+
+    # {key: version} of the items and tombstones in the given leaves, None for an item without a version
+    def leaf_versions(self, leaves):
+        leaves = set(leaves)
+        with self.lock:
+            keys = set(dict.keys(self)) | set(self.versions)
+            return {key: self.versions.get(key) for key in keys if leaf_of(key) in leaves}
+
+    # (clock, shards) saved with the data, None if nothing was saved
+    def load_state(self):
+        return None
+
+    # Record the vector clock (a VectorClock) and shard map the data belongs to
+    def save_state(self, vc, shards):
+        pass
+
+    # Block until every change made so far would survive a crash
+    def wait_durable(self):
+        pass
+
+    # Replica messages queued for peers, kept by an engine that survives a restart so they can be sent again.
+    # queue_message() returns an id for message_delivered() once the peer took it
+    def queue_message(self, peer, message):
+        return None
+
+    def message_delivered(self, peer, message_id):
+        pass
+
+    # forget every message queued for a peer that left
+    def drop_messages(self, peer):
+        pass
+
+    # {peer: [(message id, message), ...]} of the messages not delivered yet, in the order they were queued
+    def queued_messages(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+def put_record(key, value):
+    if isinstance(value, Compressed):
+        return ['z', key, value.wire()]
+    return ['p', key, value]
+
+
+# Appends every change to log-<generation>.jsonl in data_dir, one JSON array per line:
+#   ["p", key, value]  put           ["z", key, base64]  put of a Compressed value        ["d", key]  delete
+#   ["c", {address: count}]  clock counters that changed      ["C", {address: count}]  whole clock
+#   ["s", {shard id: [addresses]}]  shard map      ["v", key, version]  version      ["f", key]  version dropped
+#   ["q", peer, id, message]  replica message queued     ["a", peer, id]  message delivered     ["x", peer]  peer's messages dropped
+# A syncer thread fsyncs the log for a whole group of writes at once. Once SNAPSHOT_RECORDS records pile up
+# the log moves to the next generation and the data as of the end of the old log is written to
+# snapshot-<next generation>.json, after which older files are deleted. Opening the directory loads the
+# newest snapshot and replays the logs from its generation on, a torn last line is ignored
+class LogStorage(MemoryStorage):
+    persistent = True
+
+    def __init__(self, data_dir, bucket_of=default_bucket_of, budget=None):
+        super().__init__(bucket_of=bucket_of, budget=budget, spill_dir=data_dir)
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.synced_changed = threading.Condition(self.lock)
+        self.clock = {}
+        self.shards = {}
+        self.queued = {} # peer: {message id: message} not delivered yet
+        self.next_message = 0
+        self.records = 0 # records since the last snapshot
+        self.written = 0 # records appended since opening
+        self.synced = 0 # records fsynced since opening
+        self.generation = self.recover()
+        self.log = open(self.path('log', self.generation), 'a', encoding='utf-8')
+        self.closed = False
+        self.syncer = threading.Thread(target=self.sync_loop, name='storage-sync', daemon=True)
+        self.syncer.start()
+
+    def path(self, kind, generation):
+        return os.path.join(self.data_dir, f'{kind}-{generation:08d}.{"json" if kind == "snapshot" else "jsonl"}')
+
+    def generations(self, kind):
+        suffix = '.json' if kind == 'snapshot' else '.jsonl'
+        return sorted(int(name[len(kind) + 1:-len(suffix)]) for name in os.listdir(self.data_dir)
+                if name.startswith(kind + '-') and name.endswith(suffix))
+
+    # Load the newest snapshot and replay the logs written after it. Returns the generation to write next
+    def recover(self):
+        snapshots = self.generations('snapshot')
+        base = snapshots[-1] if snapshots else 0
+        if snapshots:
+            with open(self.path('snapshot', base), 'rb') as snapshot:
+                state = json.loads(snapshot.read())
+            for key, value in join_values(state["storage"], state.get("zlib", {})).items():
+                self.put(key, value)
+            for key, version in state.get("versions", {}).items():
+                self.tag_version(key, version)
+            self.clock = state["clock"]
+            self.shards = state["shards"]
+            for peer, messages in state.get("queued", {}).items():
+                for message_id, message in messages:
+                    self.replay(['q', peer, message_id, message])
+        logs = [generation for generation in self.generations('log') if generation >= base]
+        for generation in logs:
+            with open(self.path('log', generation), 'r', encoding='utf-8') as log:
+                for line in log:
+                    try:
+                        record = json.loads(line)
+                    except ValueError: # torn write at the end of the log
+                        break
+                    self.replay(record)
+                    self.records += 1
+        return (logs[-1] if logs else base) + 1
+
+    def replay(self, record):
+        kind = record[0]
+        if kind == 'p':
+            self.put(record[1], record[2])
+        elif kind == 'z':
+            self.put(record[1], Compressed.from_wire(record[2]))
+        elif kind == 'd':
+            if record[1] in self:
+                self.drop(record[1])
+        elif kind == 'v':
+            self.tag_version(record[1], record[2])
+        elif kind == 'f':
+            self.untag_version(record[1])
+        elif kind == 'c':
+            self.clock.update(record[1])
+        elif kind == 'C':
+            self.clock = record[1]
+        elif kind == 's':
+            self.shards = record[1]
+        elif kind == 'q':
+            self.queued.setdefault(record[1], {})[record[2]] = record[3]
+            self.next_message = max(self.next_message, record[2] + 1)
+        elif kind == 'a':
+            self.queued.get(record[1], {}).pop(record[2], None)
+        elif kind == 'x':
+            self.queued.pop(record[1], None)
+
+    # must be called with self.lock held
+    def append(self, record):
+        self.log.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.written += 1
+        self.records += 1
+        self.synced_changed.notify_all()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.put(key, value)
+            self.append(put_record(key, value))
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self:
+                raise KeyError(key)
+            self.drop(key)
+            self.append(['d', key])
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                return dict.pop(self, key, *default)
+            value = self.drop(key)
+            self.append(['d', key])
+            return value
+
+    def update(self, other=(), **kwargs):
+        with self.lock:
+            for key, value in dict(other, **kwargs).items():
+                self.put(key, value)
+                self.append(put_record(key, value))
+
+    def set_version(self, key, version):
+        with self.lock:
+            self.tag_version(key, version)
+            self.append(['v', key, version])
+
+    def forget(self, key):
+        with self.lock:
+            if self.untag_version(key):
+                self.append(['f', key])
+
+    def load_state(self):
+        if not self.clock and not self.shards:
+            return None
+        return dict(self.clock), {int(shard_id): members for shard_id, members in self.shards.items()}
+
+    def save_state(self, vc, shards):
+        clock = vc.clock
+        with self.lock:
+            if clock.keys() != self.clock.keys():
+                self.append(['C', clock])
+            else:
+                changed = {address: count for address, count in clock.items() if self.clock[address] != count}
+                if changed:
+                    self.append(['c', changed])
+            self.clock = clock
+            shards = {str(shard_id): list(members) for shard_id, members in shards.items()}
+            if shards != self.shards:
+                self.append(['s', shards])
+                self.shards = shards
+
+    def queue_message(self, peer, message):
+        with self.lock:
+            message_id = self.next_message
+            self.next_message += 1
+            self.queued.setdefault(peer, {})[message_id] = message
+            self.append(['q', peer, message_id, message])
+            return message_id
+
+    def message_delivered(self, peer, message_id):
+        with self.lock:
+            if self.queued.get(peer, {}).pop(message_id, None) is not None:
+                self.append(['a', peer, message_id])
+
+    def drop_messages(self, peer):
+        with self.lock:
+            if self.queued.pop(peer, None):
+                self.append(['x', peer])
+
+    def queued_messages(self):
+        with self.lock:
+            return {peer: sorted(messages.items()) for peer, messages in self.queued.items() if messages}
+
+    def wait_durable(self):
+        with self.synced_changed:
+            target = self.written
+            self.synced_changed.wait_for(lambda: self.synced >= target or self.closed)
+
+    # Every time records are waiting, give other writers SYNC_INTERVAL to join, then fsync all of them at once
+    def sync_loop(self):
+        while True:
+            with self.synced_changed:
+                self.synced_changed.wait_for(lambda: self.written > self.synced or self.closed)
+                if self.closed:
+                    return
+            time.sleep(SYNC_INTERVAL)
+            with self.lock:
+                if self.closed:
+                    return
+                log = self.log
+                log.flush()
+                target = self.written
+                snapshot = self.records >= SNAPSHOT_RECORDS
+            try:
+                os.fsync(log.fileno())
+            except (OSError, ValueError): # closed meanwhile, close() synced it
+                return
+            with self.synced_changed:
+                self.synced = max(self.synced, target)
+                self.synced_changed.notify_all()
+            if snapshot:
+                self.snapshot()
+
+    # Start the next log generation and write everything up to the end of the old log as its snapshot.
+    # Writers wait for the copy of the dict and the fsync of the old log, the snapshot is written on its own
+    # thread. The old log is synced before the swap: sync_loop() only syncs the current log, so records
+    # written to the old one since its last sync would otherwise count as synced with the new one's
+    def snapshot(self):
+        with self.lock:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.synced = self.written
+            self.synced_changed.notify_all()
+            plain, packed = split_values(dict(self.loaded_items())) # reads the spilled values back
+            state = {"storage": plain, "zlib": packed, "versions": dict(self.versions), "clock": dict(self.clock), "shards": dict(self.shards),
+                    "queued": {peer: list(messages.items()) for peer, messages in self.queued.items() if messages}}
+            old_log = self.log
+            self.generation += 1
+            self.log = open(self.path('log', self.generation), 'a', encoding='utf-8')
+            self.records = 0
+        threading.Thread(target=self.write_snapshot, args=(state, old_log, self.generation), name='storage-snapshot', daemon=True).start()
+
+    def write_snapshot(self, state, old_log, generation):
+        old_log.close()
+        temporary = self.path('snapshot', generation) + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as snapshot:
+            json.dump(state, snapshot, separators=(',', ':'))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.path('snapshot', generation))
+        for kind in ('snapshot', 'log'):
+            for old in self.generations(kind):
+                if old < generation:
+                    os.remove(self.path(kind, old))
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            self.log.close()
+            self.synced = self.written
+            self.synced_changed.notify_all()
+
+
+STORAGE_ENGINES = {'memory': MemoryStorage, 'log': LogStorage}
+
+## Returns a new `engine` storage that buckets keys with bucket_of(key), the log engine keeps its files in data_dir
+def open_storage(engine, data_dir, bucket_of=default_bucket_of):
+    if engine not in STORAGE_ENGINES:
+        raise ValueError(f"Storage engine: {engine} is not one of {', '.join(STORAGE_ENGINES)}. // open_storage()")
+    if engine == 'memory':
+        return MemoryStorage(bucket_of=bucket_of, spill_dir=data_dir)
+    return LogStorage(data_dir, bucket_of=bucket_of)
@@ -0,0 +1,1327 @@
+###################
+# Unit tests for kvsservice.py that run without docker.
+# Run with: python -m unittest test_kvsservice
+###################
+
+import asyncio
+import collections
+import http.server
+import itertools
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import kvsclient
+import kvsservice
+import kvsstorage
+from kvsservice import HashRing
+
+
+class TestHashRing(unittest.TestCase):
+
+    key_count = 20000
+
+    def test_a_keys_spread_evenly(self):
+        '''Does every shard own close to an equal share of the keys?'''
+        for shard_count in (2, 3, 5):
+            ring = HashRing(range(shard_count))
+            counts = collections.Counter(ring.shard_for('key{}'.format(n)) for n in range(self.key_count))
+            equal_share = self.key_count / shard_count
+            for shard_id in range(shard_count):
+                with self.subTest(msg='shard {} of {}'.format(shard_id, shard_count)):
+                    self.assertLess(equal_share * 0.85, counts[shard_id])
+                    self.assertLess(counts[shard_id], equal_share * 1.15)
+
+    def test_b_moved_key_fraction(self):
+        '''Does adding one shard move only about 1/(N+1) of the keys, and only onto the new shard?'''
+        keys = ['key{}'.format(n) for n in range(self.key_count)]
+        for shard_count in range(1, 8):
+            before = HashRing(range(shard_count))
+            after = HashRing(range(shard_count + 1))
+            moved = [key for key in keys if before.shard_for(key) != after.shard_for(key)]
+            fraction = len(moved) / len(keys)
+            with self.subTest(msg='{} -> {} shards'.format(shard_count, shard_count + 1)):
+                self.assertGreater(fraction, 0.8 / (shard_count + 1))
+                self.assertLess(fraction, 1.2 / (shard_count + 1))
+                self.assertTrue(all(after.shard_for(key) == shard_count for key in moved))
+
+    def test_c_empty_ring(self):
+        with self.assertRaises(KeyError):
+            HashRing([]).shard_for('key0')
+
+
+class TestAssignShards(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.replicas = ['10.10.0.{}:8090'.format(n) for n in range(2, 9)]
+        kvsservice.set_shards({0: kvsservice.replicas[0:4:2] + kvsservice.replicas[4:5], 1: kvsservice.replicas[1:4:2] + kvsservice.replicas[5:7]})
+
+    def test_a_grow_keeps_members(self):
+        '''Does a reshard from 2 to 3 shards leave every node it can in its old shard?'''
+        old_shards = {shard: list(members) for shard, members in kvsservice.shards.items()}
+        new_shards = kvsservice.assign_shards(3)
+        self.assertEqual(sorted(sum(new_shards.values(), [])), sorted(kvsservice.replicas))
+        self.assertEqual(sorted(len(members) for members in new_shards.values()), [2, 2, 3])
+        stayed = sum(len(set(old_shards[shard]) & set(new_shards[shard])) for shard in old_shards)
+        self.assertEqual(stayed, 5)
+
+    def test_b_shrink(self):
+        new_shards = kvsservice.assign_shards(1)
+        self.assertEqual(sorted(new_shards[0]), sorted(kvsservice.replicas))
+
+
+class TestPeerConnections(unittest.TestCase):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # keep-alive, like the threaded flask server
+        def do_GET(self):
+            body = b'{"result": "ok"}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.address = '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_a_connections_are_reused(self):
+        '''Do repeated calls to one peer share a single keep-alive connection?'''
+        before = dict(kvsservice.connection_stats)
+        for _ in range(10):
+            response = kvsservice.peer_request('GET', 'http://{}/view'.format(self.address))
+            self.assertEqual(response.json(), {'result': 'ok'})
+        self.assertEqual(kvsservice.connection_stats['requests'] - before['requests'], 10)
+        self.assertEqual(kvsservice.connection_stats['new-connections'] - before['new-connections'], 1)
+
+
+class TestForwarding(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TestPeerConnections.Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.live = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.dead = '127.0.0.1:1' # nothing listens there, connecting is refused
+        kvsservice.socket_address = '127.0.0.1:9999'
+        kvsservice.peer_health.clear()
+        kvsservice.forward_turns.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_a_members_take_turns(self):
+        '''Without load or failures, does every other member of the shard get the same share of requests?'''
+        members = ['10.10.0.{}:8090'.format(n) for n in range(2, 5)]
+        kvsservice.set_shards({0: [kvsservice.socket_address] + members})
+        firsts = collections.Counter(kvsservice.forward_order(0)[0] for _ in range(30))
+        self.assertEqual(firsts, {member: 10 for member in members})
+        kvsservice.peer_health[members[0]].outstanding = 2
+        self.assertNotEqual(kvsservice.forward_order(0)[0], members[0])
+
+    def test_b_failed_member_is_skipped(self):
+        '''Does a request go to the next member when one is down, and is the down one tried last afterwards?'''
+        kvsservice.set_shards({0: [self.dead, self.live]})
+        for _ in range(4):
+            response = kvsservice.forward_to_shard(0, 'GET', '/shard/key-count/0')
+            self.assertEqual(response.json(), {'result': 'ok'})
+        self.assertEqual(kvsservice.peer_health[self.dead].failures, 1)
+        self.assertEqual(kvsservice.peer_health[self.live].forwarded, 4)
+        kvsservice.set_shards({0: [self.dead]})
+        with self.assertRaises(kvsservice.requests.exceptions.RequestException):
+            kvsservice.forward_to_shard(0, 'GET', '/shard/key-count/0')
+
+
+class TestFanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = kvsservice.fanout_pool
+
+    def tearDown(self):
+        kvsservice.fanout_pool = self.pool
+
+    def test_a_results_map_to_their_peers(self):
+        '''Does every peer get what its own send returned or raised, with the peers sent to at the same time?'''
+        def send(peer):
+            time.sleep(0.2)
+            if peer == 'down':
+                raise kvsservice.requests.exceptions.ConnectionError(peer)
+            return peer.upper()
+        start = time.perf_counter()
+        results = kvsservice.fan_out(['a', 'down', 'b'], send)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(list(results), ['a', 'down', 'b'])
+        self.assertEqual((results['a'], results['b']), ('A', 'B'))
+        self.assertIsInstance(results['down'], kvsservice.requests.exceptions.ConnectionError)
+
+    def test_b_fan_out_from_another_pool_does_not_starve(self):
+        '''With every fan-out thread taken, do sends run on transfer_pool still get to fan out themselves?'''
+        kvsservice.fanout_pool = kvsservice.ThreadPoolExecutor(max_workers=1)
+        send = lambda peer: kvsservice.fan_out([peer], lambda part: part * 2)[peer]
+        done = []
+        worker = threading.Thread(target=lambda: done.append(kvsservice.fan_out([1, 2, 3], send, kvsservice.transfer_pool)), daemon=True)
+        worker.start()
+        worker.join(5)
+        self.assertEqual(done, [{1: 2, 2: 4, 3: 6}])
+        kvsservice.fanout_pool.shutdown()
+
+class TestRemoteCache(unittest.TestCase):
+
+    alice, bob, carol = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090'
+
+    def setUp(self):
+        kvsservice.vc = kvsservice.VectorClock([self.alice, self.bob, self.carol])
+        kvsservice.set_shards({0: [self.alice], 1: [self.bob, self.carol]})
+        self.cache = kvsservice.RemoteCache(2)
+        keys = ['key{}'.format(n) for n in range(100)]
+        self.x, self.y = [key for key in keys if kvsservice.hash_of_key(key) == 1][:2]
+        self.other = next(key for key in keys if kvsservice.hash_of_key(key) == 0)
+
+    def answer(self, value, counts):
+        return {'result': 'found', 'value': value, 'causal-metadata': {'message-clock': kvsservice.vc.encode(counts)}, 'shard-id': 1}
+
+    def clock(self, sender, count):
+        return {'senders-address': sender, 'message-clock': {sender: count}, 'coalesced': True}
+
+    def test_a_served_only_to_clients_not_ahead(self):
+        '''Is a kept answer given to a client whose clock it covers on the owner shard's counters, and forwarded for one that saw a newer write there?'''
+        self.cache.keep(self.x, self.cache.ticket(), self.answer(1, [2, 5, 0]))
+        self.assertEqual(self.cache.lookup(self.x, None)['value'], 1)
+        self.assertEqual(self.cache.lookup(self.x, {'message-clock': kvsservice.vc.encode([2, 4, 0])})['value'], 1)
+        self.assertEqual(self.cache.lookup(self.x, {'message-clock': kvsservice.vc.encode([9, 5, 0])})['value'], 1)
+        self.assertIsNone(self.cache.lookup(self.x, {'message-clock': kvsservice.vc.encode([2, 5, 1])}))
+        self.assertIsNone(self.cache.lookup(self.other, None))
+
+    def test_b_written_keys_are_dropped(self):
+        '''Does a clock naming a key drop it, also from an answer still on its way, and does one naming none drop its shard's keys?'''
+        self.cache.keep(self.x, self.cache.ticket(), self.answer(1, [0, 1, 0]))
+        ticket = self.cache.ticket()
+        self.cache.invalidate([self.x], self.clock(self.bob, 2))
+        self.assertIsNone(self.cache.lookup(self.x, None))
+        self.cache.keep(self.x, ticket, self.answer(1, [0, 1, 0]))
+        self.assertIsNone(self.cache.lookup(self.x, None))
+        self.cache.keep(self.x, self.cache.ticket(), self.answer(2, [0, 2, 0]))
+        self.cache.keep(self.other, self.cache.ticket(), self.answer(3, [1, 0, 0]))
+        self.assertEqual(self.cache.lookup(self.x, None)['value'], 2)
+        self.cache.invalidate(None, self.clock(self.carol, 1))
+        self.assertIsNone(self.cache.lookup(self.x, None))
+        self.assertEqual(self.cache.lookup(self.other, None)['value'], 3)
+
+    def test_c_least_recently_used_goes_first(self):
+        for key in ('x', 'y'):
+            self.cache.keep(key, self.cache.ticket(), self.answer(key, [0, 1, 0]))
+        self.cache.lookup('x', None)
+        self.cache.keep('z', self.cache.ticket(), self.answer('z', [0, 1, 0]))
+        self.assertIsNone(self.cache.lookup('y', None))
+        self.assertEqual(self.cache.lookup('x', None)['value'], 'x')
+
+    def test_d_later_clocks_extend_kept_answers(self):
+        '''Does a clock of the owner shard that does not name a kept key let clients that saw its writes read the key,
+        but not when the answer may predate a clock that came before the GET?'''
+        behind = {'message-clock': kvsservice.vc.encode([0, 3, 0])}
+        self.cache.keep(self.x, self.cache.ticket(), self.answer(1, [0, 1, 0]))
+        self.assertIsNone(self.cache.lookup(self.x, behind))
+        self.cache.invalidate([self.y], self.clock(self.bob, 3))
+        self.assertEqual(self.cache.lookup(self.x, behind)['value'], 1)
+        self.cache.keep(self.y, self.cache.ticket(), self.answer(2, [0, 1, 0])) # from a member that did not have bob's write 3 yet
+        self.cache.invalidate([], self.clock(self.bob, 4))
+        self.assertIsNone(self.cache.lookup(self.y, behind))
+
+
+class TestBatch(unittest.TestCase):
+
+    class Peer(http.server.BaseHTTPRequestHandler):
+        '''A replica of the node's shard and the member of the other shard: takes /replica_batch, and answers a
+        forwarded /kvs/batch with "remote" for every key and the clock `remote_clock`'''
+        protocol_version = 'HTTP/1.1'
+        paths = []
+        bodies = []
+        remote_clock = None
+        def respond(self, body):
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_PUT(self):
+            self.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.paths.append(self.path)
+            self.respond({'result': 'batch applied'})
+        def do_POST(self):
+            data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self.paths.append(self.path)
+            self.respond({'results': [{'key': operation['key'], 'result': 'found', 'value': 'remote'} for operation in data['operations']],
+                    'causal-metadata': {'message-clock': self.remote_clock}})
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Peer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.peer = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.Peer.paths = []
+        self.Peer.bodies = []
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.replicas = [kvsservice.socket_address, self.peer, '10.10.0.5:8090']
+        kvsservice.vc = kvsservice.VectorClock(kvsservice.replicas)
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        kvsservice.set_shards({0: [kvsservice.socket_address, self.peer], 1: ['10.10.0.5:8090']})
+        kvsservice.peer_health.clear()
+        self.Peer.remote_clock = kvsservice.vc.encode([0, 0, 7])
+        keys = ['key{}'.format(n) for n in range(100)]
+        self.local = [key for key in keys if kvsservice.hash_of_key(key) == 0][:3]
+        self.other = [key for key in keys if kvsservice.hash_of_key(key) == 1][:2]
+        kvsservice.storage[self.local[0]] = 'old'
+        self.client = kvsservice.app.test_client()
+
+    def tearDown(self):
+        kvsservice.close_outbox(self.peer)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def batch(self, remote_member): # the peer server stands in for the other shard's member too
+        kvsservice.set_shards({**kvsservice.shards, 1: [remote_member]})
+        operations = [{'op': 'get', 'key': self.other[0]}, {'op': 'put', 'key': self.local[1], 'value': 1},
+                {'op': 'get', 'key': self.local[0]}, {'op': 'delete', 'key': self.local[2]},
+                {'op': 'delete', 'key': self.local[0]}, {'op': 'get', 'key': self.other[1]}]
+        response = self.client.post('/kvs/batch', json={'operations': operations, 'causal-metadata': None})
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def test_a_results_in_order_across_shards(self):
+        '''Do local and forwarded operations come back in the order they were sent, with a 404 for each missing key
+        and the clocks of both shards merged?'''
+        body = self.batch(self.peer)
+        results = body['results']
+        self.assertEqual([result['key'] for result in results], [self.other[0], self.local[1], self.local[0], self.local[2], self.local[0], self.other[1]])
+        self.assertEqual([results[0]['value'], results[5]['value']], ['remote', 'remote'])
+        self.assertEqual(results[1]['result'], 'created')
+        self.assertEqual(results[2]['value'], 'old')
+        self.assertEqual(results[3]['status'], 404)
+        self.assertEqual(results[4]['result'], 'deleted')
+        self.assertEqual(kvsservice.unpack_clock(body['causal-metadata']['message-clock']), (kvsservice.vc.digest, [1, 0, 7]))
+        self.assertEqual(dict(kvsservice.storage), {self.local[1]: 1})
+
+    def test_b_one_replica_message_per_peer(self):
+        '''Do all the local writes of a batch reach the shard's other replica as one /replica_batch, and the other
+        shard's operations as one forwarded /kvs/batch?'''
+        self.batch(self.peer)
+        self.assertEqual(sorted(self.Peer.paths), ['/kvs/batch', '/replica_batch'])
+
+    def test_c_failed_forward_fails_only_its_keys(self):
+        '''Does every operation of a shard that cannot be reached get a 503, and do the local ones still run?'''
+        results = self.batch('127.0.0.1:1')['results'] # nothing listens there, connecting is refused
+        self.assertEqual([results[0]['status'], results[5]['status']], [503, 503])
+        self.assertEqual(results[1]['result'], 'created')
+        self.assertEqual(self.Peer.paths, ['/replica_batch'])
+
+
+    def test_d_replicas_get_only_the_stored_value(self):
+        '''Does a write's replica message carry the value as stored here, whatever other fields the client sent?'''
+        data = {'value': 'hello', 'zlib': 'not base64!!', 'causal-metadata': None}
+        response = self.client.put('/kvs/{}'.format(self.local[1]), json=data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(kvsservice.storage[self.local[1]], 'hello')
+        self.assertEqual(self.Peer.paths, ['/replica_kvs/{}'.format(self.local[1])])
+        self.assertNotIn('zlib', self.Peer.bodies[0])
+        self.assertEqual(kvsstorage.value_from(self.Peer.bodies[0]), 'hello')
+
+class TestWriteModes(unittest.TestCase):
+
+    alice, bob, carol, dave = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090', '10.10.0.5:8090'
+
+    def setUp(self):
+        kvsservice.set_shards({0: [self.alice, self.bob, self.carol], 1: [self.dave]})
+
+    def waiter(self, mode):
+        '''A write of `mode` on shard 0 waiting for its peers on a thread, with the acks of its replicas and of the other shard'''
+        replication, metadata = kvsservice.Acks([self.bob, self.carol]), kvsservice.Acks([self.dave])
+        thread = threading.Thread(target=kvsservice.wait_for_write, args=(mode, 0, replication, metadata))
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread, replication, metadata
+
+    def test_a_all_waits_for_every_peer(self):
+        thread, replication, metadata = self.waiter('all')
+        replication.record(self.bob, True)
+        replication.record(self.carol, True)
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        metadata.record(self.dave, True)
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+
+    def test_b_quorum_waits_for_a_majority(self):
+        '''Does a quorum write in a shard of three return once one other replica has it, the writer being the second?'''
+        thread, replication, metadata = self.waiter('quorum')
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        replication.record(self.carol, True)
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(kvsservice.write_waits('quorum', 0, replication, metadata), [(replication, 1)])
+
+    def test_c_local_waits_for_nobody(self):
+        thread, replication, metadata = self.waiter('local')
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(kvsservice.write_waits('local', 0, replication, metadata), [])
+
+    def test_d_unreachable_peers_do_not_block(self):
+        '''Does a peer that was dropped count as done, so a write never waits on a peer that is gone?'''
+        replication = kvsservice.Acks([self.bob, self.carol])
+        replication.record(self.bob, False)
+        replication.record(self.carol, False)
+        self.assertEqual(replication.wait(), 0)
+
+    def test_e_delivered_messages_leave_the_stored_queue(self):
+        '''With the log engine, is a replica message stored until its peer took it?'''
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), TestBatch.Peer)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        peer = '127.0.0.1:{}'.format(server.server_address[1])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        kvsservice.storage = kvsstorage.LogStorage(directory.name)
+        acks = kvsservice.Acks([peer])
+        kvsservice.outbox_for(peer).put('PUT', 'http://{}/replica_batch'.format(peer), {'operations': []}, acks)
+        self.addCleanup(kvsservice.close_outbox, peer)
+        self.assertEqual(acks.wait(), 1)
+        self.assertEqual(kvsservice.storage.queued_messages(), {})
+        kvsservice.storage.close()
+        reopened = kvsstorage.LogStorage(directory.name)
+        self.addCleanup(reopened.close)
+        self.assertEqual(reopened.queued_messages(), {})
+
+    def test_f_message_held_until_timeout_is_sent_again(self):
+        '''Is a peer that holds a message for its whole HOLDBACK_TIMEOUT, longer than PEER_TIMEOUT, sent it again
+        after the 503 instead of being dropped from the view?'''
+        class Holding(TestBatch.Peer):
+            def do_PUT(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.paths.append(self.path)
+                if len(self.paths) == 1: # dependencies missing: held, then refused
+                    time.sleep(kvsservice.HOLDBACK_TIMEOUT)
+                    body = b'{"error": "missing dependencies"}'
+                    self.send_response(503)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.respond({'result': 'batch applied'})
+        Holding.paths = []
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Holding)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        peer = '127.0.0.1:{}'.format(server.server_address[1])
+        timeouts = kvsservice.PEER_TIMEOUT, kvsservice.HOLDBACK_TIMEOUT, kvsservice.broadcast_delete_view
+        def restore():
+            kvsservice.PEER_TIMEOUT, kvsservice.HOLDBACK_TIMEOUT, kvsservice.broadcast_delete_view = timeouts
+        self.addCleanup(restore)
+        kvsservice.PEER_TIMEOUT, kvsservice.HOLDBACK_TIMEOUT = 0.2, 0.4
+        dropped = []
+        kvsservice.broadcast_delete_view = dropped.append
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        with kvsservice.write_lock: # and the holdback queue gives up after HOLDBACK_TIMEOUT
+            kvsservice.vc = kvsservice.VectorClock([self.alice, self.bob])
+            kvsservice.holdback = kvsservice.HoldbackQueue()
+            start = time.perf_counter()
+            with self.assertRaises(TimeoutError):
+                kvsservice.holdback.deliver({'senders-address': self.bob, 'message-clock': {self.alice: 1, self.bob: 1}}, lambda: None)
+            self.assertGreaterEqual(time.perf_counter() - start, 0.4)
+        acks = kvsservice.Acks([peer])
+        kvsservice.outbox_for(peer).put('PUT', 'http://{}/replica_batch'.format(peer), {'operations': []}, acks)
+        self.addCleanup(kvsservice.close_outbox, peer)
+        self.assertEqual(acks.wait(), 1)
+        self.assertEqual(Holding.paths, ['/replica_batch', '/replica_batch'])
+        self.assertEqual(dropped, [])
+
+
+class TestVectorClock(unittest.TestCase):
+
+    alice, bob, carol, dave = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090', '10.10.0.5:8090'
+
+    def setUp(self):
+        kvsservice.vc = kvsservice.VectorClock([self.carol, self.alice, self.bob])
+        kvsservice.storage = kvsstorage.MemoryStorage() # outboxes keep their queue in storage
+        kvsservice.received_clocks.clear()
+
+    def test_a_packed_clock_round_trip(self):
+        vc = kvsservice.vc
+        vc.clock = {self.alice: 3, self.bob: 0, self.carol: 200000}
+        packed = vc.encode()
+        self.assertEqual(len(packed), len(vc.digest) + 1 + 7) # 1 + 1 + 3 varint bytes, 7 base64 characters
+        self.assertEqual(kvsservice.unpack_clock(packed), (vc.digest, [3, 0, 200000]))
+        self.assertEqual(kvsservice.read_client_clock(packed), (vc.digest, [3, 0, 200000]))
+
+    def test_b_clock_from_earlier_view_is_aligned(self):
+        '''Is a packed clock made before a replica joined still read against the right replicas?'''
+        vc = kvsservice.vc
+        vc.clock = {self.alice: 1, self.bob: 2, self.carol: 3}
+        before = kvsservice.read_client_clock(vc.encode())
+        vc.add_replica(self.dave)
+        vc.delete_replica(self.alice)
+        self.assertEqual(vc.align(before), [2, 3, 0])
+        self.assertTrue(vc.is_causal(vc.align(before)))
+        self.assertFalse(vc.is_causal([2, 4, 0]))
+
+    def test_c_delta_against_acked_clock(self):
+        '''Does a replica message after the first one carry only the counters that changed?'''
+        vc = kvsservice.vc
+        outbox = kvsservice.Outbox(self.dave)
+        try:
+            vc.clock = {self.alice: 5, self.bob: 7}
+            first = {'causal-metadata': {'senders-address': self.bob, 'message-clock': vc.sparse()}}
+            self.assertIs(outbox.compact(first, vc.snapshot()), first)
+            with kvsservice.write_lock:
+                kvsservice.remember_clock(kvsservice.read_replica_metadata(first['causal-metadata']))
+            outbox.acked = vc.snapshot()
+            vc.increment(self.bob)
+            second = outbox.compact({'causal-metadata': {'senders-address': self.bob, 'message-clock': vc.sparse()}}, vc.snapshot())
+            self.assertEqual(second['causal-metadata']['message-clock']['delta'], [vc.index[self.bob], 8])
+            self.assertEqual(kvsservice.read_replica_metadata(second['causal-metadata'])['clock'], vc.snapshot())
+            kvsservice.received_clocks.clear()
+            with self.assertRaises(LookupError):
+                kvsservice.read_replica_metadata(second['causal-metadata'])
+        finally:
+            outbox.close()
+
+
+class TestLogStorage(unittest.TestCase):
+
+    alice, bob = '10.10.0.2:8090', '10.10.0.3:8090'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def open(self):
+        storage = kvsstorage.LogStorage(self.directory.name)
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_a_reopen_recovers_data_clock_and_shards(self):
+        storage = self.open()
+        vc = kvsservice.VectorClock([self.alice, self.bob])
+        storage['x'] = 1
+        storage['y'] = {'nested': [1, 2]}
+        storage.update({'z': None})
+        storage.pop('x')
+        vc.increment(self.alice)
+        vc.increment(self.alice)
+        storage.save_state(vc, {0: [self.alice], 1: [self.bob]})
+        storage.wait_durable()
+        storage.close()
+        reopened = self.open()
+        self.assertEqual(dict(reopened), {'y': {'nested': [1, 2]}, 'z': None})
+        self.assertEqual(reopened.load_state(), ({self.alice: 2, self.bob: 0}, {0: [self.alice], 1: [self.bob]}))
+
+    def test_b_torn_last_record_is_ignored(self):
+        storage = self.open()
+        storage['x'] = 1
+        storage.close()
+        log = os.path.join(self.directory.name, sorted(os.listdir(self.directory.name))[-1])
+        with open(log, 'a') as torn:
+            torn.write('["p","y",')
+        self.assertEqual(dict(self.open()), {'x': 1})
+
+    def test_c_snapshot_compacts_the_log(self):
+        '''Once SNAPSHOT_RECORDS records are logged, are they replaced by one snapshot that reopens the same?'''
+        records = kvsstorage.SNAPSHOT_RECORDS
+        kvsstorage.SNAPSHOT_RECORDS = 50
+        self.addCleanup(setattr, kvsstorage, 'SNAPSHOT_RECORDS', records)
+        storage = self.open()
+        for n in range(120):
+            storage['key{}'.format(n % 40)] = n
+            storage.wait_durable()
+        deadline = time.time() + 5
+        while time.time() < deadline and not any(name.startswith('snapshot-') and name.endswith('.json') for name in os.listdir(self.directory.name)):
+            time.sleep(0.05)
+        expected = dict(storage)
+        storage.close()
+        names = os.listdir(self.directory.name)
+        self.assertTrue(any(name.startswith('snapshot-') for name in names), names)
+        self.assertEqual(dict(self.open()), expected)
+
+    def test_d_compressed_values_stay_compressed(self):
+        storage = self.open()
+        document = {'events': ['click', 'view'] * 200}
+        storage['x'] = kvsstorage.compress(document)[0]
+        storage.update({'y': kvsstorage.compress(dict(document, n=1))[0]})
+        storage.close()
+        reopened = self.open()
+        self.assertIsInstance(reopened['x'], kvsstorage.Compressed)
+        self.assertEqual(reopened['x'].value(), document)
+        self.assertEqual(reopened['y'].value(), dict(document, n=1))
+
+
+    def test_e_undelivered_replica_messages_survive(self):
+        '''Are queued replica messages kept across a restart and a snapshot, until they are delivered or their peer left?'''
+        storage = self.open()
+        first = storage.queue_message(self.bob, ['PUT', 'http://{}/replica_kvs/x'.format(self.bob), {'value': 1}, None])
+        second = storage.queue_message(self.bob, ['PUT', 'http://{}/replica_kvs/y'.format(self.bob), {'value': 2}, ['abcd1234', [1, 0]]])
+        storage.queue_message(self.alice, ['PUT', 'http://{}/update_metadata'.format(self.alice), {}, None])
+        storage.message_delivered(self.bob, first)
+        storage.drop_messages(self.alice)
+        storage.close()
+        reopened = self.open()
+        expected = {self.bob: [(second, ['PUT', 'http://{}/replica_kvs/y'.format(self.bob), {'value': 2}, ['abcd1234', [1, 0]]])]}
+        self.assertEqual(reopened.queued_messages(), expected)
+        self.assertGreater(reopened.queue_message(self.bob, ['PUT', 'http://{}/replica_kvs/z'.format(self.bob), {}, None]), second)
+        reopened.snapshot()
+        reopened.close()
+        deadline = time.time() + 5
+        while time.time() < deadline and not any(name.startswith('snapshot-') and name.endswith('.json') for name in os.listdir(self.directory.name)):
+            time.sleep(0.05)
+        self.assertEqual(len(self.open().queued_messages()[self.bob]), 2)
+
+    def test_f_snapshot_syncs_the_old_log_first(self):
+        '''Are records written to the old log since its last fsync on disk by the time the next generation starts?'''
+        interval = kvsstorage.SYNC_INTERVAL
+        kvsstorage.SYNC_INTERVAL = 5 # the sync thread does not get to them first
+        self.addCleanup(setattr, kvsstorage, 'SYNC_INTERVAL', interval)
+        synced = []
+        fsync = kvsstorage.os.fsync
+        def record(fd):
+            synced.append(fd)
+            fsync(fd)
+        kvsstorage.os.fsync = record
+        self.addCleanup(setattr, kvsstorage.os, 'fsync', fsync)
+        storage = self.open()
+        storage['x'] = 1
+        old_log = storage.log.fileno()
+        storage.snapshot()
+        self.assertEqual(synced[:1], [old_log]) # before snapshot() returns, the snapshot file comes after
+        self.assertEqual(storage.synced, storage.written)
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.replicas = [kvsservice.socket_address]
+        kvsservice.vc = kvsservice.VectorClock(kvsservice.replicas)
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({0: [kvsservice.socket_address]})
+        kvsservice.lamport = 0
+
+    def test_a_large_values_are_stored_compressed(self):
+        '''Is a large value compressed once on write, sent on to replicas compressed, and read back as it was written?'''
+        document = {'events': [{'type': 'click', 'page': '/products/{}'.format(n % 10)} for n in range(100)]}
+        sent = []
+        broadcast = kvsservice.broadcast_to_replicas
+        kvsservice.broadcast_to_replicas = lambda method, path, data, *args: sent.append(data) or broadcast(method, path, data, *args)
+        self.addCleanup(setattr, kvsservice, 'broadcast_to_replicas', broadcast)
+        kvsservice.kvs_serve('PUT', 'doc', {'value': document, 'causal-metadata': None}, 0)
+        self.assertIsInstance(kvsservice.storage['doc'], kvsstorage.Compressed)
+        self.assertNotIn('value', sent[0])
+        self.assertEqual(kvsstorage.value_from(sent[0]), kvsservice.storage['doc'])
+        self.assertLess(len(kvsservice.storage['doc']), len(json.dumps(document)) / 5)
+        body, status, _ = kvsservice.kvs_serve('GET', 'doc', {'causal-metadata': None}, 0)
+        self.assertEqual((status, body['value']), (200, document))
+
+    def test_b_small_and_lookalike_values_stay_plain(self):
+        lookalike = {'zlib': kvsstorage.compress(['x'] * 1000)[0].wire()}
+        for value in ('small', lookalike):
+            data = {'value': value, 'causal-metadata': None}
+            kvsservice.kvs_serve('PUT', 'key', data, 0)
+            self.assertEqual(kvsservice.storage['key'], value)
+            self.assertEqual(kvsstorage.value_from(data), value)
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.items = {'key{}'.format(n): {'n': n, 'text': 'x' * 80} for n in range(200)}
+
+    def test_a_budget_holds_and_values_read_back(self):
+        '''Do the values in memory stay under the budget, with the spilled ones read back the same and the hash tree
+        and bucket bytes the same as without a budget?'''
+        storage = kvsstorage.MemoryStorage(self.items, budget=2000, spill_dir=self.directory.name)
+        unlimited = kvsstorage.MemoryStorage(self.items, budget=0)
+        stats = storage.memory_stats()
+        self.assertLessEqual(stats['resident-bytes'], 2000)
+        self.assertEqual(stats['resident-keys'] + stats['spilled-keys'], 200)
+        self.assertEqual(storage.leaves, unlimited.leaves)
+        self.assertEqual(storage.bucket_bytes, unlimited.bucket_bytes)
+        self.assertEqual(dict(storage.items()), self.items)
+        self.assertEqual(storage.memory_stats(), stats) # items() does not pull values back in
+
+    def test_b_changes_to_spilled_keys(self):
+        compact = kvsstorage.SPILL_COMPACT_BYTES
+        kvsstorage.SPILL_COMPACT_BYTES = 4000
+        self.addCleanup(setattr, kvsstorage, 'SPILL_COMPACT_BYTES', compact)
+        storage = kvsstorage.MemoryStorage(self.items, budget=2000, spill_dir=self.directory.name)
+        self.assertIsInstance(dict.__getitem__(storage, 'key0'), kvsstorage.Spilled)
+        self.assertEqual(storage['key0'], self.items['key0'])
+        self.assertNotIsInstance(dict.__getitem__(storage, 'key0'), kvsstorage.Spilled)
+        self.assertEqual(storage.pop('key1'), self.items['key1'])
+        storage['key2'] = 'replaced'
+        for n in range(3, 200):
+            storage['key{}'.format(n)] = {'n': n}
+        expected = dict(self.items, key2='replaced', **{'key{}'.format(n): {'n': n} for n in range(3, 200)})
+        del expected['key1']
+        self.assertEqual(dict(storage.items()), expected)
+        self.assertEqual(storage.leaves, kvsstorage.MemoryStorage(expected, budget=0).leaves)
+        self.assertLess(storage.memory_stats()['spill-file-bytes'], 4000 + len(self.items) * 120)
+
+    def test_c_log_storage_reopens_with_a_budget(self):
+        storage = kvsstorage.LogStorage(self.directory.name, budget=2000)
+        storage.update(self.items)
+        storage.close()
+        reopened = kvsstorage.LogStorage(self.directory.name, budget=2000)
+        self.addCleanup(reopened.close)
+        self.assertGreater(reopened.memory_stats()['spilled-keys'], 0)
+        self.assertEqual(dict(reopened.items()), self.items)
+
+
+class TestHoldbackQueue(unittest.TestCase):
+
+    alice, bob, carol = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090'
+
+    def setUp(self):
+        kvsservice.vc = kvsservice.VectorClock([self.alice, self.bob, self.carol])
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({})
+        self.applied = []
+
+    def deliver(self, sender, clock, timeout=5):
+        metadata = {'senders-address': sender, 'message-clock': clock}
+        with kvsservice.write_lock:
+            return kvsservice.holdback.deliver(metadata, lambda: self.applied.append(sender) or sender, timeout)
+
+    def test_a_early_message_waits_for_dependency(self):
+        '''Is a message that depends on an undelivered one held, then delivered right after it?'''
+        early = {}
+        thread = threading.Thread(target=lambda: early.update(result=self.deliver(self.carol, {self.alice: 1, self.bob: 0, self.carol: 1})))
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(self.applied, [])
+        self.assertEqual(self.deliver(self.alice, {self.alice: 1, self.bob: 0, self.carol: 0}), self.alice)
+        thread.join(2)
+        self.assertEqual(early['result'], self.carol)
+        self.assertEqual(self.applied, [self.alice, self.carol])
+        self.assertEqual(kvsservice.vc.clock, {self.alice: 1, self.bob: 0, self.carol: 1})
+
+    def test_b_resent_message_is_not_applied_twice(self):
+        self.deliver(self.bob, {self.alice: 0, self.bob: 1, self.carol: 0})
+        self.assertIsNone(self.deliver(self.bob, {self.alice: 0, self.bob: 1, self.carol: 0}))
+        self.assertEqual(self.applied, [self.bob])
+
+    def test_c_missing_dependency_times_out(self):
+        with self.assertRaises(TimeoutError):
+            self.deliver(self.bob, {self.alice: 3, self.bob: 1, self.carol: 0}, timeout=0.1)
+        self.assertEqual(kvsservice.holdback.held, {})
+
+    def test_d_buffered_until_release(self):
+        '''While joining, are replica messages kept and then only the ones the copied shard lacks applied?'''
+        kvsservice.holdback.buffering = True
+        self.assertEqual(self.deliver(self.bob, {self.alice: 0, self.bob: 1, self.carol: 0}), 'buffered')
+        self.assertEqual(self.deliver(self.bob, {self.alice: 0, self.bob: 2, self.carol: 0}), 'buffered')
+        self.assertEqual(self.applied, [])
+        kvsservice.vc.clock = {self.alice: 0, self.bob: 1, self.carol: 0} # the copy covered bob's first write
+        with kvsservice.write_lock:
+            kvsservice.holdback.release()
+        self.assertEqual(self.applied, [self.bob])
+        self.assertEqual(kvsservice.vc.get(self.bob), 2)
+
+
+    def test_e_sender_outside_the_view_is_refused(self):
+        '''Is a message from a sender a view change removed refused with a 410, also one held when its sender left?'''
+        dave = '10.10.0.5:8090'
+        with self.assertRaises(kvsservice.SenderNotInView):
+            self.deliver(dave, {dave: 1})
+        data = {'value': 1, 'version': [1, dave], 'causal-metadata': {'senders-address': dave, 'message-clock': {dave: 1}}}
+        self.assertEqual(kvsservice.replica_write('PUT', 'x', data)[1], 410)
+        held = {}
+        def early():
+            try:
+                self.deliver(self.carol, {self.alice: 1, self.bob: 0, self.carol: 1})
+            except kvsservice.SenderNotInView as e:
+                held['error'] = e
+        thread = threading.Thread(target=early)
+        thread.start()
+        time.sleep(0.2)
+        with kvsservice.write_lock:
+            kvsservice.vc.delete_replica(self.carol)
+        self.assertEqual(self.deliver(self.alice, {self.alice: 1, self.bob: 0}), self.alice)
+        thread.join(2)
+        self.assertIn('error', held)
+        self.assertEqual(self.applied, [self.alice])
+
+    def test_f_unknown_layout_fetched_outside_write_lock(self):
+        '''Is the layout of a packed clock from an earlier view asked for before write_lock is taken?'''
+        earlier = kvsservice.VectorClock([self.alice, self.bob])
+        fetched = []
+        def fetch_layout(digest):
+            fetched.append(kvsservice.write_lock.locked())
+            kvsservice.vc.layouts[digest] = earlier.members
+        fetch = kvsservice.fetch_layout
+        kvsservice.fetch_layout = fetch_layout
+        self.addCleanup(setattr, kvsservice, 'fetch_layout', fetch)
+        metadata = {'senders-address': self.bob, 'message-clock': earlier.encode([0, 1])}
+        body, status = kvsservice.replica_write('PUT', 'x', {'value': 1, 'version': [1, self.bob], 'causal-metadata': metadata})
+        self.assertEqual((status, fetched), (201, [False]))
+        self.assertEqual(kvsservice.vc.get(self.bob), 1)
+
+class TestCoalescedMetadata(unittest.TestCase):
+
+    alice, bob, carol, dave = '10.10.0.2:8090', '10.10.0.3:8090', '10.10.0.4:8090', '10.10.0.5:8090'
+
+    def setUp(self):
+        kvsservice.socket_address = self.alice
+        kvsservice.vc = kvsservice.VectorClock([self.alice, self.bob, self.carol, self.dave])
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({0: [self.alice, self.bob], 1: [self.carol, self.dave]})
+        self.causal_wait, self.interval, self.outbox_for = kvsservice.CAUSAL_WAIT, kvsservice.METADATA_INTERVAL, kvsservice.outbox_for
+        self.applied = []
+
+    def tearDown(self):
+        kvsservice.CAUSAL_WAIT, kvsservice.METADATA_INTERVAL, kvsservice.outbox_for = self.causal_wait, self.interval, self.outbox_for
+        kvsservice.set_shards({})
+
+    def deliver(self, sender, clock, coalesced=False, timeout=5):
+        metadata = {'senders-address': sender, 'message-clock': clock, 'coalesced': coalesced}
+        with kvsservice.write_lock:
+            return kvsservice.holdback.deliver(metadata, lambda: self.applied.append(sender) or sender, timeout)
+
+    def test_a_merged_clock_waits_for_own_shard_only(self):
+        '''Is a merged clock from another shard held until this shard's writes it covers are in, then merged whole?'''
+        held = {}
+        thread = threading.Thread(target=lambda: held.update(result=self.deliver(self.carol, {self.bob: 1, self.carol: 3, self.dave: 2}, True)))
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(kvsservice.vc.counts, [0, 0, 0, 0])
+        self.deliver(self.bob, {self.bob: 1})
+        thread.join(2)
+        self.assertEqual(held['result'], self.carol)
+        self.assertEqual(kvsservice.vc.counts, [0, 1, 3, 2])
+        # an older merged clock arriving late changes nothing, but is still applied
+        self.assertEqual(self.deliver(self.dave, {self.carol: 1, self.dave: 1}, True), self.dave)
+        self.assertEqual(kvsservice.vc.counts, [0, 1, 3, 2])
+
+    def test_b_flush_sends_one_merged_clock(self):
+        '''Do several writes go to the other shard as one coalesced clock per replica, covering all of them?'''
+        sent = []
+        class Outbox:
+            def __init__(self, peer):
+                self.peer = peer
+            def put(self, method, url, data, acks, clock=None):
+                sent.append((self.peer, url, data))
+        kvsservice.outbox_for = Outbox
+        kvsservice.METADATA_INTERVAL = 0.05
+        threading.Thread(target=kvsservice.flush_metadata, daemon=True).start()
+        with kvsservice.write_lock:
+            for _ in range(3):
+                kvsservice.vc.increment(self.alice)
+        time.sleep(0.3)
+        with kvsservice.write_lock:
+            kvsservice.METADATA_INTERVAL = 3600 # the thread goes to sleep for good after this round
+        time.sleep(0.2)
+        self.assertEqual([peer for peer, _, _ in sent], [self.carol, self.dave])
+        metadata = sent[0][2]['causal-metadata']
+        self.assertEqual(metadata, {'senders-address': self.alice, 'message-clock': {self.alice: 3}, 'coalesced': True})
+        # on carol's side, the clock is delivered whole and merged
+        kvsservice.socket_address = self.carol
+        kvsservice.vc = kvsservice.VectorClock([self.alice, self.bob, self.carol, self.dave])
+        self.assertEqual(self.deliver(self.alice, metadata['message-clock'], True), self.alice)
+        self.assertEqual(kvsservice.vc.get(self.alice), 3)
+
+    def test_c_client_waits_for_unflushed_clock(self):
+        '''Does a client that saw writes of another shard wait until their merged clock arrives, and is refused without it?'''
+        client = kvsservice.vc.encode([0, 0, 2, 0])
+        kvsservice.CAUSAL_WAIT = 0.1
+        self.assertFalse(kvsservice.handle_client_metadata({'message-clock': client}))
+        kvsservice.CAUSAL_WAIT = 5
+        waited = {}
+        thread = threading.Thread(target=lambda: waited.update(result=kvsservice.handle_client_metadata({'message-clock': client})))
+        thread.start()
+        time.sleep(0.2)
+        self.assertNotIn('result', waited)
+        self.deliver(self.carol, {self.carol: 2}, True)
+        thread.join(2)
+        self.assertTrue(waited['result'])
+
+class TestStorageExport(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.storage = kvsstorage.MemoryStorage({'key{}'.format(n): n for n in range(300)})
+        kvsservice.set_shards({0: ['10.10.0.2:8090'], 1: ['10.10.0.3:8090']})
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        self.client = kvsservice.app.test_client()
+
+    def export(self, part, parts, session=None):
+        pages, cursor = [], ''
+        while cursor is not None:
+            query = {'shard': 0, 'part': part, 'parts': parts, 'limit': 7, 'cursor': cursor}
+            if session:
+                query['session'] = session
+            body = self.client.get('/storage/export', query_string=query).get_json()
+            pages.append(body['storage'])
+            cursor = body['next-cursor']
+        return pages
+
+    def test_a_parts_cover_the_shard_once(self):
+        '''Do the key ranges of a parallel copy add up to the shard, each key in exactly one page?'''
+        shard_keys = {key for key in kvsservice.storage if kvsservice.hash_of_key(key) == 0}
+        for session in (None, 'join'):
+            copied = []
+            for part in range(3):
+                for page in self.export(part, 3, session and '{}-{}'.format(session, part)):
+                    copied.extend(page)
+            with self.subTest(session=session):
+                self.assertEqual(len(copied), len(set(copied)))
+                self.assertEqual(set(copied), shard_keys)
+        self.assertEqual(kvsservice.export_sessions, {})
+
+class TestJoinCopy(unittest.TestCase):
+
+    class Member(http.server.BaseHTTPRequestHandler):
+        '''The one member of shard 0: answers /getshards and registers the joining node at clock 4'''
+        protocol_version = 'HTTP/1.1'
+        def respond(self, body):
+            body = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            self.respond({'shards': {'0': [self.server.member, kvsservice.socket_address]}})
+        def do_PUT(self):
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.respond({'message-clock': kvsservice.vc.encode([0, 4])})
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Member)
+        self.server.member = self.member = '127.0.0.1:{}'.format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.replicas = [kvsservice.socket_address, self.member]
+        kvsservice.viewenv = list(kvsservice.replicas)
+        kvsservice.vc = kvsservice.VectorClock(kvsservice.replicas)
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        self.copy_part = kvsservice.copy_part
+
+    def tearDown(self):
+        kvsservice.copy_part = self.copy_part
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_a_no_donor_left_raises(self):
+        with self.assertRaises(kvsservice.IncompleteCopy) as raised:
+            kvsservice.copy_part(0, 0, ['127.0.0.1:1'], kvsservice.vc.encode(), 'key5')
+        self.assertEqual((raised.exception.cursor, raised.exception.copied), ('key5', 0))
+
+    def test_b_serves_only_once_every_part_is_copied(self):
+        '''Does a part that failed get copied again from its cursor, with the node buffering until it is?'''
+        calls = []
+        retried = threading.Event()
+        def copy_part(shard_id, part, donors, clock, cursor=''):
+            calls.append(cursor)
+            if len(calls) == 1:
+                raise kvsservice.IncompleteCopy(part, 'key5', 3)
+            retried.wait(5)
+            return 7
+        kvsservice.copy_part = copy_part
+        joining = threading.Thread(target=kvsservice.initialize_kvs, args=(0,))
+        joining.start()
+        time.sleep(0.5)
+        self.assertEqual(calls, ['', 'key5'])
+        self.assertTrue(kvsservice.holdback.buffering)
+        self.assertFalse(kvsservice.serves(0))
+        retried.set()
+        joining.join(5)
+        self.assertFalse(kvsservice.holdback.buffering)
+        self.assertEqual(kvsservice.vc.get(self.member), 4)
+
+class TestAntiEntropy(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({0: ['10.10.0.2:8090', '10.10.0.3:8090']})
+        kvsservice.lamport = 0
+
+    def test_a_hash_tree_ignores_write_order(self):
+        '''Do replicas that took the same writes in different orders, or undid one, end with the same root?'''
+        first = kvsstorage.MemoryStorage({'key{}'.format(n): n for n in range(100)})
+        second = kvsstorage.MemoryStorage({'key{}'.format(n): n for n in reversed(range(100))})
+        root = first.merkle_levels()[0]
+        self.assertEqual(root, second.merkle_levels()[0])
+        second['key7'] = 'other'
+        second['extra'] = 1
+        self.assertNotEqual(root, second.merkle_levels()[0])
+        second['key7'] = 7
+        del second['extra']
+        self.assertEqual(root, second.merkle_levels()[0])
+
+    def test_b_items_apply_only_if_newer(self):
+        kvsservice.storage['key'] = 'mine'
+        kvsservice.storage.set_version('key', [5, '10.10.0.2:8090'])
+        applied = kvsservice.apply_items({'key': {'value': 'older', 'version': [4, '10.10.0.3:8090']},
+                'gone': {'deleted': True, 'version': [2, '10.10.0.3:8090']}})
+        self.assertEqual(applied, 1)
+        self.assertEqual(kvsservice.storage['key'], 'mine')
+        self.assertEqual(kvsservice.storage.versions['gone'], [2, '10.10.0.3:8090'])
+        self.assertEqual(kvsservice.apply_items({'key': {'deleted': True, 'version': [5, '10.10.0.3:8090']}}), 1)
+        self.assertNotIn('key', kvsservice.storage)
+        self.assertEqual(kvsservice.next_version(), [6, '10.10.0.2:8090'])
+
+
+class TestShardMap(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.set_shards({0: ['10.10.0.2:8090', '10.10.0.3:8090'], 1: ['10.10.0.4:8090', '10.10.0.5:8090']})
+        self.client = kvsservice.app.test_client()
+
+    def test_a_clients_route_like_the_nodes(self):
+        '''Does a ring built from /shard/map put every key on the shard the nodes put it on?'''
+        body = self.client.get('/shard/map').get_json()
+        ring = HashRing({int(shard_id) for shard_id in body['shards']}, body['vnodes'], body['buckets'], body['key-hash'])
+        for n in range(500):
+            self.assertEqual(ring.shard_for('key{}'.format(n)), kvsservice.hash_of_key('key{}'.format(n)))
+
+    def test_b_epoch_follows_the_map(self):
+        '''Is the epoch in every response header, and does it change with the members of a shard?'''
+        response = self.client.get('/shard/map')
+        epoch = response.get_json()['epoch']
+        self.assertEqual(response.headers['X-Shard-Epoch'], epoch)
+        kvsservice.shard_add(1, '10.10.0.6:8090')
+        self.assertNotEqual(self.client.get('/shard/ids').headers['X-Shard-Epoch'], epoch)
+
+
+class TestClient(unittest.TestCase):
+
+    class Node(http.server.BaseHTTPRequestHandler):
+        '''A node of a one shard store: serves the server's `shard_map` and answers every key with its epoch'''
+        protocol_version = 'HTTP/1.1'
+        def respond(self, status, body):
+            body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Shard-Epoch', self.server.shard_map['epoch'])
+            self.end_headers()
+            self.wfile.write(body)
+        def do_GET(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.server.paths.append(self.path)
+            if self.path == '/shard/map':
+                self.respond(200, self.server.shard_map)
+            else:
+                self.respond(200, {'result': 'found', 'value': self.server.address, 'causal-metadata': {'message-clock': 'clock'}})
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        self.servers = []
+        for _ in range(2):
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.Node)
+            server.address = '127.0.0.1:{}'.format(server.server_address[1])
+            server.paths = []
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.first, self.second = (server.address for server in self.servers)
+        self.publish('a', [self.first])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def publish(self, epoch, members):
+        for server in self.servers:
+            server.shard_map = {'epoch': epoch, 'vnodes': 8, 'buckets': 64, 'key-hash': 'crc32', 'shards': {'0': members}}
+
+    def test_a_stale_epoch_refreshes_the_map(self):
+        '''Does a response with another epoch make the client fetch the map, and route by the new one?'''
+        shard_map = kvsclient.ShardMap([self.first])
+        client = kvsclient.KVSClient(shard_map)
+        self.assertEqual(client.get('x'), self.first)
+        self.publish('b', [self.second])
+        self.assertEqual(client.get('x'), self.first) # answered by the old member, whose header is news
+        self.assertEqual((shard_map.epoch, shard_map.members(0)), ('b', [self.second]))
+        self.assertEqual(client.get('x'), self.second)
+        self.assertEqual(self.servers[0].paths.count('/shard/map'), 2)
+        self.assertEqual(client.metadata, {'message-clock': 'clock'})
+
+    def test_b_unreachable_member_is_skipped(self):
+        '''Does a request go to the next member of the shard when one cannot be reached?'''
+        self.publish('a', ['127.0.0.1:1', self.second])
+        client = kvsclient.KVSClient(kvsclient.ShardMap([self.first]))
+        self.assertEqual([client.get('x') for _ in range(4)], [self.second] * 4)
+        self.assertEqual(self.servers[1].paths, ['/kvs/x'] * 4)
+
+    def test_c_map_refreshed_when_no_member_answers(self):
+        '''When every member of the shard it knows is gone, does the client fetch the map again and find the new one?'''
+        self.publish('a', ['127.0.0.1:1'])
+        shard_map = kvsclient.ShardMap([self.first])
+        client = kvsclient.KVSClient(shard_map)
+        self.publish('b', [self.second])
+        self.assertEqual(client.get('x'), self.second)
+        self.assertEqual(shard_map.epoch, 'b')
+
+
+class TestBuckets(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.set_shards({0: ['10.10.0.2:8090'], 1: ['10.10.0.3:8090'], 2: ['10.10.0.4:8090']})
+        kvsservice.storage = kvsstorage.MemoryStorage({'key{}'.format(n): 'v' * (n % 7) for n in range(3000)}, bucket_of=kvsservice.bucket_of)
+
+    def test_a_counts_follow_writes(self):
+        '''Do the per-shard key and byte counts match a full scan after overwrites and deletes?'''
+        storage = kvsservice.storage
+        for n in range(0, 3000, 3):
+            storage['key{}'.format(n)] = 'longer value'
+        for n in range(0, 3000, 5):
+            storage.pop('key{}'.format(n))
+        for shard_id in kvsservice.shards:
+            keys = [key for key in storage if kvsservice.hash_of_key(key) == shard_id]
+            size = sum(len(kvsstorage.encode_item(key, storage[key])) for key in keys)
+            self.assertEqual(storage.bucket_totals(kvsservice.ring.buckets_of(shard_id)), (len(keys), size))
+
+    def test_b_prune_keeps_own_buckets(self):
+        storage = kvsservice.storage
+        storage.set_version('key1', [1, '10.10.0.3:8090'])
+        own = {key for key in storage if kvsservice.hash_of_key(key) == 0}
+        self.assertEqual(kvsservice.prune_storage(), 3000 - len(own))
+        self.assertEqual(set(storage), own)
+        self.assertEqual(set(storage.held_buckets()), set(storage.bucket_keys) | ({storage.bucket_of('key1')} if 'key1' in own else set()))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.vc = kvsservice.VectorClock(['10.10.0.2:8090', '10.10.0.3:8090'])
+        kvsservice.histograms.clear()
+        kvsservice.counters.clear()
+        kvsservice.storage = kvsstorage.MemoryStorage({'key{}'.format(n): n for n in range(100)})
+        kvsservice.set_shards({0: ['10.10.0.2:8090'], 1: ['10.10.0.3:8090']})
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        self.client = kvsservice.app.test_client()
+
+    def test_a_histogram_buckets_are_cumulative(self):
+        for seconds in (0.0002, 0.003, 0.003, 40):
+            kvsservice.observe('kvs_forward_seconds', seconds, peer='10.10.0.3:8090')
+        text = kvsservice.render_metrics([])
+        self.assertIn('# TYPE kvs_forward_seconds histogram', text)
+        self.assertIn('kvs_forward_seconds_bucket{peer="10.10.0.3:8090",le="0.0005"} 1', text)
+        self.assertIn('kvs_forward_seconds_bucket{peer="10.10.0.3:8090",le="0.005"} 3', text)
+        self.assertIn('kvs_forward_seconds_bucket{peer="10.10.0.3:8090",le="+Inf"} 4', text)
+        self.assertIn('kvs_forward_seconds_count{peer="10.10.0.3:8090"} 4', text)
+
+    def test_b_routes_and_storage_are_exposed(self):
+        '''Are requests counted per route pattern and status, and the shards' keys reported?'''
+        self.client.get('/shard/key-count/0')
+        self.client.get('/shard/key-count/7')
+        text = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('kvs_requests_total{route="/shard/key-count/<ID>",method="GET",status="404"} 1', text)
+        self.assertIn('kvs_request_seconds_count{route="/shard/key-count/<ID>",method="GET"} 2', text)
+        shard_keys = sum(1 for key in kvsservice.storage if kvsservice.hash_of_key(key) == 1)
+        self.assertIn('kvs_storage_keys{{shard="1"}} {}'.format(shard_keys), text)
+
+    def test_c_cluster_stats_gathered_once_per_ttl(self):
+        '''Does /cluster/stats report this node's shard, report a shard with no member that answers instead of failing,
+        and answer from what it gathered until STATS_TTL is up?'''
+        kvsservice.set_shards({0: ['10.10.0.2:8090'], 1: ['127.0.0.1:1']}) # nothing listens there, connecting is refused
+        kvsservice.gathered_stats = None
+        kvsservice.peer_health.clear()
+        body = self.client.get('/cluster/stats').get_json()
+        shard_keys = sum(1 for key in kvsservice.storage if kvsservice.hash_of_key(key) == 0)
+        self.assertEqual(body['shards']['0']['key-count'], shard_keys)
+        self.assertEqual(body['shards']['0']['clock-entries'], len(kvsservice.vc.members))
+        self.assertIn('error', body['shards']['1'])
+        self.assertEqual((body['key-count'], body['unreachable-shards']), (shard_keys, 1))
+        self.client.get('/cluster/stats')
+        self.assertEqual(kvsservice.peer_health['127.0.0.1:1'].failures, 1)
+
+class TestAsyncServer(unittest.TestCase):
+
+    def test_a_acks_wake_coroutine(self):
+        '''Does a coroutine waiting on acks wake when another thread records them, without polling?'''
+        acks = kvsservice.Acks(['10.10.0.3:8090', '10.10.0.4:8090'])
+
+        async def wait():
+            threading.Timer(0.05, acks.record, ('10.10.0.3:8090', True)).start()
+            return await asyncio.wait_for(acks.wait_async(1), 2)
+
+        self.assertEqual(asyncio.run(wait()), 1)
+        self.assertEqual(acks.pending, {'10.10.0.4:8090'})
+
+    def test_b_causal_wait_times_out(self):
+        condition = kvsservice.AsyncCondition()
+        start = time.time()
+        self.assertFalse(asyncio.run(condition.wait_for_async(lambda: False, 0.1)))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(condition.futures, [])
+
+class TestConcurrency(unittest.TestCase):
+
+    def setUp(self):
+        kvsservice.socket_address = '10.10.0.2:8090'
+        kvsservice.replicas = ['10.10.0.2:8090', '10.10.0.3:8090']
+        kvsservice.vc = kvsservice.VectorClock(kvsservice.replicas)
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({0: ['10.10.0.2:8090'], 1: ['10.10.0.3:8090']})
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        kvsservice.lamport = 0
+        self.interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5) # switch threads often to bring races out
+
+    def tearDown(self):
+        sys.setswitchinterval(self.interval)
+
+    def test_a_no_lost_updates(self):
+        '''Does every key end with the value of its newest write when writes from many threads, reads, anti-entropy
+        repairs and view changes all run at once?'''
+        writers, writes, key_count = 8, 250, 16
+        keys = [key for key in ('key{}'.format(n) for n in range(200)) if kvsservice.hash_of_key(key) == 0][:key_count]
+        written = collections.defaultdict(list)
+        errors = []
+        lock = threading.Lock()
+
+        def run(work):
+            try:
+                work()
+            except Exception as e:
+                errors.append(e)
+
+        broadcast = kvsservice.broadcast_to_replicas
+        def sent(method, path, data, shard_id, sent_keys): # every write's version and value, as its replicas get them
+            with lock:
+                written[sent_keys[0]].append((data['version'], kvsstorage.value_from(data)))
+            return broadcast(method, path, data, shard_id, sent_keys)
+        kvsservice.broadcast_to_replicas = sent
+        self.addCleanup(setattr, kvsservice, 'broadcast_to_replicas', broadcast)
+
+        def writer(n):
+            for i in range(writes):
+                kvsservice.kvs_serve('PUT', keys[i % key_count], {'value': '{}-{}'.format(n, i), 'causal-metadata': None}, 0)
+
+        def reader():
+            for i in range(writes):
+                body, status, waits = kvsservice.kvs_serve('GET', keys[i % key_count], {}, 0)
+                if status == 200:
+                    kvsservice.unpack_clock(body['causal-metadata']['message-clock'])
+
+        def repairer(): # items as new as the latest write, which win over the write of the same Lamport time
+            for i in range(writes):
+                item = {'value': 'repair-{}'.format(i), 'version': [kvsservice.lamport, '10.10.0.9:8090']}
+                kvsservice.apply_items({keys[i % key_count]: item})
+                with lock:
+                    written[keys[i % key_count]].append((item['version'], item['value']))
+
+        def view_changer():
+            client = kvsservice.app.test_client()
+            for i in range(50):
+                client.put('/view', json={'socket-address': '10.10.0.9:8090'})
+                client.delete('/view', json={'socket-address': '10.10.0.9:8090'})
+
+        work = [lambda n=n: writer(n) for n in range(writers)] + [reader, reader, repairer, view_changer]
+        threads = [threading.Thread(target=run, args=(job,)) for job in work]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(kvsservice.vc.get('10.10.0.2:8090'), writers * writes)
+        self.assertEqual(kvsservice.lamport, writers * writes)
+        for key in keys:
+            version, value = max(written[key])
+            self.assertEqual((kvsservice.storage.versions[key], kvsservice.storage[key]), (version, value))
+        self.assertEqual(kvsservice.storage.bucket_totals(range(kvsservice.BUCKETS))[0], key_count)
+        self.assertEqual(kvsservice.replicas, ['10.10.0.2:8090', '10.10.0.3:8090'])
+        self.assertEqual(kvsservice.shards, {0: ['10.10.0.2:8090'], 1: ['10.10.0.3:8090']})
+
+    def test_b_full_reads_while_keys_come_and_go(self):
+        '''Do /getall and the hash tree's version lists read a steady copy while writers add and remove keys?'''
+        stopped = threading.Event()
+        def churn():
+            for i in itertools.count():
+                if stopped.is_set():
+                    return
+                kvsservice.storage['key{}'.format(i % 500)] = i
+                kvsservice.storage.pop('key{}'.format((i + 250) % 500), None)
+                kvsservice.storage.set_version('key{}'.format(i % 500), [i, '10.10.0.2:8090'])
+                kvsservice.storage.forget('key{}'.format((i + 250) % 500))
+        threads = [threading.Thread(target=churn) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        try:
+            client = kvsservice.app.test_client()
+            for _ in range(30):
+                self.assertEqual(client.get('/getall').status_code, 200)
+                kvsservice.storage.leaf_versions(range(kvsstorage.MERKLE_LEAVES))
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+
+class TestReplicaFrames(unittest.TestCase):
+
+    alice = '10.10.0.2:8090'
+
+    def setUp(self):
+        probe = socket.create_server(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        self.node = '127.0.0.1:{}'.format(port - kvsservice.REPLICA_PORT_OFFSET)
+        kvsservice.socket_address = self.node
+        kvsservice.vc = kvsservice.VectorClock([self.alice, self.node])
+        kvsservice.storage = kvsstorage.MemoryStorage()
+        kvsservice.set_shards({0: [self.alice, self.node]})
+        kvsservice.holdback = kvsservice.HoldbackQueue()
+        kvsservice.lamport = 0
+        kvsservice.serve_frames('127.0.0.1', port)
+        self.connection = kvsservice.FrameConnection(self.node)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def test_a_pipelined_messages_in_order(self):
+        '''Are replica messages sent without waiting for each other's answers delivered in order, with packed clocks?'''
+        futures = []
+        for n in range(1, 51):
+            metadata = {'senders-address': self.alice, 'message-clock': kvsservice.pack_clock(kvsservice.vc.digest, [n, 0])}
+            futures.append(self.connection.call('PUT', '/replica_kvs/key{}'.format(n % 5), {'value': n, 'version': [n, self.alice], 'causal-metadata': metadata}))
+        responses = [future.result(5) for future in futures]
+        self.assertEqual([response.status_code for response in responses], [201] * 5 + [200] * 45)
+        self.assertEqual(kvsservice.vc.get(self.alice), 50)
+        self.assertEqual({key: kvsservice.storage[key] for key in kvsservice.storage}, {'key{}'.format(n % 5): n for n in range(46, 51)})
+        self.assertEqual(self.connection.call('GET', '/getall', None).result(5).status_code, 404)
+
+    def test_b_closed_connection_refuses_calls(self):
+        self.connection.close()
+        with self.assertRaises(OSError):
+            self.connection.call('PUT', '/update_metadata', {})
+
+
+if __name__ == '__main__':
+    unittest.main()